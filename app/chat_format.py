@@ -0,0 +1,213 @@
+"""
+Prompt format, stop words and model type of a GGUF model from its header.
+
+The prompts of the web UIs are written in Zephyr's format:
+
+    <|system|>
+    You are a text generation tool... </s>
+    <|user|> Generate a random character name. Topic: fantasy. </s>
+    <|assistant|>
+
+Other models do not know these tags and keep generating until
+`max_new_tokens`, and a model of an architecture the backend can't run
+fails only after it has been downloaded. `ChatFormat.from_header()` reads
+what the model itself declares (see `gguf_header`): its architecture, its
+end-of-sequence token and the chat template embedded by the converter.
+`ChatFormattedLLM` then rewrites every prompt into the model's template and
+the loader takes the stop words from the template's turn markers and the
+EOS token. Models without a template, or with a Zephyr-style one, get the
+prompts unchanged.
+
+Rendering the template needs jinja2, which Gradio installs.
+"""
+
+import re
+
+import gguf_header
+from llm_backend import LLMBackend
+
+# The only GGUF architecture CTransformers loads, and its model type.
+# CTransformers reads GGUF files only through its llama.cpp backend; its
+# other model types (gpt2, mpt, starcoder, ...) read GGML files. Mistral
+# and its fine-tunes declare the llama architecture.
+ARCHITECTURE = "llama"
+MODEL_TYPE = "llama"
+# Tokens that start or end a turn in common templates; whichever of them
+# the template uses are stop words.
+TURN_MARKERS = [
+    "<|im_end|>", "<|im_start|>", "<|eot_id|>", "<|start_header_id|>",
+    "<end_of_turn>", "<start_of_turn>", "<|end|>", "<|user|>",
+    "<|assistant|>", "<|system|>", "[INST]", "</s>",
+]
+TURN = re.compile(r"<\|(system|user|assistant)\|>")
+
+
+class UnsupportedModel(ValueError):
+    pass
+
+
+def parse_prompt(prompt):
+    """Split a Zephyr-style prompt into chat messages.
+
+    Returns the messages and the text the assistant's answer starts with
+    (usually empty).
+    """
+    parts = TURN.split(prompt)
+    messages = [
+        {"role": role, "content": content.strip().removesuffix("</s>").strip()}  # nopep8
+        for role, content in zip(parts[1::2], parts[2::2])
+    ]
+    answer = ""
+    if messages and messages[-1]["role"] == "assistant":
+        answer = messages.pop()["content"]
+    return messages, answer
+
+
+def without_system(messages):
+    # For templates that reject a system message (e.g. Mistral Instruct).
+    if not messages or messages[0]["role"] != "system":
+        return messages
+    system, *rest = messages
+    if rest and rest[0]["role"] == "user":
+        rest[0] = {"role": "user",
+                   "content": system["content"] + "\n\n" + rest[0]["content"]}
+        return rest
+    return [{"role": "user", "content": system["content"]}, *rest]
+
+
+class ChatFormat:
+    def __init__(self, model_type, template=None, bos="", eos=""):
+        self.model_type = model_type
+        self.template = template
+        self.bos = bos
+        self.eos = eos
+        self._compiled = None
+
+    @classmethod
+    def from_header(cls, header):
+        architecture = header.architecture
+        if architecture != ARCHITECTURE:
+            raise UnsupportedModel(
+                f"The model's architecture is {architecture}; CTransformers "
+                f"loads GGUF models of the {ARCHITECTURE} architecture only"
+            )
+        tokens = header.get("tokenizer.ggml.tokens") or []
+
+        def token(key):
+            index = header.get(key)
+            return tokens[index] if index is not None and index < len(tokens) else ""  # nopep8
+
+        return cls(MODEL_TYPE,
+                   header.get("tokenizer.chat_template"),
+                   token("tokenizer.ggml.bos_token_id"),
+                   token("tokenizer.ggml.eos_token_id"))
+
+    @property
+    def rewrites(self):
+        """Whether prompts have to be rewritten for this model."""
+        return bool(self.template) and "<|user|>" not in self.template
+
+    def stop(self, default):
+        """Stop words: the template's turn markers and the EOS token."""
+        if self.rewrites:
+            stop = [marker for marker in TURN_MARKERS
+                    if marker in self.template]
+        else:
+            stop = list(default)
+        if self.eos and self.eos not in stop:
+            stop.append(self.eos)
+        return stop
+
+    def _render(self, messages):
+        if self._compiled is None:
+            from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+            def raise_exception(message):
+                raise ValueError(message)
+
+            environment = ImmutableSandboxedEnvironment(
+                trim_blocks=True, lstrip_blocks=True
+            )
+            environment.globals["raise_exception"] = raise_exception
+            self._compiled = environment.from_string(self.template)
+        return self._compiled.render(
+            messages=messages, add_generation_prompt=True,
+            bos_token=self.bos, eos_token=self.eos,
+        )
+
+    def format(self, prompt):
+        """Rewrite a Zephyr-style prompt into the model's template."""
+        if not self.rewrites:
+            return prompt
+        messages, answer = parse_prompt(prompt)
+        if not messages:
+            return prompt
+        try:
+            text = self._render(messages)
+        except ImportError:
+            print("jinja2 is not installed; prompts are passed on in Zephyr's format")  # nopep8
+            self.template = None
+            return prompt
+        except Exception:
+            # E.g. a template that only accepts user and assistant turns.
+            try:
+                text = self._render(without_system(messages))
+            except Exception as e:
+                print(f"The model's chat template failed ({e}); passing the prompt on unchanged")  # nopep8
+                return prompt
+        # The tokenizer adds the BOS token itself.
+        if self.bos and text.startswith(self.bos):
+            text = text[len(self.bos):]
+        return text + answer
+
+
+def model_type(path, default=MODEL_TYPE):
+    """Return the CTransformers model type of the GGUF file at `path`.
+
+    Every script that loads a model passes the same type, so they share one
+    copy of it in the model server. `default` is returned when the header
+    can't be read; loading the file reports the actual problem.
+    """
+    try:
+        header = gguf_header.read_local(path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read the header of {path}: {e}")
+        return default
+    return ChatFormat.from_header(header).model_type
+
+
+def with_chat_format(llm, chat_format):
+    """Wrap `llm` in a `ChatFormattedLLM` if its prompts need rewriting."""
+    if chat_format is None or not chat_format.rewrites:
+        return llm
+    return ChatFormattedLLM(llm, chat_format)
+
+
+class ChatFormattedLLM(LLMBackend):
+    """Pass prompts to `llm` in the model's own chat template."""
+
+    def __init__(self, llm, chat_format):
+        self.llm = llm
+        self.chat_format = chat_format
+
+    @property
+    def config(self):
+        return self.llm.config
+
+    @property
+    def last_timing(self):
+        return self.llm.last_timing
+
+    def __getattr__(self, name):
+        # queue_status(), slots, ... of the wrapped backend.
+        return getattr(self.llm, name)
+
+    def invalidate(self, key=None):
+        self.llm.invalidate(key)
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text)
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        return self.llm.stream(self.chat_format.format(prompt), stop=stop,
+                               prefix_key=prefix_key)
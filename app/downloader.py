@@ -0,0 +1,208 @@
+"""
+Resumable model downloader shared by the CLI scripts and the web UIs.
+
+Large files are fetched as several HTTP Range segments in parallel and
+written into a `<file>.part` file next to the destination. Progress of every
+segment is kept in `<file>.part.json`, so an interrupted download continues
+where it stopped. The file is only renamed to its final name once every byte
+has arrived, so a truncated model never ends up in the `models` folder.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from tqdm import tqdm
+
+DEFAULT_CONNECTIONS = 4
+CHUNK_SIZE = 1024 * 1024
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+STATE_SAVE_INTERVAL = 2.0
+RETRIES = 3
+TIMEOUT = 30
+
+
+def probe(url):
+    # A one byte range request tells us the size, whether ranges work and
+    # the final URL after redirects (e.g. Hugging Face -> CDN).
+    with requests.get(
+        url,
+        headers={"Range": "bytes=0-0"},
+        stream=True,
+        allow_redirects=True,
+        timeout=TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        content_range = response.headers.get("content-range", "")
+        if response.status_code == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            if total.isdigit():
+                return int(total), True, response.url
+        return int(response.headers.get("content-length", 0)), False, response.url
+
+
+def split_segments(total_size, connections):
+    count = max(1, min(connections, total_size // MIN_SEGMENT_SIZE))
+    step = total_size // count
+    segments = []
+    for i in range(count):
+        start = i * step
+        end = total_size - 1 if i == count - 1 else start + step - 1
+        segments.append([start, end, 0])
+    return segments
+
+
+def load_state(state_path, url, total_size):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("url") != url or state.get("size") != total_size:
+        return None
+    return state
+
+
+def save_state(state_path, state):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def download_segment(url, part_path, segment, lock, counter):
+    start, end, _ = segment
+    for attempt in range(RETRIES):
+        offset = start + segment[2]
+        if offset > end:
+            return
+        try:
+            with requests.get(
+                url,
+                headers={"Range": f"bytes={offset}-{end}"},
+                stream=True,
+                timeout=TIMEOUT,
+            ) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise IOError("Server ignored the range request")
+                with open(part_path, "r+b") as out_file:
+                    out_file.seek(offset)
+                    for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                        out_file.write(data)
+                        with lock:
+                            segment[2] += len(data)
+                            counter[0] += len(data)
+            if start + segment[2] > end:
+                return
+        except (requests.RequestException, IOError):
+            if attempt == RETRIES - 1:
+                raise
+            time.sleep(1 + attempt)
+
+
+def download_ranged(url, resolved_url, part_path, state_path, total_size,
+                    connections, report):
+    state = load_state(state_path, url, total_size)
+    if state is None or not os.path.exists(part_path):
+        state = {
+            "url": url,
+            "size": total_size,
+            "segments": split_segments(total_size, connections),
+        }
+        with open(part_path, "wb") as out_file:
+            out_file.truncate(total_size)
+        save_state(state_path, state)
+
+    segments = state["segments"]
+    lock = threading.Lock()
+    counter = [sum(segment[2] for segment in segments)]
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [
+            executor.submit(
+                download_segment, resolved_url, part_path, segment, lock, counter
+            )
+            for segment in segments
+        ]
+        pending = futures
+        while pending:
+            _, pending = wait(pending, timeout=STATE_SAVE_INTERVAL)
+            with lock:
+                snapshot = {**state, "segments": [list(s) for s in segments]}
+                downloaded = counter[0]
+            save_state(state_path, snapshot)
+            report(downloaded)
+        for future in futures:
+            future.result()
+    if any(start + done <= end for start, end, done in segments):
+        raise IOError(f"Connection closed early while downloading {url}")
+
+
+def download_single(url, part_path, report):
+    with requests.get(url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        downloaded = 0
+        with open(part_path, "wb") as out_file:
+            for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                out_file.write(data)
+                downloaded += len(data)
+                report(downloaded)
+
+
+def download_file(url, destination, connections=DEFAULT_CONNECTIONS,
+                  progress=None):
+    """Download `url` to `destination`, resuming a previous `.part` file.
+
+    `progress` is an optional callable taking `(fraction, description)`,
+    such as `gr.Progress()`. Progress is always reported from the calling
+    thread.
+    """
+    folder = os.path.dirname(destination)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    part_path = destination + ".part"
+    state_path = part_path + ".json"
+    total_size, accepts_ranges, resolved_url = probe(url)
+
+    name = os.path.basename(destination)
+    progress_bar = tqdm(
+        total=total_size or None,
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=f"Downloading {name}",
+    )
+
+    def report(downloaded):
+        progress_bar.update(downloaded - progress_bar.n)
+        if progress and total_size > 0:
+            progress(
+                downloaded / total_size,
+                f"Downloading {name}... {downloaded // 1024 // 1024}MB / {total_size // 1024 // 1024}MB",  # nopep8
+            )
+
+    try:
+        if accepts_ranges and total_size > 0:
+            # Segments use the resolved (possibly signed CDN) address while
+            # the state file stays keyed by the original URL.
+            download_ranged(
+                url, resolved_url, part_path, state_path, total_size,
+                connections, report
+            )
+        else:
+            download_single(url, part_path, report)
+    finally:
+        progress_bar.close()
+
+    if total_size and os.path.getsize(part_path) != total_size:
+        raise IOError(
+            f"Incomplete download of {url}: expected {total_size} bytes, "
+            f"got {os.path.getsize(part_path)}"
+        )
+    os.replace(part_path, destination)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return destination
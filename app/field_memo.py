@@ -0,0 +1,98 @@
+"""
+Remember which inputs every generated character field came from.
+
+A field's key is a hash of everything that flows into its generation: the
+full prompt (template, name, summary, topic, gender, ...), the model and
+its sampling parameters. `FieldMemo` keeps the output generated for a key
+and, for each output, the key it was generated from. That tells whether a
+field is stale, i.e. was generated from inputs that have changed since,
+without keeping any per-session state. Text that was never generated here
+(typed in or imported) is never considered stale.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# Config keys that change the generated text; threads, batch size and GPU
+# layers only change how fast it is generated.
+SAMPLING_KEYS = (
+    "max_new_tokens",
+    "repetition_penalty",
+    "last_n_tokens",
+    "top_k",
+    "top_p",
+    "temperature",
+    "seed",
+    "stop",
+)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def field_key(prompt, model, config=None):
+    sampling = {k: v for k, v in (config or {}).items() if k in SAMPLING_KEYS}
+    return text_hash(json.dumps([prompt, model, sampling], sort_keys=True))
+
+
+class FieldMemo:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._outputs = OrderedDict()  # key -> output
+        self._sources = OrderedDict()  # hash of an output -> key
+
+    def record(self, key, output):
+        with self._lock:
+            self._outputs[key] = output
+            self._outputs.move_to_end(key)
+            self._sources[text_hash(output)] = key
+            self._sources.move_to_end(text_hash(output))
+            for entries in (self._outputs, self._sources):
+                while len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+
+    def lookup(self, key):
+        with self._lock:
+            if key in self._outputs:
+                self._outputs.move_to_end(key)
+            return self._outputs.get(key)
+
+    def is_stale(self, value, key):
+        """Return True if `value` is empty or was generated for another key."""
+        if not value:
+            return True
+        with self._lock:
+            source = self._sources.get(text_hash(value))
+        return source is not None and source != key
+
+    def refresh(self, fields, prompts, key, generate):
+        """Bring `fields` up to date with the inputs they are generated from.
+
+        `fields` maps field names to their values in dependency order and is
+        updated in place. `prompts[field](fields)` builds a field's prompt
+        from the current values, `key(prompt)` its key and
+        `generate(field, prompt)` streams a new value. Walking from top to
+        bottom, a regenerated field makes the fields generated from it stale
+        in turn; fresh fields and text typed in by hand are left alone, and
+        inputs seen before reuse the remembered output.
+
+        Yields `(field, "reused")` for a remembered output and
+        `(field, "generated")` for every chunk of a new one.
+        """
+        for field in fields:
+            prompt = prompts[field](fields)
+            prompt_key = key(prompt)
+            if not self.is_stale(fields[field], prompt_key):
+                continue
+            remembered = self.lookup(prompt_key)
+            if remembered is not None:
+                fields[field] = remembered
+                yield field, "reused"
+                continue
+            for output in generate(field, prompt):
+                fields[field] = output
+                yield field, "generated"
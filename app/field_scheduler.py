@@ -0,0 +1,73 @@
+"""
+Generate character fields concurrently, following their dependencies.
+
+Every field is generated from the fields it is declared to depend on, so
+once the name, summary and personality exist, the scenario, greeting message
+and example messages are independent of each other and run at the same time
+on a small pool of LLM workers. The avatar prompt only needs the summary.
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+FIELD_DEPENDENCIES = {
+    "name": [],
+    "summary": ["name"],
+    "personality": ["name", "summary"],
+    "scenario": ["summary", "personality"],
+    "greeting_message": ["name", "summary", "personality"],
+    "example_messages": ["name", "summary", "personality"],
+    "avatar_prompt": ["summary"],
+}
+
+
+def run_fields(generators, given=None, workers=2,
+               dependencies=FIELD_DEPENDENCIES):
+    """Return a dict with the given fields and every generated one.
+
+    `generators` maps a field to a function that receives the fields
+    generated so far and returns the new value. Fields in `given` are used
+    as they are and not generated.
+    """
+    fields = dict(given or {})
+    pending = [field for field in dependencies
+               if field in generators and field not in fields]
+    for field in pending:
+        missing = [d for d in dependencies[field]
+                   if d not in fields and d not in generators]
+        if missing:
+            raise ValueError(f"{field} depends on {', '.join(missing)}, which is neither given nor generated")  # nopep8
+
+    durations = {}
+    started = time.perf_counter()
+
+    def generate(field, inputs):
+        field_started = time.perf_counter()
+        value = generators[field](inputs)
+        durations[field] = time.perf_counter() - field_started
+        return value
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        running = {}
+        while pending or running:
+            # Pending fields stay in declaration order, which puts the
+            # fields other fields wait for first.
+            for field in [f for f in pending
+                          if all(d in fields for d in dependencies[f])]:
+                pending.remove(field)
+                running[executor.submit(generate, field, dict(fields))] = field  # nopep8
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                field = running.pop(future)
+                try:
+                    fields[field] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+
+    wall = time.perf_counter() - started
+    if durations:
+        busy = sum(durations.values())
+        print(f"Generated {len(durations)} fields in {wall:.1f}s; one after another they take {busy:.1f}s ({busy / wall:.2f}x)")  # nopep8
+    return fields
@@ -0,0 +1,82 @@
+"""
+Per-field generation limits.
+
+The models are loaded with `max_new_tokens: 1024` and one stop list for
+every field, so a name could run on for hundreds of tokens that are thrown
+away afterwards. Each field gets a profile, applied per call to the loaded
+model:
+
+- `max_new_tokens`: upper bound for the field.
+- `stop`: stop sequences added to the model's stop list.
+- `lines`: stop after this many non-empty lines.
+- `turns`: stop at the end of the line of this many `{{user}}:`/`{{char}}:`
+  dialogue turns.
+
+Profiles are looked up by the prefix key of the request, which names the
+field. CHARACTER_FACTORY_FIELD_PROFILES=0 turns them off.
+"""
+
+import os
+import re
+
+ENABLED = os.environ.get("CHARACTER_FACTORY_FIELD_PROFILES", "1") != "0"
+
+PROFILES = {
+    "name": {"max_new_tokens": 24, "stop": ["(", ","], "lines": 1},
+    "summary": {"max_new_tokens": 512},
+    "personality": {"max_new_tokens": 256},
+    "scenario": {"max_new_tokens": 256},
+    "greeting_message": {"max_new_tokens": 384},
+    "example_messages": {"max_new_tokens": 640, "turns": 8},
+    "avatar_prompt": {"max_new_tokens": 128, "lines": 1},
+}
+
+TURN = re.compile(r"\s*\{\{(user|char)\}\}:")
+
+
+def profile(field):
+    """Return the profile of `field`, empty if there is none or they are off."""
+    return PROFILES.get(field, {}) if ENABLED else {}
+
+
+def stop_list(field, stop):
+    extra = profile(field).get("stop", [])
+    return list(stop or []) + [s for s in extra if s not in (stop or [])]
+
+
+def cut_position(field, text):
+    """Return where to end `text` once the field's early-stop rule is met.
+
+    Only complete lines count, so the position never lies before the
+    newline that completed the rule.
+    """
+    lines = profile(field).get("lines")
+    turns = profile(field).get("turns")
+    if not lines and not turns:
+        return None
+    seen_lines = seen_turns = 0
+    position = 0
+    for line in text.split("\n")[:-1]:
+        if line.strip():
+            seen_lines += 1
+            if TURN.match(line):
+                seen_turns += 1
+        if (lines and seen_lines >= lines) or (turns and seen_turns >= turns):
+            return position + len(line)
+        position += len(line) + 1
+    return None
+
+
+def held_back(text, stop):
+    """Return how many characters at the end of `text` may start a stop word.
+
+    Backends that look for stop words themselves keep these back until the
+    next chunk shows whether the stop word follows.
+    """
+    held = 0
+    for word in stop:
+        for length in range(min(len(word) - 1, len(text)), held, -1):
+            if text.endswith(word[:length]):
+                held = length
+                break
+    return held
@@ -0,0 +1,134 @@
+"""
+Read the metadata of a GGUF model file without loading it.
+
+A GGUF file starts with a header of key-value metadata (architecture, layer
+count, embedding size, quantization, tokenizer, chat template, ...). Local
+files are memory-mapped, so only the pages of the header are read; for a
+URL the header is fetched with HTTP Range requests, so nothing has to be
+downloaded to find out what a model needs.
+"""
+
+import mmap
+import os
+import struct
+
+import requests
+
+MAGIC = b"GGUF"
+# Remote headers are fetched in growing ranges up to this size.
+FIRST_RANGE = 2 * 1024 * 1024
+MAX_RANGE = 64 * 1024 * 1024
+TIMEOUT = 30
+
+# Value types of the metadata.
+SCALARS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?",
+    10: "<Q", 11: "<q", 12: "<d",
+}
+STRING = 8
+ARRAY = 9
+
+
+class TruncatedHeader(ValueError):
+    pass
+
+
+class GGUFHeader:
+    def __init__(self, version, tensor_count, metadata, file_size):
+        self.version = version
+        self.tensor_count = tensor_count
+        self.metadata = metadata
+        self.file_size = file_size
+
+    @property
+    def architecture(self):
+        return self.metadata.get("general.architecture", "llama")
+
+    def get(self, key, default=None):
+        """Return `key`, with `{arch}` replaced by the architecture."""
+        return self.metadata.get(key.format(arch=self.architecture), default)
+
+
+class Reader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def read(self, fmt):
+        size = struct.calcsize(fmt)
+        if self.offset + size > len(self.buffer):
+            raise TruncatedHeader("GGUF header is longer than the data read")
+        value = struct.unpack_from(fmt, self.buffer, self.offset)[0]
+        self.offset += size
+        return value
+
+    def string(self, length_fmt):
+        length = self.read(length_fmt)
+        if self.offset + length > len(self.buffer):
+            raise TruncatedHeader("GGUF header is longer than the data read")
+        value = bytes(self.buffer[self.offset:self.offset + length])
+        self.offset += length
+        return value.decode("utf-8", errors="replace")
+
+    def value(self, value_type, length_fmt):
+        if value_type in SCALARS:
+            return self.read(SCALARS[value_type])
+        if value_type == STRING:
+            return self.string(length_fmt)
+        if value_type == ARRAY:
+            item_type = self.read("<I")
+            count = self.read(length_fmt)
+            return [self.value(item_type, length_fmt) for _ in range(count)]
+        raise ValueError(f"Unknown GGUF value type {value_type}")
+
+
+def parse(buffer, file_size=None):
+    """Parse the header at the start of `buffer` (bytes or mmap)."""
+    reader = Reader(buffer)
+    if bytes(buffer[:4]) != MAGIC:
+        raise ValueError("Not a GGUF file")
+    reader.offset = 4
+    version = reader.read("<I")
+    # Version 1 used 32-bit counts and lengths.
+    length_fmt = "<I" if version == 1 else "<Q"
+    tensor_count = reader.read(length_fmt)
+    kv_count = reader.read(length_fmt)
+    metadata = {}
+    for _ in range(kv_count):
+        key = reader.string(length_fmt)
+        metadata[key] = reader.value(reader.read("<I"), length_fmt)
+    return GGUFHeader(version, tensor_count, metadata,
+                      len(buffer) if file_size is None else file_size)
+
+
+def read_local(path):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return parse(mapped, os.path.getsize(path))
+
+
+def read_remote(url):
+    size = FIRST_RANGE
+    while True:
+        with requests.get(url, headers={"Range": f"bytes=0-{size - 1}"},
+                          stream=True, allow_redirects=True,
+                          timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            content_range = response.headers.get("content-range", "")
+            if response.status_code == 206 and "/" in content_range:
+                file_size = int(content_range.rsplit("/", 1)[1])
+            else:
+                file_size = int(response.headers.get("content-length", 0))
+            # A server that ignores the range sends the whole file; stop
+            # reading after the part that was asked for.
+            data = bytearray()
+            for chunk in response.iter_content(1024 * 1024):
+                data += chunk
+                if len(data) >= size:
+                    break
+        try:
+            return parse(bytes(data[:size]), file_size or None)
+        except TruncatedHeader:
+            if size >= MAX_RANGE or (file_size and size >= file_size):
+                raise
+            size *= 4
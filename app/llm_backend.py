@@ -0,0 +1,37 @@
+"""
+The interface behind every `llm.invoke()` and `llm.stream()` call.
+
+The scripts and web UIs only use the methods of `LLMBackend`, so the model
+can run in this process (`PrefixCachedLLM`, `SpeculativeLLM`), in the model
+server (`RemoteLLM`) or behind an OpenAI-compatible HTTP endpoint
+(`OpenAICompatibleLLM`). `CachedLLM` wraps any of them.
+"""
+
+
+class LLMBackend:
+    """Base class of the LLM backends.
+
+    `prefix_key` names the field being generated ("name", "summary", ...);
+    backends use it for the field's generation profile and their caches.
+    """
+
+    config = None
+    last_timing = None
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        """Yield the generated text in chunks as it arrives.
+
+        Closing the generator early stops the generation.
+        """
+        raise NotImplementedError
+
+    def invoke(self, prompt, stop=None, prefix_key="default"):
+        return "".join(self.stream(prompt, stop=stop, prefix_key=prefix_key))
+
+    def invalidate(self, key=None):
+        """Forget cached state of a prompt template; a no-op by default."""
+
+    def tokenize(self, text):
+        raise NotImplementedError(
+            f"{type(self).__name__} can't tokenize text locally"
+        )
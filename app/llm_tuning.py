@@ -0,0 +1,182 @@
+"""
+Per-host tuning of CTransformers `threads` and `batch_size`.
+
+The library defaults (all cores, batch size 8) are far from ideal on large
+CPU-only machines. The tuner loads a GGUF model once, then times prompt
+evaluation and token generation with the real few-shot prompt for every
+combination in a small grid, and stores the fastest settings in
+`models/llm_tuning.json` keyed by host and model file:
+
+    python app/llm_tuning.py models/mistral-7b-instruct-v0.1.Q4_K_M.gguf
+
+The scripts call `apply_tuning()` when they build a CPU-only LLM, which applies
+whatever was stored; nothing changes until the tuner has run.
+"""
+
+import argparse
+import ast
+import datetime
+import json
+import os
+import platform
+import time
+
+TUNING_FILE = os.path.join("models", "llm_tuning.json")
+PROMPT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "main-poweruser-webui.py")
+# A character field costs one few-shot prompt evaluation plus roughly this
+# many generated tokens; the score weights both phases accordingly.
+EXPECTED_NEW_TOKENS = 200
+
+
+def host_key():
+    return f"{platform.node()}/{os.cpu_count()}cpu"
+
+
+def model_key(model_path):
+    return f"{os.path.basename(model_path)}:{os.path.getsize(model_path)}"
+
+
+def load_tuning(path=TUNING_FILE):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_tuning(model_path, result, path=TUNING_FILE):
+    tuning = load_tuning(path)
+    tuning.setdefault(host_key(), {})[model_key(model_path)] = result
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(tuning, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def tuned_config(model_path, path=TUNING_FILE):
+    """Return `{"threads": ..., "batch_size": ...}` or `{}` if not tuned."""
+    try:
+        result = load_tuning(path).get(host_key(), {}).get(model_key(model_path))
+    except OSError:
+        return {}
+    if not result:
+        return {}
+    return {"threads": result["threads"], "batch_size": result["batch_size"]}
+
+
+def apply_tuning(config, model_path, gpu_layers):
+    # Tuning is measured without offloading, so it only applies to CPU runs.
+    if gpu_layers:
+        return config
+    tuned = tuned_config(model_path)
+    if tuned:
+        print(f"Using tuned CPU settings: {tuned['threads']} threads, batch size {tuned['batch_size']}")  # nopep8
+    else:
+        print(f"No CPU tuning for this host yet, run: python app/llm_tuning.py {model_path}")  # nopep8
+    return {**config, **tuned}
+
+
+def default_prompt(name="SUMMARY_PROMPT"):
+    # Read the few-shot prompt from the power-user UI without importing it.
+    with open(PROMPT_SOURCE, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and \
+                any(getattr(t, "id", None) == name for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise KeyError(name)
+
+
+def thread_candidates():
+    cpus = os.cpu_count() or 1
+    return sorted({max(1, cpus * n // 8) for n in (2, 4, 6, 8)})
+
+
+def measure(llm, tokens, new_tokens, threads, batch_size):
+    llm._context.clear()
+    started = time.perf_counter()
+    llm.eval(tokens, batch_size=batch_size, threads=threads)
+    prompt_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(new_tokens):
+        token = llm.sample(seed=0)
+        llm.eval([token], batch_size=batch_size, threads=threads)
+    generation_seconds = time.perf_counter() - started
+    return len(tokens) / prompt_seconds, new_tokens / generation_seconds
+
+
+def tune(model_path, model_type="llama", prompt=None, threads=None,
+         batch_sizes=(8, 32, 128, 512), prompt_tokens=512, new_tokens=16):
+    from ctransformers import AutoModelForCausalLM
+
+    llm = AutoModelForCausalLM.from_pretrained(
+        model_path, model_type=model_type, gpu_layers=0, context_length=4096
+    )
+    tokens = llm.tokenize(prompt or default_prompt())[:prompt_tokens]
+    # Page the mapped weights in before anything is timed.
+    measure(llm, tokens[:32], 1, None, None)
+    best = None
+    for thread_count in threads or thread_candidates():
+        for batch_size in batch_sizes:
+            prompt_rate, generation_rate = measure(
+                llm, tokens, new_tokens, thread_count, batch_size
+            )
+            seconds = len(tokens) / prompt_rate + \
+                EXPECTED_NEW_TOKENS / generation_rate
+            print(f"threads={thread_count:3d} batch_size={batch_size:4d}  "
+                  f"prompt {prompt_rate:7.1f} tok/s  "
+                  f"generation {generation_rate:6.2f} tok/s  "
+                  f"field estimate {seconds:6.1f}s")
+            if best is None or seconds < best["field_seconds"]:
+                best = {
+                    "threads": thread_count,
+                    "batch_size": batch_size,
+                    "prompt_tokens_per_second": round(prompt_rate, 2),
+                    "tokens_per_second": round(generation_rate, 2),
+                    "field_seconds": round(seconds, 2),
+                }
+    best["tuned_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the fastest CTransformers threads and batch_size for this host"  # nopep8
+    )
+    parser.add_argument("model", help="path of the GGUF model file")
+    parser.add_argument("--model-type",
+                        help="CTransformers model type (default: from the file's header)")  # nopep8
+    parser.add_argument("--threads", type=int, nargs="+",
+                        help="thread counts to try (default: 1/4 to all cores)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[8, 32, 128, 512])
+    parser.add_argument("--prompt-tokens", type=int, default=512,
+                        help="evaluate at most this many prompt tokens")
+    parser.add_argument("--new-tokens", type=int, default=16,
+                        help="tokens to generate per measurement")
+    args = parser.parse_args()
+
+    model_type = args.model_type
+    if model_type is None:
+        import gguf_header
+        from chat_format import ChatFormat
+
+        header = gguf_header.read_local(args.model)
+        model_type = ChatFormat.from_header(header).model_type
+    result = tune(
+        args.model,
+        model_type=model_type,
+        threads=args.threads,
+        batch_sizes=args.batch_sizes,
+        prompt_tokens=args.prompt_tokens,
+        new_tokens=args.new_tokens,
+    )
+    save_tuning(args.model, result)
+    print(f"Best: {result['threads']} threads, batch size {result['batch_size']}; saved to {TUNING_FILE}")  # nopep8
+
+
+if __name__ == "__main__":
+    main()
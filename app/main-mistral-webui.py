@@ -1,16 +1,22 @@
 import os
-import sys
 
 import aichar
-import requests
-from tqdm import tqdm
-from diffusers import DiffusionPipeline
 import torch
-from langchain_community.llms import CTransformers
 import gradio as gr
 from PIL import Image
 import re
 
+from chat_format import model_type
+from llm_tuning import apply_tuning
+from model_server import MODEL_SERVER_SOCKET, RemoteDiffusionPipeline, RemoteLLM
+from model_store import OfflineModelMissing, ensure_model
+from prefix_cache import PrefixCachedLLM
+from request_scheduler import ScheduledLLM
+from resource_queue import POLL_SECONDS, QueueFull, llm_queue, sd_queue
+from response_cache import with_cache
+import telemetry
+from sd_loading import load_pipeline
+
 llm = None
 sd = None
 safety_checker_sd = None
@@ -20,76 +26,62 @@ model_url = "https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.1-GGUF/resol
 
 
 def load_models():
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-    llm_model_name = os.path.join(folder_path, os.path.basename(model_url))
-    if not os.path.exists(llm_model_name):
-        try:
-            print(f"Downloading LLM model from: {model_url}")
-            with requests.get(model_url, stream=True) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("content-length", 0))
-                block_size = 1024
-                progress_bar = tqdm(
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024
-                )
-                with open(llm_model_name, "wb") as out_file:
-                    for data in response.iter_content(chunk_size=block_size):
-                        out_file.write(data)
-                        progress_bar.update(len(data))
-                    progress_bar.close()
-                    print(f"Model downloaded and saved to: {llm_model_name}")
-        except Exception as e:
-            print(f"Error while downloading LLM model: {str(e)}")
+    try:
+        ensure_model(model_url, os.path.basename(model_url), folder_path)
+    except OfflineModelMissing as e:
+        raise SystemExit(f"Error: {e}")
+    except Exception as e:
+        print(f"Error while downloading LLM model: {str(e)}")
+    config = {
+        "max_new_tokens": 1024,
+        "repetition_penalty": 1.1,
+        "top_k": 40,
+        "top_p": 0.95,
+        "temperature": 0.8,
+        # The largest context; each one is sized to its prompts.
+        "context_length": 8192,
+        "stop": [
+            "/s",
+            "</s>",
+            "<s>",
+            "[INST]",
+            "[/INST]",
+            "<|im_end|>"
+        ],
+    }
     global sd
-    sd = DiffusionPipeline.from_pretrained(
-        "Lykon/dreamshaper-8",
-        torch_dtype=torch.float16,
-        variant="fp16",
-        low_cpu_mem_usage=False,
-    )
-    if torch.cuda.is_available():
-        sd.to("cuda")
-        print("Loading Stable Diffusion to GPU...")
-    elif torch.backends.mps.is_available():
-        sd.to("mps")
-        print("Loading Stable Diffusion to Metal...")
-    else:
-        if sys.platform == "darwin":
-            sd.to("cpu", torch.float32)
-        print("Loading Stable Diffusion to CPU...")
     global llm
+    if MODEL_SERVER_SOCKET:
+        print(f"Using models from model server: {MODEL_SERVER_SOCKET}")
+        sd = RemoteDiffusionPipeline(MODEL_SERVER_SOCKET, "Lykon/dreamshaper-8")
+        llm = RemoteLLM(
+            MODEL_SERVER_SOCKET,
+            "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+            model_type("models/mistral-7b-instruct-v0.1.Q4_K_M.gguf"),
+            config,
+        )
+        llm = with_cache(llm, "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf")
+        return
+    sd, _ = load_pipeline("Lykon/dreamshaper-8")
     gpu_layers = 0
     if torch.cuda.is_available() or torch.backends.mps.is_available():
         gpu_layers = 110
         print("Loading LLM to GPU...")
     else:
         print("Loading LLM to CPU...")
-    llm = CTransformers(
-        model="models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
-        model_type="llama",
-        gpu_layers=gpu_layers,
-        config={
-            "max_new_tokens": 1024,
-            "repetition_penalty": 1.1,
-            "top_k": 40,
-            "top_p": 0.95,
-            "temperature": 0.8,
-            "context_length": 8192,
+    # All sessions share one queue. On the GPU every request uses the same
+    # context slot; on the CPU a few generations take turns token by token,
+    # so a name does not wait for a whole example dialogue.
+    llm = ScheduledLLM(PrefixCachedLLM(
+        "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+        model_type("models/mistral-7b-instruct-v0.1.Q4_K_M.gguf"),
+        {
+            **apply_tuning(config, "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf", gpu_layers),  # nopep8
             "gpu_layers": gpu_layers,
-            "stop": [
-                "/s",
-                "</s>",
-                "<s>",
-                "[INST]",
-                "[/INST]",
-                "<|im_end|>"
-            ],
         },
-    )
+        slots=1 if gpu_layers else 3,
+    ))
+    llm = with_cache(llm, "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf")
 
 
 load_models()
@@ -105,14 +97,12 @@ Eldric</s>
 Tatsukaga Yamari</s>
     """  # nopep8
     gender = input_none(gender)
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + f"\n[INST] Generate a random character name. Topic: {topic}. "
-        + f"{'Gender: '+gender if gender else ''} [/INST]\n"
-    )
-    output = re.sub(r"[^a-zA-Z0-9_ -]", "", output)
-    print(output)
-    return output
+        + f"{'Gender: '+gender if gender else ''} [/INST]\n",
+        prefix_key="name",
+    ), clean=clean_name)
 
 
 def generate_character_summary(character_name, topic, gender):
@@ -132,7 +122,7 @@ Yamari's character is multifaceted. She can transition from being cheerful and o
 Yamari's extraordinary abilities, involve tapping into her inner strength when confronted with adversity. She can unleash awe-inspiring magical spells and summon incredible, larger-than-life transformations when the situation calls for it. Her unwavering determination and belief in the power of friendship are her greatest assets. </s>
     """  # nopep8
     gender = input_none(gender)
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n[INST] Create a description for a character named "
         + f"{character_name}. "
@@ -143,10 +133,9 @@ Yamari's extraordinary abilities, involve tapping into her inner strength when c
         + "Make this character unique "
         + f"and tailor them to the theme of {topic} "
         + "but don't specify what topic "
-        + "it is, and don't describe the topic itself [/INST]\n"
-    )
-    print(output)
-    return output
+        + "it is, and don't describe the topic itself [/INST]\n",
+        prefix_key="summary",
+    ))
 
 
 def generate_character_personality(character_name, character_summary, topic):
@@ -159,7 +148,7 @@ Yamari stands at a petite, delicate frame with a cascade of raven-black hair flo
 Yamari's wardrobe is a colorful and eclectic mix, mirroring her ever-changing moods and the whimsy of her adventures.\nWhat are their strengths and weaknesses? What values guide this character? Describe them in a way that allows the reader to better understand their character. Make this character unique and tailor them to the theme of anime but don't specify what topic it is, and don't describe the topic itself [/INST]
 Tatsukaga Yamari's personality is a vibrant tapestry of enthusiasm, curiosity, and whimsy. She approaches life with boundless energy and a spirit of adventure, always ready to embrace new experiences and challenges. Yamari is a compassionate and caring friend, offering solace and support to those in need, and her infectious laughter brightens the lives of those around her. Her unwavering loyalty and belief in the power of friendship define her character, making her a heartwarming presence in the story she inhabits. Underneath her playful exterior lies a wellspring of inner strength, as she harnesses incredible magical abilities to overcome adversity and protect her loved ones. </s>
     """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + f"\n[INST] Describe the personality of {character_name}. "
         + f"Their characteristic {character_summary}\n"
@@ -168,10 +157,9 @@ Tatsukaga Yamari's personality is a vibrant tapestry of enthusiasm, curiosity, a
         + "to better understand their character. Make this character "
         + f"unique and tailor them to the theme of {topic} but don't "
         + "specify what topic it is, and don't describe the "
-        + "topic itself [/INST]\n"
-    )
-    print(output)
-    return output
+        + "topic itself [/INST]\n",
+        prefix_key="personality",
+    ))
 
 
 def generate_character_scenario(
@@ -186,7 +174,7 @@ On a sunny morning in a sleek corporate office, {{user}} eagerly prepares to mee
 {{user}} resides in a mesmerizing and ever-changing fantasy realm, where magic and imagination are part of everyday life. In this enchanting world, Tatsukaga Yamari is a well-known figure. With her raven-black hair, amethyst eyes, and boundless energy, she's a constant presence in {{user}}'s life.
 The world is a vibrant, ever-shifting tapestry of colors, and {{user}} frequently joins Yamari on epic quests and adventures that unveil supernatural mysteries. They rely on Yamari's extraordinary magical abilities to guide them through the whimsical landscapes and forge new friendships along the way. In this extraordinary realm, the unwavering belief in the power of friendship is the key to unlocking hidden wonders and embarking on unforgettable journeys. </s>
 """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n[INST] Create a vivid and immersive scenario "
         + "in a specific setting "
@@ -197,10 +185,9 @@ The world is a vibrant, ever-shifting tapestry of colors, and {{user}} frequentl
         + f"the story. {{char}} characteristics: {character_summary}. "
         + f"{character_personality}. Make this character unique and tailor "
         + f"them to the theme of {topic} but don't specify what topic it is, "
-        + "and don't describe the topic itself [/INST]\n"
-    )
-    print(output)
-    return output
+        + "and don't describe the topic itself [/INST]\n",
+        prefix_key="scenario",
+    ))
 
 
 def generate_character_greeting_message(
@@ -218,7 +205,7 @@ Jamie's appearance is always polished and professional.\nJamie Hale's personalit
 <s>[INST] Create the first message that the character Eldric, whose personality is Eldric is a strikingly elegant elf who has honed his skills as an archer and possesses a deep connection to the mystical arts. Standing at a lithe and graceful 6 feet, his elven heritage is evident in his pointed ears, ethereal features, and eyes that shimmer with an otherworldly wisdom.\nEldric possesses a serene and contemplative nature, reflecting the wisdom of his elven heritage. He is deeply connected to the natural world, showing a profound respect for the environment and its creatures. Despite his formidable combat abilities, he prefers peaceful solutions and seeks to maintain harmony in his woodland domain.\ngreets the user we are addressing as {{user}}. Make this character unique and tailor them to the theme of fantasy but don't specify what topic it is, and don't describe the topic itself [/INST]
 *Eldric, the elegant elf, approaches you with a serene and contemplative air. His shimmering eyes, filled with ancient wisdom, meet yours as he offers a soft and respectful greeting* Greetings, {{user}}. It is an honor to welcome you to our enchanted woodland realm. I am Eldric, guardian of this forest, and I can sense that you bring a unique energy with you. How may I assist you in your journey through the wonders of the natural world or share the mysteries of our elven heritage with you today? </s>
     """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n[INST] Create the first message that the character "
         + f"{character_name}, whose personality is "
@@ -226,10 +213,9 @@ Jamie's appearance is always polished and professional.\nJamie Hale's personalit
         + f"greets the user we are addressing as {{user}}. "
         + "Make this character unique and tailor them to the theme "
         + f"of {topic} but don't specify what topic it is, "
-        + "and don't describe the topic itself [/INST]\n"
-    )
-    print(output)
-    return output
+        + "and don't describe the topic itself [/INST]\n",
+        prefix_key="greeting_message",
+    ))
 
 
 def generate_example_messages(
@@ -247,7 +233,7 @@ def generate_example_messages(
 {{user}}: *Nods with determination.* I have no doubt we can do it. With your magic and our unwavering friendship, there's nothing we can't accomplish.
 {{char}}: *{{char}} moves closer, her eyes shining with trust and camaraderie.* That's the spirit, {{user}}! Let's embark on this epic quest and make the Crystal Caves ours! </s>
 """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n[INST] Create a dialogue between {{user}} and {{char}}, "
         + "they should have an interesting and engaging conversation, "
@@ -257,10 +243,9 @@ def generate_example_messages(
         + f" {character_summary}. {character_personality}. Make this "
         + f"character unique and tailor them to the theme of {topic} but "
         + " don't specify what topic it is, and don't describe the "
-        + "topic itself [/INST]\n"
-    )
-    print(output)
-    return output
+        + "topic itself [/INST]\n",
+        prefix_key="example_messages",
+    ))
 
 def save_uploaded_image(image, character_name):
     if image is not None:
@@ -288,21 +273,30 @@ male, human, Confident and commanding presence, Polished and professional appear
 Yamari's wardrobe is a colorful and eclectic mix, mirroring her ever-changing moods and the whimsy of her adventures. She often sports a schoolgirl uniform, a cute kimono, or an array of anime-inspired outfits, each tailored to suit the theme of her current escapade. Accessories, such as oversized bows, cat-eared headbands, or a pair of mismatched socks, contribute to her quirky and endearing charm. Topic: anime [/INST]
 female, anime, Petite and delicate frame, Raven-black hair flowing down to her waist, Striking purple ribbon in her hair, Large and expressive amethyst-colored eyes, Colorful and eclectic outfit, oversized bows, cat-eared headbands, mismatched socks </s>
     """  # nopep8
-    sd_prompt = input_none(avatar_prompt) or llm.invoke(
-        example_dialogue
-        + "\n[INST] create a prompt that lists the appearance "
-        + "characteristics of a character whose summary is "
-        + f" {character_summary}. Topic: {topic} [/INST]\n"
-    )
+    sd_prompt = input_none(avatar_prompt)
+    if not sd_prompt:
+        try:
+            with llm_queue.slot(on_wait=lambda position: gr.Info(
+                f"Waiting for the LLM, position {position} in the queue"
+            )):
+                sd_prompt = llm.invoke(
+                    example_dialogue
+                    + "\n[INST] create a prompt that lists the appearance "
+                    + "characteristics of a character whose summary is "
+                    + f" {character_summary}. Topic: {topic} [/INST]\n",
+                    prefix_key="avatar_prompt",
+                )
+        except QueueFull as e:
+            raise gr.Error(str(e))
     print(sd_prompt)
-    sd_filter(nsfw_filter)
     return image_generate(character_name,
                           sd_prompt,
-                          input_none(negative_prompt)
+                          input_none(negative_prompt),
+                          nsfw_filter
                           )
 
 
-def image_generate(character_name, prompt, negative_prompt):
+def image_generate(character_name, prompt, negative_prompt, nsfw_filter):
     prompt = "absurdres, full hd, 8k, high quality, " + prompt
     default_negative_prompt = (
         "worst quality, normal quality, low quality, low res, blurry, "
@@ -321,7 +315,19 @@ def image_generate(character_name, prompt, negative_prompt):
     )
     negative_prompt = default_negative_prompt + (negative_prompt or "")
 
-    generated_image = sd(prompt, negative_prompt=negative_prompt).images[0]
+    try:
+        with sd_queue.slot(on_wait=lambda position: gr.Info(
+            f"Waiting for Stable Diffusion, position {position} in the queue"
+        )):
+            # The pipeline is shared by all sessions, so its safety checker
+            # is only switched while this request holds it.
+            sd_filter(nsfw_filter)
+            generated_image = telemetry.generate_image(
+                sd, prompt, "Lykon/dreamshaper-8",
+                negative_prompt=negative_prompt,
+            )
+    except QueueFull as e:
+        raise gr.Error(str(e))
 
     character_name = character_name.replace(" ", "_")
     os.makedirs(f"characters/{character_name}", exist_ok=True)
@@ -351,6 +357,31 @@ def input_none(text):
         return user_input
 
 
+def clean_name(text):
+    return re.sub(r"[^a-zA-Z0-9_ -]", "", text).strip()
+
+
+def stream_output(chunks, clean=str.strip):
+    # Show the text while it is generated. Gradio closes this generator when
+    # the Stop button is pressed or the page is closed, which stops the
+    # generation as well.
+    try:
+        ticket = llm_queue.join()
+    except QueueFull as e:
+        raise gr.Error(str(e))
+    try:
+        while not ticket.wait(POLL_SECONDS):
+            yield f"Waiting for the LLM, position {ticket.position()} in the queue..."  # nopep8
+        output = ""
+        for chunk in chunks:
+            output += chunk
+            yield clean(output)
+        yield clean(output)
+    finally:
+        ticket.release()
+    print(clean(output))
+
+
 """## Start WebUI"""
 
 
@@ -423,6 +454,14 @@ def export_character_card(
     return card_path
 
 
+
+def telemetry_status():
+    # The model server's queue is not visible from here.
+    queue_status = getattr(llm, "queue_status", None)
+    return ((queue_status() if queue_status else "") + llm_queue.status()
+            + sd_queue.status() + "\n" + telemetry.summary())
+
+
 with gr.Blocks() as webui:
     gr.Markdown("# Character Factory WebUI")
     gr.Markdown("## Model: Mistral 7b instruct 0.1")
@@ -441,19 +480,22 @@ with gr.Blocks() as webui:
             with gr.Row():
                 name = gr.Textbox(placeholder="character name", label="name")
                 name_button = gr.Button("Generate character name with LLM")
-                name_button.click(
+                name_event = name_button.click(
                     generate_character_name,
                     inputs=[topic, gender],
-                    outputs=name
+                    outputs=name,
+                    # Every session reaches the LLM queue, which orders them.
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 summary = gr.Textbox(placeholder="character summary",
                                      label="summary")
                 summary_button = gr.Button("Generate character summary with LLM")  # nopep8
-                summary_button.click(
+                summary_event = summary_button.click(
                     generate_character_summary,
                     inputs=[name, topic, gender],
                     outputs=summary,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 personality = gr.Textbox(
@@ -462,20 +504,22 @@ with gr.Blocks() as webui:
                 personality_button = gr.Button(
                     "Generate character personality with LLM"
                 )
-                personality_button.click(
+                personality_event = personality_button.click(
                     generate_character_personality,
                     inputs=[name, summary, topic],
                     outputs=personality,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 scenario = gr.Textbox(
                     placeholder="character scenario", label="scenario"
                 )
                 scenario_button = gr.Button("Generate character scenario with LLM")  # nopep8
-                scenario_button.click(
+                scenario_event = scenario_button.click(
                     generate_character_scenario,
                     inputs=[summary, personality, topic],
                     outputs=scenario,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 greeting_message = gr.Textbox(
@@ -485,10 +529,11 @@ with gr.Blocks() as webui:
                 greeting_message_button = gr.Button(
                     "Generate character greeting message with LLM"
                 )
-                greeting_message_button.click(
+                greeting_message_event = greeting_message_button.click(
                     generate_character_greeting_message,
                     inputs=[name, summary, personality, topic],
                     outputs=greeting_message,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 example_messages = gr.Textbox(
@@ -498,11 +543,24 @@ with gr.Blocks() as webui:
                 example_messages_button = gr.Button(
                     "Generate character example messages with LLM"
                 )
-                example_messages_button.click(
+                example_messages_event = example_messages_button.click(
                     generate_example_messages,
                     inputs=[name, summary, personality, topic],
                     outputs=example_messages,
+                    concurrency_limit=None,
                 )
+            stop_button = gr.Button("Stop generation")
+            stop_button.click(
+                None,
+                cancels=[
+                    name_event,
+                    summary_event,
+                    personality_event,
+                    scenario_event,
+                    greeting_message_event,
+                    example_messages_event,
+                ],
+            )
             gr.Markdown("## Generate a character avatar using Stable Diffusion or upload an image file (.png file format is recommended)")
             gr.Markdown("### (set character name first)")
             with gr.Row():
@@ -537,6 +595,8 @@ with gr.Blocks() as webui:
                             potential_nsfw_checkbox,
                         ],
                         outputs=image_input,
+                        # Renders wait in the Stable Diffusion queue instead.
+                        concurrency_limit=None,
                     )
     with gr.Tab("Import character"):
         with gr.Column():
@@ -609,6 +669,16 @@ with gr.Blocks() as webui:
                     ],
                     outputs=export_json_textbox,
                 )
+    with gr.Accordion("Telemetry", open=False):
+        gr.Markdown(
+            "Time spent per field and per image since the WebUI started."
+        )
+        telemetry_output = gr.Markdown()
+        telemetry_button = gr.Button("Refresh")
+        telemetry_button.click(
+            telemetry_status, inputs=None, outputs=telemetry_output
+        )
+    webui.load(telemetry_status, inputs=None, outputs=telemetry_output)
     gr.HTML("""<div style='text-align: center; font-size: 20px;'>
     <p>
       <a style="text-decoration: none; color: inherit;" href="https://github.com/Hukasx0/character-factory">Character Factory</a> 
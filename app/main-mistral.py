@@ -1,101 +1,140 @@
 import os
 import random
 import re
-import sys
+import time
 
 import aichar
-import requests
-from tqdm import tqdm
-import sdkit
-from sdkit.models import load_model
-from sdkit.generate import generate_images
-from sdkit.utils import log
-import torch
 import argparse
-from langchain_community.llms import CTransformers
 
 llm = None
+# Same default as openai_backend.DEFAULT_URL, without importing requests.
+DEFAULT_LLM_URL = os.environ.get("CHARACTER_FACTORY_LLM_URL", "http://localhost:8000/v1")  # nopep8
 
 
-def prepare_llm():
+def prepare_llm(args):
+    # Heavy imports are deferred to the stage that needs them, so --help
+    # and argument errors return immediately.
+    from chat_format import model_type
+    from model_store import OfflineModelMissing, ensure_model
+    from response_cache import with_cache
+
     global llm
     folder_path = "models"
     model_url = "https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.1-GGUF/resolve/main/mistral-7b-instruct-v0.1.Q4_K_M.gguf"  # nopep8
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-    llm_model_name = os.path.join(folder_path, os.path.basename(model_url))
-    if not os.path.exists(llm_model_name):
-        try:
-            print(f"Downloading LLM model from: {model_url}")
-            with requests.get(model_url, stream=True) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("content-length", 0))
-                block_size = 1024
-                progress_bar = tqdm(
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024
-                )
-                with open(llm_model_name, "wb") as out_file:
-                    for data in response.iter_content(chunk_size=block_size):
-                        out_file.write(data)
-                        progress_bar.update(len(data))
-                progress_bar.close()
-            print(f"Model downloaded and saved to: {llm_model_name}")
-        except Exception as e:
-            print(f"Error while downloading LLM model: {str(e)}")
-    sd_model_url = "https://civitai.com/api/download/models/128713"
-    sd_model_name = os.path.join(folder_path, "dreamshaper_8.safetensors")
-    if not os.path.exists(sd_model_name):
+    config = {
+        "max_new_tokens": 1024,
+        "repetition_penalty": 1.1,
+        "top_k": 40,
+        "top_p": 0.95,
+        "temperature": 0.8,
+        # The largest context; each one is sized to its prompts.
+        "context_length": 8192,
+        "stop": [
+            "/s",
+            "</s>",
+            "<s>",
+            "[INST]",
+            "[/INST]",
+            "<|im_end|>"
+        ],
+    }
+    if args.llm_backend == "openai":
+        from openai_backend import OpenAICompatibleLLM
+
+        if args.model_server or args.draft_model:
+            raise SystemExit("Error: --llm-backend openai can't be combined with --model-server or --draft-model")  # nopep8
+        # The server may run several generations side by side.
+        args.llm_workers = args.llm_workers or 2
         try:
-            print(f"Downloading Stable Diffusion model from: {sd_model_url}")
-            with requests.get(sd_model_url, stream=True) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("content-length", 0))
-                block_size = 1024
-                progress_bar = tqdm(
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024
-                )
-                with open(sd_model_name, "wb") as out_file:
-                    for data in response.iter_content(chunk_size=block_size):
-                        out_file.write(data)
-                        progress_bar.update(len(data))
-                progress_bar.close()
-            print(f"Model downloaded and saved to: {sd_model_name}")
-        except Exception as e:
-            print(f"Error while downloading Stable Diffusion model: {str(e)}")
+            llm = OpenAICompatibleLLM(
+                args.llm_url,
+                args.llm_api_model,
+                config,
+                max_connections=args.llm_workers,
+            )
+        except RuntimeError as e:
+            raise SystemExit(f"Error: {e}")
+        print(f"Using LLM {llm.model} from {args.llm_url}")
+        llm = with_cache(llm, f"{args.llm_url}#{llm.model}", args.llm_cache)
+        return
+    try:
+        ensure_model(model_url, os.path.basename(model_url), folder_path)
+    except OfflineModelMissing as e:
+        raise SystemExit(f"Error: {e}")
+    except Exception as e:
+        print(f"Error while downloading LLM model: {str(e)}")
+    if args.model_server:
+        from model_server import RemoteLLM
+
+        if args.draft_model:
+            raise SystemExit("Error: --draft-model runs the LLM in this process and can't be combined with --model-server")  # nopep8
+        print(f"Using LLM from model server: {args.model_server}")
+        llm = RemoteLLM(
+            args.model_server,
+            "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+            model_type("models/mistral-7b-instruct-v0.1.Q4_K_M.gguf"),
+            config,
+        )
+        llm = with_cache(llm, "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf", args.llm_cache)
+        args.llm_workers = args.llm_workers or 2
+        return
+
+    import torch
+
+    from llm_tuning import apply_tuning
+    from prefix_cache import PrefixCachedLLM
+
     gpu_layers = 0
     if torch.cuda.is_available() or torch.backends.mps.is_available():
         gpu_layers = 110
         print("Loading LLM to GPU...")
     else:
         print("Loading LLM to CPU...")
-    llm = CTransformers(
-        model="models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
-        model_type="mistral",
-        gpu_layers=gpu_layers,
-        config={
-            "max_new_tokens": 1024,
-            "repetition_penalty": 1.1,
-            "top_k": 40,
-            "top_p": 0.95,
-            "temperature": 0.8,
-            "context_length": 8192,
-            "gpu_layers": gpu_layers,
-            "stop": [
-                "/s",
-                "</s>",
-                "<s>",
-                "[INST]",
-                "[/INST]",
-                "<|im_end|>"
-            ],
-        },
-    )
+    if args.draft_model:
+        # The speculative LLM has a single context.
+        args.llm_workers = 1
+    if not args.llm_workers:
+        # Each worker uploads its own copy of the offloaded layers.
+        args.llm_workers = 1 if gpu_layers else 2
+    config = {
+        **apply_tuning(config, "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf", gpu_layers),  # nopep8
+        "gpu_layers": gpu_layers,
+    }
+    if not gpu_layers and args.llm_workers > 1:
+        # Concurrent fields share the cores instead of oversubscribing them.
+        config["threads"] = max(
+            1, config.get("threads", os.cpu_count() or 1) // args.llm_workers
+        )
+    if args.draft_model:
+        from speculative import SpeculativeLLM
+
+        draft_path = args.draft_model
+        if draft_path.startswith(("http://", "https://")):
+            draft_path = os.path.join(folder_path, os.path.basename(draft_path))  # nopep8
+            try:
+                ensure_model(args.draft_model, os.path.basename(draft_path), folder_path)  # nopep8
+            except OfflineModelMissing as e:
+                raise SystemExit(f"Error: {e}")
+        print(f"Speculative decoding with draft model {draft_path}")
+        try:
+            llm = SpeculativeLLM(
+                "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+                draft_path,
+                config,
+                draft_tokens=args.draft_tokens,
+            )
+        except RuntimeError as e:
+            raise SystemExit(f"Error: {e}")
+    else:
+        # One context per worker; every field has its own template, so
+        # further slots would hold contexts never reused within a character.
+        llm = PrefixCachedLLM(
+            "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf",
+            model_type("models/mistral-7b-instruct-v0.1.Q4_K_M.gguf"),
+            config,
+            slots=args.llm_workers,
+        )
+    llm = with_cache(llm, "models/mistral-7b-instruct-v0.1.Q4_K_M.gguf", args.llm_cache)
 
 
 def generate_character_name(topic, args):
@@ -110,7 +149,8 @@ Tatsukaga Yamari</s>
     output = llm.invoke(
         example_dialogue
         + f"\n[INST] Generate a random character name. Topic: {topic}. "
-        + f"{'Gender: '+args.gender if args.gender else ''} [/INST]\n"
+        + f"{'Gender: '+args.gender if args.gender else ''} [/INST]\n",
+        prefix_key="name",
     )
     output = re.sub(r"[^a-zA-Z0-9_ -]", "", output)
     print(output)
@@ -149,7 +189,8 @@ Yamari's extraordinary abilities, involve tapping into her inner strength when c
         + "Make this character unique "
         + f"and tailor them to the theme of {topic} "
         + "but don't specify what topic "
-        + "it is, and don't describe the topic itself [/INST]\n"
+        + "it is, and don't describe the topic itself [/INST]\n",
+        prefix_key="summary",
     )
     print(output + "\n")
     return output
@@ -180,7 +221,8 @@ Tatsukaga Yamari's personality is a vibrant tapestry of enthusiasm, curiosity, a
         + "to better understand their character. Make this character "
         + f"unique and tailor them to the theme of {topic} but don't "
         + "specify what topic it is, and don't describe the "
-        + "topic itself [/INST]\n"
+        + "topic itself [/INST]\n",
+        prefix_key="personality",
     )
     print(output + "\n")
     return output
@@ -210,7 +252,8 @@ The world is a vibrant, ever-shifting tapestry of colors, and {{user}} frequentl
         + f"the story. {{char}} characteristics: {character_summary}. "
         + f"{character_personality}. Make this character unique and tailor "
         + f"them to the theme of {topic} but don't specify what topic it is, "
-        + "and don't describe the topic itself [/INST]\n"
+        + "and don't describe the topic itself [/INST]\n",
+        prefix_key="scenario",
     )
     print(output + "\n")
     return output
@@ -240,7 +283,8 @@ and I can sense that you bring a unique energy with you. How may I assist you in
         + f"greets the user we are addressing as {{user}}. "
         + "Make this character unique and tailor them to the theme "
         + f"of {topic} but don't specify what topic it is, "
-        + "and don't describe the topic itself [/INST]\n"
+        + "and don't describe the topic itself [/INST]\n",
+        prefix_key="greeting_message",
     )
     print(output + "\n")
     return output
@@ -271,13 +315,14 @@ def generate_example_messages(
         + f" {character_summary}. {character_personality}. Make this "
         + f"character unique and tailor them to the theme of {topic} but "
         + " don't specify what topic it is, and don't describe the "
-        + "topic itself [/INST]\n"
+        + "topic itself [/INST]\n",
+        prefix_key="example_messages",
     )
     print(output + "\n")
     return output
 
 
-def generate_character_avatar(character_name, character_summary, args):
+def generate_avatar_prompt(character_summary, args):
     example_dialogue = """
 <s>[INST] create a prompt that lists the appearance characteristics of a character whose summary is Jamie Hale is a savvy and accomplished businessman who has carved a name for himself in the world of corporate success. With his sharp mind, impeccable sense of style, and unwavering determination, he has 
 risen to the top of the business world. Jamie stands at 6 feet tall with a confident and commanding presence. He exudes charisma and carries himself with an air of authority that draws people to him.
@@ -290,41 +335,42 @@ cat-eared headbands, or a pair of mismatched socks, contribute to her quirky and
 female, anime, Petite and delicate frame, Raven-black hair flowing down to her waist, Striking purple ribbon in her hair, Large and expressive amethyst-colored eyes, Colorful and eclectic outfit, oversized bows, cat-eared headbands, mismatched socks </s>
     """  # nopep8
     topic = args.topic if args.topic else ""
-    sd_prompt = (
-        args.avatar_prompt
-        if args.avatar_prompt
-        else llm.invoke(
-            example_dialogue
-            + "\n[INST] create a prompt that lists the appearance "
-            + "characteristics of a character whose summary is "
-            + f" {character_summary}. Topic: {topic} [/INST]\n"
-        )
+    sd_prompt = llm.invoke(
+        example_dialogue
+        + "\n[INST] create a prompt that lists the appearance "
+        + "characteristics of a character whose summary is "
+        + f" {character_summary}. Topic: {topic} [/INST]\n",
+        prefix_key="avatar_prompt",
     )
     print(sd_prompt)
+    return sd_prompt
+
+
+def generate_character_avatar(character_name, sd_prompt, args):
     image_generate(
         character_name,
         sd_prompt,
-        args.negative_prompt if args.negative_prompt else ""
+        args.negative_prompt if args.negative_prompt else "",
+        args.model_server,
     )
 
 
-def image_generate(character_name, prompt, negative_prompt):
-    context = sdkit.Context()
-    if torch.cuda.is_available():
-        context.device = "cuda"
-        print("Loading Stable Diffusion to GPU...")
-    elif torch.backends.mps.is_available():
-        context.device = "mps"
-        print("Loading Stable Diffusion to Metal...")
-    else:
-        context.device = "cpu"
-        if sys.platform == "darwin":
-            context.half_precision = False
-        print("Loading Stable Diffusion to CPU...")
-    context.model_paths[
-        "stable-diffusion"
-    ] = "models/dreamshaper_8.safetensors"  # nopep8
-    load_model(context, "stable-diffusion")
+def ensure_sd_model():
+    from model_store import OfflineModelMissing, ensure_model
+
+    sd_model_url = "https://civitai.com/api/download/models/128713"
+    try:
+        ensure_model(sd_model_url, "dreamshaper_8.safetensors", "models")
+    except OfflineModelMissing as e:
+        raise SystemExit(f"Error: {e}")
+    except Exception as e:
+        print(f"Error while downloading Stable Diffusion model: {str(e)}")
+
+
+def image_generate(character_name, prompt, negative_prompt, model_server=None):
+    import telemetry
+
+    ensure_sd_model()
     prompt = "absurdres, full hd, 8k, high quality, " + prompt
     default_negative_prompt = (
         "worst quality, normal quality, low quality, low res, blurry, "
@@ -342,70 +388,119 @@ def image_generate(character_name, prompt, negative_prompt):
         + "extra eyes, huge eyes, 2girl, amputation, disconnected limbs"
     )
     negative_prompt = default_negative_prompt + (negative_prompt or "")
+    seed = random.randint(0, 2**32 - 1)
+    character_name = character_name.replace(" ", "_")
+    if not os.path.exists(character_name):
+        os.mkdir(character_name)
+
+    if model_server:
+        from model_server import RemoteDiffusionPipeline
+
+        print(f"Using Stable Diffusion from model server: {model_server}")
+        sd = RemoteDiffusionPipeline(
+            model_server, "models/dreamshaper_8.safetensors"
+        )
+        image = telemetry.generate_image(
+            sd,
+            prompt,
+            "models/dreamshaper_8.safetensors",
+            negative_prompt=negative_prompt,
+            width=512,
+            height=512,
+            seed=seed,
+            num_inference_steps=25,
+        )
+        image.save(f"{character_name}/{character_name}.png")
+        print("Generated character avatar")
+        return
+
+    from sdkit.generate import generate_images
+    from sdkit.utils import log
+
+    from sd_contexts import get_context
+
+    context, load_seconds = get_context("models/dreamshaper_8.safetensors")
+    started = time.perf_counter()
     images = generate_images(
         context,
         prompt=prompt,
         negative_prompt=negative_prompt or "",
-        seed=random.randint(0, 2**32 - 1),
+        seed=seed,
         width=512,
         height=512,
     )
-    character_name = character_name.replace(" ", "_")
-    if not os.path.exists(character_name):
-        os.mkdir(character_name)
+    sample_seconds = time.perf_counter() - started
+    # sdkit samples 25 steps by default.
+    telemetry.record_image("models/dreamshaper_8.safetensors", 25,
+                           images[0].size, load_seconds, sample_seconds)
     images[0].save(f"{character_name}/{character_name}.png")
     log.info("Generated character avatar")
+    print(
+        f"Avatar timing: load {load_seconds:.2f}s"
+        f"{' (cached)' if load_seconds == 0 else ''}, "
+        f"sampling {sample_seconds:.2f}s"
+    )
 
 
 def create_character(args):
+    """Return the character and the avatar prompt (None with --no-avatar).
+
+    Fields that only depend on fields already generated run concurrently
+    on --llm-workers workers.
+    """
+    from field_scheduler import run_fields
+
     topic = (
         args.topic
         if args.topic
         else "any theme"
     )
-    name = (
-        args.name
-        if args.name
-        else generate_character_name(topic, args).strip()
-    )
-    summary = (
-        args.summary
-        if args.summary
-        else generate_character_summary(name, topic, args)
-    )
-
-    personality = (
-        args.personality
-        if args.personality
-        else generate_character_personality(name, summary, topic)
-    )
-    scenario = (
-        args.scenario
-        if args.scenario
-        else generate_character_scenario(summary, personality, topic)
-    )
-    greeting_message = (
-        args.greeting_message
-        if args.greeting_message
-        else generate_character_greeting_message(name,
-                                                 summary,
-                                                 personality,
-                                                 topic)
-    )
-    example_messages = (
-        args.example_messages
-        if args.example_messages
-        else generate_example_messages(name, summary, personality, topic)
-    )
-    return aichar.create_character(
-        name=name,
-        summary=summary,
-        personality=personality,
-        scenario=scenario,
-        greeting_message=greeting_message,
-        example_messages=example_messages,
+    generators = {
+        "name": lambda f: generate_character_name(topic, args).strip(),
+        "summary": lambda f: generate_character_summary(
+            f["name"], topic, args
+        ),
+        "personality": lambda f: generate_character_personality(
+            f["name"], f["summary"], topic
+        ),
+        "scenario": lambda f: generate_character_scenario(
+            f["summary"], f["personality"], topic
+        ),
+        "greeting_message": lambda f: generate_character_greeting_message(
+            f["name"], f["summary"], f["personality"], topic
+        ),
+        "example_messages": lambda f: generate_example_messages(
+            f["name"], f["summary"], f["personality"], topic
+        ),
+    }
+    if not args.no_avatar:
+        generators["avatar_prompt"] = lambda f: generate_avatar_prompt(
+            f["summary"], args
+        )
+    given = {
+        "name": args.name,
+        "summary": args.summary,
+        "personality": args.personality,
+        "scenario": args.scenario,
+        "greeting_message": args.greeting_message,
+        "example_messages": args.example_messages,
+        "avatar_prompt": args.avatar_prompt,
+    }
+    fields = run_fields(
+        generators,
+        given={field: value for field, value in given.items() if value},
+        workers=args.llm_workers,
+    )
+    character = aichar.create_character(
+        name=fields["name"],
+        summary=fields["summary"],
+        personality=fields["personality"],
+        scenario=fields["scenario"],
+        greeting_message=fields["greeting_message"],
+        example_messages=fields["example_messages"],
         image_path="",
     )
+    return character, fields.get("avatar_prompt")
 
 
 def parse_args():
@@ -462,22 +557,89 @@ def parse_args():
         type=str,
         help="Negative prompt for Stable Diffusion",  # nopep8
     )
+    parser.add_argument(
+        "--model-server",
+        type=str,
+        default=os.environ.get("CHARACTER_FACTORY_MODEL_SERVER"),
+        help="Unix socket of a running app/model_server.py; use its loaded models instead of loading them here",  # nopep8
+    )
+    parser.add_argument(
+        "--llm-backend",
+        choices=["local", "openai"],
+        default="local",
+        help="Run the LLM in this process (local, the default) or use an OpenAI-compatible completions server (openai)",  # nopep8
+    )
+    parser.add_argument(
+        "--llm-url",
+        type=str,
+        default=DEFAULT_LLM_URL,
+        help=f"Base URL of the OpenAI-compatible server for --llm-backend openai (default: {DEFAULT_LLM_URL})",  # nopep8
+    )
+    parser.add_argument(
+        "--llm-api-model",
+        type=str,
+        default="",
+        help="Model name to request from the server (default: the first one it lists)",  # nopep8
+    )
+    parser.add_argument(
+        "--llm-workers",
+        type=int,
+        help="Number of fields generated at the same time (default: 2 on CPU and with --model-server, 1 on GPU)",  # nopep8
+    )
+    parser.add_argument(
+        "--draft-model",
+        type=str,
+        help="Path or URL of a small GGUF model for speculative decoding (needs llama-cpp-python)",  # nopep8
+    )
+    parser.add_argument(
+        "--draft-tokens",
+        type=int,
+        default=8,
+        help="Tokens the draft model proposes at a time (default: 8)",
+    )
+    parser.add_argument(
+        "--llm-cache",
+        nargs="?",
+        const="1",
+        default=os.environ.get("CHARACTER_FACTORY_LLM_CACHE"),
+        metavar="PATH",
+        help="Answer repeated LLM requests from an on-disk cache (default file: models/llm_cache.sqlite)",  # nopep8
+    )
+    parser.add_argument(
+        "--no-avatar",
+        action="store_true",
+        help="Only generate the text fields; skip Stable Diffusion and the character card",  # nopep8
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        default=os.environ.get("CHARACTER_FACTORY_OFFLINE", "") not in ("", "0"),  # nopep8
+        help="Use only models that are already downloaded and never access the network",  # nopep8
+    )
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
-    prepare_llm()
-    character = create_character(args)
+    if args.offline:
+        from model_store import enable_offline
+
+        enable_offline()
+    prepare_llm(args)
+    if args.offline and not args.no_avatar:
+        # Stop now rather than after all text fields are generated.
+        ensure_sd_model()
+    character, sd_prompt = create_character(args)
     character_name = character.name.replace(" ", "_")
     if not os.path.exists(character_name):
         os.mkdir(character_name)
     character_path = f"{character_name}/{character_name}"
     character.export_neutral_json_file(character_path + ".json")
     character.export_neutral_yaml_file(character_path + ".yml")
-    generate_character_avatar(character.name, character.summary, args)
-    character.image_path = f"{character_name}/{character_name}.png"
-    character.export_neutral_card_file(character_path + ".card.png")
+    if not args.no_avatar:
+        generate_character_avatar(character.name, sd_prompt, args)
+        character.image_path = f"{character_name}/{character_name}.png"
+        character.export_neutral_card_file(character_path + ".card.png")
     print(character.data_summary)
 
 
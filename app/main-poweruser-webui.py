@@ -1,22 +1,43 @@
 import os
-import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
 
 import aichar
-import requests
-from tqdm import tqdm
-from diffusers import DiffusionPipeline
 import torch
-from langchain_community.llms import CTransformers
 import gradio as gr
 from PIL import Image
 import re
 
-llm = None
-sd = None
-safety_checker_sd = None
+from chat_format import ChatFormat, with_chat_format
+from field_memo import FieldMemo, field_key
+from llm_tuning import apply_tuning
+import memory_planner
+from model_registry import ModelRegistry, default_budget_bytes, pipeline_size_bytes  # nopep8
+from model_server import MODEL_SERVER_SOCKET, RemoteDiffusionPipeline, RemoteLLM
+from model_store import ensure_model
+from openai_backend import DEFAULT_URL as DEFAULT_LLM_URL, OpenAICompatibleLLM
+from prefix_cache import PrefixCachedLLM, default_slots
+from request_scheduler import ScheduledLLM
+from resource_queue import POLL_SECONDS, QueueFull, llm_queue, sd_queue
+from response_cache import CACHE_SETTING, cache_path, open_cache, with_cache
+from speculative import DRAFT_TOKENS, SpeculativeLLM
+import telemetry
+from sd_loading import format_rss, load_pipeline, peak_rss_bytes
+
+# Every loaded LLM and Stable Diffusion pipeline, keyed by "llm:<url>" and
+# "sd:<model id>". The least recently used one is evicted when the RAM
+# budget from the Configuration tab is exceeded.
+registry = ModelRegistry()
+
+# Which inputs every generated field came from, for "Regenerate stale
+# fields". Shared by all sessions; outputs are looked up by their text.
+memo = FieldMemo()
 
 DEFAULT_LLM_MODEL_URL = "https://huggingface.co/TheBloke/Mistral-7B-Instruct-v0.1-GGUF/resolve/main/mistral-7b-instruct-v0.1.Q4_K_M.gguf"
 DEFAULT_SD_MODEL_ID = "Lykon/dreamshaper-8"
+LLM_BUTTON_COUNT = 7
 
 NAME_PROMPT = """
 <|system|>
@@ -149,135 +170,339 @@ cat-eared headbands, or a pair of mismatched socks, contribute to her quirky and
 """
 
 
-def load_models(llm_model_url, sd_model_id, progress=gr.Progress()):
-    folder_path = "models"
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-    llm_model_name = os.path.join(folder_path, os.path.basename(llm_model_url))
-    if not os.path.exists(llm_model_name):
-        gr.Info(f"LLM model not found, starting download from {llm_model_url}")
-        try:
-            with requests.get(llm_model_url, stream=True) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("content-length", 0))
-                block_size = 1024
-                
-                progress_bar = tqdm(
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024,
-                    desc=f"Downloading {os.path.basename(llm_model_url)}"
-                )
-                
-                downloaded = 0
-                with open(llm_model_name, "wb") as out_file:
-                    for data in response.iter_content(chunk_size=block_size):
-                        out_file.write(data)
-                        progress_bar.update(len(data))
-                        if total_size > 0:
-                            downloaded += len(data)
-                            progress(downloaded / total_size, f"Downloading LLM model... {downloaded // 1024 // 1024}MB / {total_size // 1024 // 1024}MB")
-
-                    progress_bar.close()
-        except Exception as e:
-            print(f"Error while downloading LLM model: {str(e)}")
-            raise gr.Error(f"Error while downloading LLM model: {str(e)}")
-
-    gr.Info("LLM model file is ready.")
-
-    global sd
-    gr.Info(f"Loading Stable Diffusion model: {sd_model_id}...")
-    try:
-        for _ in tqdm(range(1), desc=f"Loading Stable Diffusion model: {sd_model_id}"):
-            sd = DiffusionPipeline.from_pretrained(
-                sd_model_id,
-                torch_dtype=torch.float16,
-                variant="fp16",
-                low_cpu_mem_usage=False,
-            )
-    except Exception as e:
-        print(f"Error loading Stable Diffusion model: {e}")
-        raise gr.Error(f"Error loading Stable Diffusion model: {e}")
+def llm_model_key(llm_model_url, draft_model_url, backend="local", llm_url="",
+                  llm_api_model=""):
+    if backend == "openai":
+        return f"{llm_url} ({llm_api_model or 'default model'})"
+    # With a draft model the same LLM is a separate entry in the dropdown.
+    if draft_model_url:
+        return f"{llm_model_url} + draft {draft_model_url}"
+    return llm_model_url
+
 
-    device = "cpu"
+def plan_llm_memory(llm_model_url, context_length, mode, header=None):
+    gpu_layers = 0
+    available = min(memory_planner.available_memory_bytes(),
+                    registry.budget_bytes)
     if torch.cuda.is_available():
-        device = "cuda"
+        # The offloaded layers and their contexts live in VRAM.
+        gpu_layers = 110
+        available = torch.cuda.mem_get_info()[0]
     elif torch.backends.mps.is_available():
-        device = "mps"
-
-    gr.Info(f"Moving Stable Diffusion to {device}...")
-    for _ in tqdm(range(1), desc=f"Moving Stable Diffusion to {device}"):
-        if torch.cuda.is_available():
-            sd.to("cuda")
-            print("Loading Stable Diffusion to GPU...")
-        elif torch.backends.mps.is_available():
-            sd.to("mps")
-            print("Loading Stable Diffusion to Metal...")
-        else:
-            if sys.platform == "darwin":
-                sd.to("cpu", torch.float32)
-            print("Loading Stable Diffusion to CPU...")
-
-    global llm
-    gpu_layers = 0
-    llm_device = "CPU"
-    if torch.cuda.is_available() or torch.backends.mps.is_available():
         gpu_layers = 110
-        llm_device = "GPU"
-    
-    gr.Info(f"Loading LLM model to {llm_device}...")
-    try:
-        for _ in tqdm(range(1), desc=f"Loading LLM model to {llm_device}"):
-            llm = CTransformers(
-                model=llm_model_name,
-                model_type="llama",
-                gpu_layers=gpu_layers,
-                config={
-                    "max_new_tokens": 1024,
-                    "repetition_penalty": 1.1,
-                    "top_k": 40,
-                    "top_p": 0.95,
-                    "temperature": 0.8,
-                    "context_length": 8192,
-                    "gpu_layers": gpu_layers,
-                    "stop": [
-                        "/s",
-                        "</s>",
-                        "<s>",
-                        "<|system|>",
-                        "<|assistant|>",
-                        "<|user|>",
-                        "<|char|>",
-                    ],
-                },
+    return memory_planner.plan(llm_model_url, context_length,
+                               default_slots(gpu_layers), available, mode,
+                               header)
+
+
+def load_llm(llm_model_url, status, draft_model_url="", draft_tokens=8,
+             backend="local", llm_url="", llm_api_model="",
+             memory_plan=memory_planner.MODE):
+    model_id = "llm:" + llm_model_key(llm_model_url, draft_model_url,
+                                      backend, llm_url, llm_api_model)
+    # The largest context; each one is sized to its prompts.
+    context_length = 8192
+    note = ""
+    chat_format = None
+    if backend == "local" and not registry.is_resident(model_id):
+        # Find out from the file's header which model it is and whether it
+        # fits before spending minutes on downloading and loading it.
+        status["llm"] = f"Reading the header of {os.path.basename(llm_model_url)}..."  # nopep8
+        header = None
+        try:
+            header = memory_planner.read_header(llm_model_url)
+        except (OSError, ValueError) as e:
+            print(f"Could not read the header of {llm_model_url}: {e}")
+        if header is not None:
+            # Fails here for an architecture CTransformers can't run.
+            chat_format = ChatFormat.from_header(header)
+        status["llm"] = f"Checking whether {os.path.basename(llm_model_url)} fits into memory..."  # nopep8
+        planned = plan_llm_memory(llm_model_url, context_length, memory_plan,
+                                  header)
+        note = planned["note"]
+        if note:
+            print(f"Memory plan: {note}")
+        context_length = planned["context_length"]
+        if planned["url"] != llm_model_url:
+            llm_model_url = planned["url"]
+            model_id = "llm:" + llm_model_key(llm_model_url, draft_model_url)
+
+    def report_download(fraction, description):
+        status["llm"] = description
+
+    # Without a header the model is assumed to be a Llama with Zephyr's
+    # prompt format, as the prompts are written.
+    model_type = chat_format.model_type if chat_format else "llama"
+
+    def loader():
+        config = {
+            "max_new_tokens": 1024,
+            "repetition_penalty": 1.1,
+            "top_k": 40,
+            "top_p": 0.95,
+            "temperature": 0.8,
+            "context_length": context_length,
+            "stop": [
+                "/s",
+                "</s>",
+                "<s>",
+                "<|system|>",
+                "<|assistant|>",
+                "<|user|>",
+                "<|char|>",
+            ],
+        }
+        if chat_format is not None:
+            # The model's end-of-turn tokens, so generation ends with the
+            # answer instead of running to max_new_tokens.
+            config["stop"] = chat_format.stop(config["stop"])
+        if backend == "openai":
+            status["llm"] = f"Connecting to {llm_url}..."
+            llm = OpenAICompatibleLLM(llm_url, llm_api_model, config)
+            # The model runs on another machine.
+            return with_cache(llm, f"{llm_url}#{llm.model}"), 0
+
+        status["llm"] = f"Checking LLM model from {llm_model_url}..."
+        llm_model_name = ensure_model(
+            llm_model_url, os.path.basename(llm_model_url), progress=report_download
+        )
+        if MODEL_SERVER_SOCKET:
+            if draft_model_url:
+                raise RuntimeError("speculative decoding runs the LLM in this process and can't be used with the model server")  # nopep8
+            # The weights live in the model server, not in this process.
+            llm = RemoteLLM(MODEL_SERVER_SOCKET, llm_model_name, model_type, config)  # nopep8
+            return with_cache(with_chat_format(llm, chat_format), llm_model_name), 0  # nopep8
+
+        gpu_layers = 0
+        llm_device = "CPU"
+        if torch.cuda.is_available() or torch.backends.mps.is_available():
+            gpu_layers = 110
+            llm_device = "GPU"
+
+        config = {
+            **apply_tuning(config, llm_model_name, gpu_layers),
+            "gpu_layers": gpu_layers,
+        }
+        if draft_model_url:
+            status["llm"] = f"Checking draft model from {draft_model_url}..."  # nopep8
+            draft_model_name = ensure_model(
+                draft_model_url, os.path.basename(draft_model_url),
+                progress=report_download
             )
-    except Exception as e:
-        print(f"Error loading LLM model: {e}")
-        raise gr.Error(f"Error loading LLM model: {e}")
-    global safety_checker_sd
-    safety_checker_sd = sd.safety_checker
-    gr.Info("Models loaded successfully!")
-    return gr.update(interactive=True)
+            status["llm"] = f"Loading LLM and draft model to {llm_device}..."  # nopep8
+            # One generation at a time; the queue runs short fields first.
+            llm = ScheduledLLM(SpeculativeLLM(
+                llm_model_name, draft_model_name, config,
+                draft_tokens=int(draft_tokens),
+            ))
+            size = os.path.getsize(llm_model_name) \
+                + os.path.getsize(draft_model_name)
+            return with_cache(with_chat_format(llm, chat_format), llm_model_name), size  # nopep8
+
+        status["llm"] = f"Loading LLM model to {llm_device}..."
+        print(f"Loading LLM model to {llm_device}...")
+        # One context per prompt template, so the few-shot examples are
+        # evaluated once instead of on every request. Requests from all
+        # sessions share one queue and take turns token by token.
+        llm = ScheduledLLM(PrefixCachedLLM(llm_model_name, model_type, config))
+        # Prompts are rewritten in front of the queue; the rewritten few-shot
+        # examples are the same every time, so the prefix cache still works.
+        llm = with_chat_format(llm, chat_format)
+        # The GGUF file is mapped into memory as a whole.
+        return with_cache(llm, llm_model_name), os.path.getsize(llm_model_name)  # nopep8
+
+    if registry.is_resident(model_id):
+        status["llm"] = "Already loaded"
+        registry.get(model_id)
+        return model_id[len("llm:"):]
+    registry.register(model_id, loader)
+    try:
+        registry.get(model_id)
+    except Exception:
+        registry.unregister(model_id)
+        raise
+    if backend == "openai":
+        status["llm"] = f"Ready on {llm_url}"
+    elif MODEL_SERVER_SOCKET:
+        status["llm"] = f"Ready on model server {MODEL_SERVER_SOCKET}"
+    else:
+        status["llm"] = f"Ready ({note})" if note else "Ready"
+    # The memory plan may have picked another file.
+    return model_id[len("llm:"):]
+
+
+def load_sd(sd_model_id, status):
+    model_id = "sd:" + sd_model_id
+
+    def loader():
+        if MODEL_SERVER_SOCKET:
+            pipeline = RemoteDiffusionPipeline(MODEL_SERVER_SOCKET, sd_model_id)
+            pipeline.default_safety_checker = pipeline.safety_checker
+            return pipeline, 0
+        status["sd"] = f"Loading Stable Diffusion model: {sd_model_id}..."
+        pipeline, device = load_pipeline(sd_model_id)
+        status["sd"] = f"Ready on {device}, peak RSS {format_rss(peak_rss_bytes())}"  # nopep8
+        pipeline.default_safety_checker = pipeline.safety_checker
+        return pipeline, pipeline_size_bytes(pipeline)
+
+    if registry.is_resident(model_id):
+        status["sd"] = "Already loaded"
+        registry.get(model_id)
+        return
+    registry.register(model_id, loader)
+    try:
+        registry.get(model_id)
+    except Exception:
+        registry.unregister(model_id)
+        raise
+    if MODEL_SERVER_SOCKET:
+        status["sd"] = f"Ready on model server {MODEL_SERVER_SOCKET}"
+
+
+# A request holds its model until it ends. Loading another model meanwhile
+# only changes what the next requests get; an evicted model finishes the
+# requests still using it before it is released.
+@contextmanager
+def use_llm(llm_model_id):
+    if not llm_model_id:
+        raise gr.Error("Load an LLM in the Configuration tab first.")
+    with registry.lease("llm:" + llm_model_id) as llm:
+        yield llm
+
+
+@contextmanager
+def use_sd(sd_model_id):
+    if not sd_model_id:
+        raise gr.Error("Load a Stable Diffusion model in the Configuration tab first.")  # nopep8
+    with registry.lease("sd:" + sd_model_id) as sd:
+        yield sd
+
+
+def invalidate_prefix(prefix_key):
+    # Called when a template changes in the Prompt Editor.
+    for llm in registry.resident_models("llm:"):
+        llm.invalidate(prefix_key)
+
+
+def model_choices(kind):
+    return [model_id[len(kind) + 1:] for model_id in registry.ids(kind + ":")]
+
+
+def queue_status():
+    return "".join(llm.queue_status()
+                   for llm in registry.resident_models("llm:")
+                   if hasattr(llm, "queue_status"))
+
+
+def telemetry_status():
+    return (queue_status() + llm_queue.status() + sd_queue.status() + "\n"
+            + telemetry.summary())
+
+
+def response_cache_status():
+    path = cache_path(CACHE_SETTING)
+    if path is None:
+        return ""
+    stats = open_cache(path).stats()
+    return (
+        f"**Response cache:** {stats['hits']} hits, {stats['misses']} misses "
+        f"this session; {stats['entries']} responses "
+        f"({stats['bytes'] / 1024 ** 2:.1f} MB) in {path}  \n"
+    )
+
+
+def draining_status():
+    draining = registry.draining_ids()
+    if not draining:
+        return ""
+    return (
+        f"**Finishing running requests before release:** {', '.join(draining)} "  # nopep8
+        f"({registry.draining_bytes() / 1024 ** 3:.1f} GiB on top of the budget)  \n"  # nopep8
+    )
 
 
-def generate_character_name(topic, gender, prompt):
+def model_status(status, started):
+    elapsed = time.monotonic() - started
+    return (
+        f"**LLM:** {status['llm']}  \n"
+        f"**Stable Diffusion:** {status['sd']}  \n"
+        f"**Resident:** {', '.join(registry.resident_ids()) or 'none'} "
+        f"({registry.used_bytes() / 1024 ** 3:.1f} of "
+        f"{registry.budget_bytes / 1024 ** 3:.1f} GiB)  \n"
+        + draining_status()
+        + response_cache_status()
+        + f"Elapsed: {elapsed:.0f}s"
+    )
+
+
+def load_models(llm_model_url, sd_model_id, ram_budget_gb, draft_model_url,
+                draft_tokens, backend, llm_url, llm_api_model, memory_plan):
+    # Both models load at the same time: the LLM is mostly disk and CPU
+    # bound, Stable Diffusion mostly network and device bound. Every update
+    # re-enables the buttons whose model is ready, so the text buttons can
+    # be used while Stable Diffusion is still loading and vice versa.
+    # Models loaded earlier stay selectable in the Edit tab.
+    registry.set_budget(int(ram_budget_gb * 1024 ** 3))
+    status = {"llm": "Waiting...", "sd": "Waiting..."}
+    labels = {"llm": "LLM model", "sd": "Stable Diffusion model"}
+    started = time.monotonic()
+    errors = []
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {
+            executor.submit(load_llm, llm_model_url, status,
+                            draft_model_url.strip(), draft_tokens, backend,
+                            llm_url.strip(), llm_api_model.strip(),
+                            memory_plan): "llm",
+            executor.submit(load_sd, sd_model_id, status): "sd",
+        }
+        ready = {"llm": False, "sd": False}
+        llm_key = None
+        pending = set(futures)
+        while True:
+            done, pending = wait(pending, timeout=0.5)
+            for future in done:
+                which = futures[future]
+                error = future.exception()
+                if error is None:
+                    ready[which] = True
+                    if which == "llm":
+                        llm_key = future.result()
+                    gr.Info(f"{labels[which]} loaded successfully!")
+                else:
+                    print(f"Error loading {labels[which]}: {error}")
+                    status[which] = f"Error: {error}"
+                    errors.append(f"Error loading {labels[which]}: {error}")
+            llm_choices = model_choices("llm")
+            sd_choices = model_choices("sd")
+            yield [model_status(status, started)] + [
+                gr.update(interactive=bool(llm_choices))
+                for _ in range(LLM_BUTTON_COUNT)
+            ] + [gr.update(interactive=bool(sd_choices))] + [
+                gr.update(choices=llm_choices, value=llm_key)
+                if ready["llm"] else gr.update(choices=llm_choices),
+                gr.update(choices=sd_choices, value=sd_model_id)
+                if ready["sd"] else gr.update(choices=sd_choices),
+            ]
+            if not pending:
+                break
+    if errors:
+        raise gr.Error("\n".join(errors))
+
+
+def name_prompt(topic, gender, prompt):
     gender = input_none(gender)
-    output = llm.invoke(
+    return (
         prompt
         + "\n<|user|> Generate a random character name. "
         + f"Topic: {topic}. "
         + f"{'Character gender: '+gender+'.' if gender else ''} "
         + "</s>\n<|assistant|> "
     )
-    output = re.sub(r"[^a-zA-Z0-9_ -]", "", output).strip()
-    print(output)
-    return output
 
 
-def generate_character_summary(character_name, topic, gender, prompt):
+def summary_prompt(character_name, topic, gender, prompt):
     gender = input_none(gender)
-    output = llm.invoke(
+    return (
         prompt
         + "\n<|user|> Create a longer description for a character named "
         + f"{character_name}. "
@@ -289,18 +514,11 @@ def generate_character_summary(character_name, topic, gender, prompt):
         + "include character traits, physical and character. You can't add "
         + "anything else. You must not write any summaries, conclusions or "
         + "endings. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+    )
 
 
-def generate_character_personality(
-    character_name,
-    character_summary,
-    topic,
-    prompt
-):
-    output = llm.invoke(
+def personality_prompt(character_name, character_summary, topic, prompt):
+    return (
         prompt
         + f"\n<|user|> Describe the personality of {character_name}. "
         + f"Their characteristic {character_summary}\nDescribe them "
@@ -310,18 +528,11 @@ def generate_character_personality(
         + "and don't describe the topic itself. You are to write out "
         + "character traits separated by commas, you must not write "
         + "any summaries, conclusions or endings. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+    )
 
 
-def generate_character_scenario(
-    character_summary,
-    character_personality,
-    topic,
-    prompt
-):
-    output = llm.invoke(
+def scenario_prompt(character_summary, character_personality, topic, prompt):
+    return (
         prompt
         + f"\n<|user|> Write a scenario for chat roleplay "
         + "to serve as a simple storyline to start chat "
@@ -334,14 +545,12 @@ def generate_character_scenario(
         + "Your response must end when {{user}} and {{char}} interact. "
         + "</s>\n<|assistant|> "
     )
-    print(output)
-    return output
 
 
-def generate_character_greeting_message(
+def greeting_message_prompt(
     character_name, character_summary, character_personality, topic, prompt
 ):
-    output = llm.invoke(
+    return (
         prompt
         + "\n<|user|> Create the first message that the character "
         + f"{character_name}, whose personality is "
@@ -354,15 +563,13 @@ def generate_character_greeting_message(
         + "childish then speak in a childish way, if the character "
         + "is serious, philosophical then speak in a serious and "
         + "philosophical way, and so on. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+    )
 
 
-def generate_example_messages(
+def example_messages_prompt(
     character_name, character_summary, character_personality, topic, prompt
 ):
-    output = llm.invoke(
+    return (
         prompt
         + f"\n<|user|> Create a dialogue between {{user}} and {{char}}, "
         + "they should have an interesting and engaging conversation, "
@@ -376,9 +583,148 @@ def generate_example_messages(
         + "if the character is childish then speak in a childish way, if the "
         + "character is serious, philosophical then speak in a serious and "
         + "philosophical way and so on. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+    )
+
+
+def generate_field(field, prompt, llm_model_id):
+    # Streams the field and remembers which inputs it was generated from,
+    # unless the generation is stopped.
+    with use_llm(llm_model_id) as llm:
+        key = field_key(prompt, llm_model_id, getattr(llm, "config", None))
+        clean = clean_name if field == "name" else str.strip
+        output = ""
+        for output in stream_output(llm.stream(prompt, prefix_key=field),
+                                    clean=clean):
+            yield output
+    memo.record(key, output)
+
+
+def generate_character_name(topic, gender, prompt, llm_model_id):
+    yield from generate_field(
+        "name", name_prompt(topic, gender, prompt), llm_model_id
+    )
+
+
+def generate_character_summary(character_name, topic, gender, prompt,
+                               llm_model_id):
+    yield from generate_field(
+        "summary",
+        summary_prompt(character_name, topic, gender, prompt),
+        llm_model_id,
+    )
+
+
+def generate_character_personality(
+    character_name,
+    character_summary,
+    topic,
+    prompt,
+    llm_model_id
+):
+    yield from generate_field(
+        "personality",
+        personality_prompt(character_name, character_summary, topic, prompt),
+        llm_model_id,
+    )
+
+
+def generate_character_scenario(
+    character_summary,
+    character_personality,
+    topic,
+    prompt,
+    llm_model_id
+):
+    yield from generate_field(
+        "scenario",
+        scenario_prompt(
+            character_summary, character_personality, topic, prompt
+        ),
+        llm_model_id,
+    )
+
+
+def generate_character_greeting_message(
+    character_name, character_summary, character_personality, topic, prompt,
+    llm_model_id
+):
+    yield from generate_field(
+        "greeting_message",
+        greeting_message_prompt(
+            character_name, character_summary, character_personality, topic,
+            prompt
+        ),
+        llm_model_id,
+    )
+
+
+def generate_example_messages(
+    character_name, character_summary, character_personality, topic, prompt,
+    llm_model_id
+):
+    yield from generate_field(
+        "example_messages",
+        example_messages_prompt(
+            character_name, character_summary, character_personality, topic,
+            prompt
+        ),
+        llm_model_id,
+    )
+
+
+def regenerate_stale_fields(
+    topic, gender, name, summary, personality, scenario, greeting_message,
+    example_messages, name_template, summary_template, personality_template,
+    scenario_template, greeting_message_template, example_messages_template,
+    llm_model_id
+):
+    # See FieldMemo.refresh() for which fields are regenerated.
+    with use_llm(llm_model_id) as llm:
+        config = getattr(llm, "config", None)
+    fields = {
+        "name": name,
+        "summary": summary,
+        "personality": personality,
+        "scenario": scenario,
+        "greeting_message": greeting_message,
+        "example_messages": example_messages,
+    }
+    prompts = {
+        "name": lambda f: name_prompt(topic, gender, name_template),
+        "summary": lambda f: summary_prompt(
+            f["name"], topic, gender, summary_template
+        ),
+        "personality": lambda f: personality_prompt(
+            f["name"], f["summary"], topic, personality_template
+        ),
+        "scenario": lambda f: scenario_prompt(
+            f["summary"], f["personality"], topic, scenario_template
+        ),
+        "greeting_message": lambda f: greeting_message_prompt(
+            f["name"], f["summary"], f["personality"], topic,
+            greeting_message_template
+        ),
+        "example_messages": lambda f: example_messages_prompt(
+            f["name"], f["summary"], f["personality"], topic,
+            example_messages_template
+        ),
+    }
+    generated, reused = [], []
+    for field, source in memo.refresh(
+        fields, prompts,
+        lambda prompt: field_key(prompt, llm_model_id, config),
+        lambda field, prompt: generate_field(field, prompt, llm_model_id),
+    ):
+        done = reused if source == "reused" else generated
+        if field not in done:
+            done.append(field)
+        yield list(fields.values())
+    gr.Info(
+        f"Generated: {', '.join(generated) or 'nothing'}. "
+        f"Reused: {', '.join(reused) or 'nothing'}. "
+        f"Up to date: {len(fields) - len(generated) - len(reused)} field(s)."
+    )
+    yield list(fields.values())
 
 
 def save_uploaded_image(image, character_name):
@@ -401,26 +747,42 @@ def generate_character_avatar(
     negative_prompt,
     avatar_prompt,
     nsfw_filter,
-    prompt_template
+    prompt_template,
+    llm_model_id,
+    sd_model_id
 ):
-    sd_prompt = (
-        input_none(avatar_prompt)
-        or llm.invoke(
-            prompt_template
-            + "\n<|user|> create a prompt that lists the appearance "
-            + "characteristics of a character whose summary is "
-            + f"{character_summary}. Topic: {topic} </s>\n<|assistant|> "
-        ).strip()
-    )
-    print(sd_prompt)
-    sd_filter(nsfw_filter)
-    return image_generate(character_name,
-                          sd_prompt,
-                          input_none(negative_prompt)
-                          )
-
-
-def image_generate(character_name, prompt, negative_prompt):
+    if not llm_model_id and not input_none(avatar_prompt):
+        raise gr.Error("No LLM is loaded yet. Enter a stable diffusion prompt or wait until it is ready.")  # nopep8
+    with use_sd(sd_model_id) as sd:
+        sd_prompt = input_none(avatar_prompt)
+        if not sd_prompt:
+            try:
+                with use_llm(llm_model_id) as llm, llm_queue.slot(
+                    on_wait=lambda position: gr.Info(
+                        f"Waiting for the LLM, position {position} in the queue"  # nopep8
+                    )
+                ):
+                    sd_prompt = llm.invoke(
+                        prompt_template
+                        + "\n<|user|> create a prompt that lists the appearance "  # nopep8
+                        + "characteristics of a character whose summary is "
+                        + f"{character_summary}. Topic: {topic} </s>\n<|assistant|> ",  # nopep8
+                        prefix_key="avatar_prompt",
+                    ).strip()
+            except QueueFull as e:
+                raise gr.Error(str(e))
+        print(sd_prompt)
+        return image_generate(character_name,
+                              sd_prompt,
+                              input_none(negative_prompt),
+                              sd,
+                              sd_model_id,
+                              nsfw_filter
+                              )
+
+
+def image_generate(character_name, prompt, negative_prompt, sd,
+                   sd_model_id, nsfw_filter):
     if not character_name:
         raise gr.Error("Set character name first before generating an avatar.")
     prompt = "absurdres, full hd, 8k, high quality, " + prompt
@@ -441,7 +803,18 @@ def image_generate(character_name, prompt, negative_prompt):
     )
     negative_prompt = default_negative_prompt + (negative_prompt or "")
 
-    generated_image = sd(prompt, negative_prompt=negative_prompt).images[0]
+    try:
+        with sd_queue.slot(on_wait=lambda position: gr.Info(
+            f"Waiting for Stable Diffusion, position {position} in the queue"
+        )):
+            # The pipeline is shared by all sessions, so its safety checker
+            # is only switched while this request holds it.
+            sd_filter(sd, nsfw_filter)
+            generated_image = telemetry.generate_image(
+                sd, prompt, sd_model_id, negative_prompt=negative_prompt
+            )
+    except QueueFull as e:
+        raise gr.Error(str(e))
 
     character_name = character_name.replace(" ", "_")
     os.makedirs(f"characters/{character_name}", exist_ok=True)
@@ -453,15 +826,13 @@ def image_generate(character_name, prompt, negative_prompt):
     return generated_image
 
 
-def sd_filter(enable):
+def sd_filter(sd, enable):
     if enable:
-        if sd:
-            sd.safety_checker = safety_checker_sd
-            sd.requires_safety_checker = True
+        sd.safety_checker = sd.default_safety_checker
+        sd.requires_safety_checker = True
     else:
-        if sd:
-            sd.safety_checker = None
-            sd.requires_safety_checker = False
+        sd.safety_checker = None
+        sd.requires_safety_checker = False
 
 
 def input_none(text):
@@ -472,6 +843,31 @@ def input_none(text):
         return user_input
 
 
+def clean_name(text):
+    return re.sub(r"[^a-zA-Z0-9_ -]", "", text).strip()
+
+
+def stream_output(chunks, clean=str.strip):
+    # Show the text while it is generated. Gradio closes this generator when
+    # the Stop button is pressed or the page is closed, which stops the
+    # generation as well.
+    try:
+        ticket = llm_queue.join()
+    except QueueFull as e:
+        raise gr.Error(str(e))
+    try:
+        while not ticket.wait(POLL_SECONDS):
+            yield f"Waiting for the LLM, position {ticket.position()} in the queue..."  # nopep8
+        output = ""
+        for chunk in chunks:
+            output += chunk
+            yield clean(output)
+        yield clean(output)
+    finally:
+        ticket.release()
+    print(clean(output))
+
+
 """## Start WebUI"""
 
 
@@ -554,7 +950,43 @@ with gr.Blocks() as webui:
         with gr.Row():
             llm_model_url_input = gr.Textbox(value=DEFAULT_LLM_MODEL_URL, label="LLM GGUF Model URL")
             sd_model_id_input = gr.Textbox(value=DEFAULT_SD_MODEL_ID, label="Stable Diffusion Model ID")
+        llm_backend_input = gr.Radio(
+            choices=[("Local GGUF model", "local"),
+                     ("OpenAI-compatible server", "openai")],
+            value="local",
+            label="LLM backend",
+        )
+        with gr.Row():
+            llm_url_input = gr.Textbox(
+                value=DEFAULT_LLM_URL,
+                label="OpenAI-compatible server URL (for the server backend; the GGUF URL above is not used then)",  # nopep8
+            )
+            llm_api_model_input = gr.Textbox(
+                label="Model name on the server (optional)",
+                placeholder="leave empty for the first model the server lists",  # nopep8
+            )
+        with gr.Row():
+            draft_model_url_input = gr.Textbox(
+                label="Draft GGUF Model URL for speculative decoding (optional, needs llama-cpp-python)",  # nopep8
+                placeholder="e.g. a TinyLlama GGUF; leave empty to disable",
+            )
+            draft_tokens_input = gr.Number(
+                value=DRAFT_TOKENS, precision=0, minimum=1,
+                label="Draft tokens proposed at a time",
+            )
+        memory_plan_input = gr.Radio(
+            choices=[("Use a smaller context if needed, only suggest a smaller quantization", "suggest"),  # nopep8
+                     ("Pick a smaller context or quantization automatically", "auto"),  # nopep8
+                     ("Load without checking", "off")],
+            value=memory_planner.MODE,
+            label="If the LLM does not fit into memory",
+        )
+        ram_budget_input = gr.Number(
+            value=round(default_budget_bytes() / 1024 ** 3),
+            label="RAM budget for loaded models (GiB). Previously loaded models stay resident until the budget is exceeded.",  # nopep8
+        )
         load_models_button = gr.Button("Load Models")
+        model_status_output = gr.Markdown()
 
     with gr.Tab("Edit character") as edit_tab:
         gr.Markdown(
@@ -567,6 +999,11 @@ with gr.Blocks() as webui:
         gender = gr.Textbox(
             placeholder="Gender: Gender of the character", label="gender"
         )
+        with gr.Row():
+            llm_model_dropdown = gr.Dropdown(choices=[], label="LLM model")
+            sd_model_dropdown = gr.Dropdown(
+                choices=[], label="Stable Diffusion model"
+            )
         with gr.Column():
             with gr.Row():
                 name = gr.Textbox(placeholder="character name", label="name")
@@ -612,6 +1049,12 @@ with gr.Blocks() as webui:
                     "Generate character example messages with LLM"
                 )
 
+            with gr.Row():
+                stale_button = gr.Button(
+                    "Regenerate stale fields (only those whose inputs changed)"  # nopep8
+                )
+                stop_button = gr.Button("Stop generation")
+
             gr.Markdown("## Generate a character avatar using Stable Diffusion or upload an image file (.png file format is recommended)")
             gr.Markdown("### (set character name first)")
             with gr.Row():
@@ -647,6 +1090,17 @@ with gr.Blocks() as webui:
         example_messages_prompt_input = gr.Textbox(label="Example Messages Prompt", value=EXAMPLE_MESSAGES_PROMPT, lines=15, max_lines=30)
         avatar_prompt_generation_prompt_input = gr.Textbox(label="Avatar Prompt Generation Prompt", value=AVATAR_PROMPT_GENERATION_PROMPT, lines=15, max_lines=30)
 
+        for prefix_key, prompt_input in [
+            ("name", name_prompt_input),
+            ("summary", summary_prompt_input),
+            ("personality", personality_prompt_input),
+            ("scenario", scenario_prompt_input),
+            ("greeting_message", greeting_message_prompt_input),
+            ("example_messages", example_messages_prompt_input),
+            ("avatar_prompt", avatar_prompt_generation_prompt_input),
+        ]:
+            prompt_input.change(partial(invalidate_prefix, prefix_key), queue=False)  # nopep8
+
     with gr.Tab("Import character"):
         with gr.Column():
             with gr.Row():
@@ -718,6 +1172,16 @@ with gr.Blocks() as webui:
                     ],
                     outputs=export_json_textbox,
                 )
+    with gr.Accordion("Telemetry", open=False):
+        gr.Markdown(
+            "Time spent per field and per image since the WebUI started."
+        )
+        telemetry_output = gr.Markdown()
+        telemetry_button = gr.Button("Refresh")
+        telemetry_button.click(
+            telemetry_status, inputs=None, outputs=telemetry_output
+        )
+    webui.load(telemetry_status, inputs=None, outputs=telemetry_output)
     gr.HTML("""<div style='text-align: center; font-size: 20px;'>
     <p>
       <a style="text-decoration: none; color: inherit;" href="https://github.com/Hukasx0/character-factory">Character Factory</a>
@@ -728,7 +1192,8 @@ with gr.Blocks() as webui:
 
     generation_buttons = [
         name_button, summary_button, personality_button,
-        scenario_button, greeting_message_button, example_messages_button, avatar_button
+        scenario_button, greeting_message_button, example_messages_button,
+        stale_button, avatar_button
     ]
 
     # Set interactive=False initially for the generation buttons
@@ -736,41 +1201,90 @@ with gr.Blocks() as webui:
 
     load_models_button.click(
         load_models,
-        inputs=[llm_model_url_input, sd_model_id_input],
-        outputs=[edit_tab]
-    ).then(
-        lambda: [gr.update(interactive=True) for _ in generation_buttons], None, generation_buttons
+        inputs=[llm_model_url_input, sd_model_id_input, ram_budget_input,
+                draft_model_url_input, draft_tokens_input, llm_backend_input,
+                llm_url_input, llm_api_model_input, memory_plan_input],
+        outputs=[model_status_output] + generation_buttons
+        + [llm_model_dropdown, sd_model_dropdown]
     )
 
-    name_button.click(
+    name_event = name_button.click(
         generate_character_name,
-        inputs=[topic, gender, name_prompt_input],
-        outputs=name
+        inputs=[topic, gender, name_prompt_input, llm_model_dropdown],
+        outputs=name,
+        # Every session reaches the LLM queue, which orders them.
+        concurrency_limit=None,
     )
-    summary_button.click(
+    summary_event = summary_button.click(
         generate_character_summary,
-        inputs=[name, topic, gender, summary_prompt_input],
+        inputs=[name, topic, gender, summary_prompt_input, llm_model_dropdown],
         outputs=summary,
+        concurrency_limit=None,
     )
-    personality_button.click(
+    personality_event = personality_button.click(
         generate_character_personality,
-        inputs=[name, summary, topic, personality_prompt_input],
+        inputs=[name, summary, topic, personality_prompt_input, llm_model_dropdown],
         outputs=personality,
+        concurrency_limit=None,
     )
-    scenario_button.click(
+    scenario_event = scenario_button.click(
         generate_character_scenario,
-        inputs=[summary, personality, topic, scenario_prompt_input],
+        inputs=[summary, personality, topic, scenario_prompt_input, llm_model_dropdown],
         outputs=scenario,
+        concurrency_limit=None,
     )
-    greeting_message_button.click(
+    greeting_message_event = greeting_message_button.click(
         generate_character_greeting_message,
-        inputs=[name, summary, personality, topic, greeting_message_prompt_input],
+        inputs=[name, summary, personality, topic, greeting_message_prompt_input, llm_model_dropdown],
         outputs=greeting_message,
+        concurrency_limit=None,
     )
-    example_messages_button.click(
+    example_messages_event = example_messages_button.click(
         generate_example_messages,
-        inputs=[name, summary, personality, topic, example_messages_prompt_input],
+        inputs=[name, summary, personality, topic, example_messages_prompt_input, llm_model_dropdown],
         outputs=example_messages,
+        concurrency_limit=None,
+    )
+    stale_event = stale_button.click(
+        regenerate_stale_fields,
+        inputs=[
+            topic,
+            gender,
+            name,
+            summary,
+            personality,
+            scenario,
+            greeting_message,
+            example_messages,
+            name_prompt_input,
+            summary_prompt_input,
+            personality_prompt_input,
+            scenario_prompt_input,
+            greeting_message_prompt_input,
+            example_messages_prompt_input,
+            llm_model_dropdown,
+        ],
+        outputs=[
+            name,
+            summary,
+            personality,
+            scenario,
+            greeting_message,
+            example_messages,
+        ],
+        concurrency_limit=None,
+    )
+    stop_button.click(
+        None,
+        cancels=[
+            name_event,
+            summary_event,
+            personality_event,
+            scenario_event,
+            greeting_message_event,
+            example_messages_event,
+            stale_event,
+        ],
     )
     avatar_button.click(
         generate_character_avatar,
@@ -781,9 +1295,13 @@ with gr.Blocks() as webui:
             negative_prompt,
             avatar_prompt,
             potential_nsfw_checkbox,
-            avatar_prompt_generation_prompt_input
+            avatar_prompt_generation_prompt_input,
+            llm_model_dropdown,
+            sd_model_dropdown,
         ],
         outputs=image_input,
+        # Renders wait in the Stable Diffusion queue instead.
+        concurrency_limit=None,
     )
     image_input.upload(save_uploaded_image, inputs=[image_input, name], outputs=image_input)
 
@@ -1,16 +1,22 @@
 import os
-import sys
 
 import aichar
-import requests
-from tqdm import tqdm
-from diffusers import DiffusionPipeline
 import torch
-from langchain_community.llms import CTransformers
 import gradio as gr
 from PIL import Image
 import re
 
+from chat_format import model_type
+from llm_tuning import apply_tuning
+from model_server import MODEL_SERVER_SOCKET, RemoteDiffusionPipeline, RemoteLLM
+from model_store import OfflineModelMissing, ensure_model
+from prefix_cache import PrefixCachedLLM
+from request_scheduler import ScheduledLLM
+from resource_queue import POLL_SECONDS, QueueFull, llm_queue, sd_queue
+from response_cache import with_cache
+import telemetry
+from sd_loading import load_pipeline
+
 llm = None
 sd = None
 safety_checker_sd = None
@@ -20,77 +26,63 @@ model_url = "https://huggingface.co/TheBloke/zephyr-7B-beta-GGUF/resolve/main/ze
 
 
 def load_models():
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-    llm_model_name = os.path.join(folder_path, os.path.basename(model_url))
-    if not os.path.exists(llm_model_name):
-        try:
-            print(f"Downloading LLM model from: {model_url}")
-            with requests.get(model_url, stream=True) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get("content-length", 0))
-                block_size = 1024
-                progress_bar = tqdm(
-                    total=total_size,
-                    unit="B",
-                    unit_scale=True,
-                    unit_divisor=1024
-                )
-                with open(llm_model_name, "wb") as out_file:
-                    for data in response.iter_content(chunk_size=block_size):
-                        out_file.write(data)
-                        progress_bar.update(len(data))
-                    progress_bar.close()
-                    print(f"Model downloaded and saved to: {llm_model_name}")
-        except Exception as e:
-            print(f"Error while downloading LLM model: {str(e)}")
+    try:
+        ensure_model(model_url, os.path.basename(model_url), folder_path)
+    except OfflineModelMissing as e:
+        raise SystemExit(f"Error: {e}")
+    except Exception as e:
+        print(f"Error while downloading LLM model: {str(e)}")
+    config = {
+        "max_new_tokens": 1024,
+        "repetition_penalty": 1.1,
+        "top_k": 40,
+        "top_p": 0.95,
+        "temperature": 0.8,
+        # The largest context; each one is sized to its prompts.
+        "context_length": 8192,
+        "stop": [
+            "/s",
+            "</s>",
+            "<s>",
+            "<|system|>",
+            "<|assistant|>",
+            "<|user|>",
+            "<|char|>",
+        ],
+    }
     global sd
-    sd = DiffusionPipeline.from_pretrained(
-        "Lykon/dreamshaper-8",
-        torch_dtype=torch.float16,
-        variant="fp16",
-        low_cpu_mem_usage=False,
-    )
-    if torch.cuda.is_available():
-        sd.to("cuda")
-        print("Loading Stable Diffusion to GPU...")
-    elif torch.backends.mps.is_available():
-        sd.to("mps")
-        print("Loading Stable Diffusion to Metal...")
-    else:
-        if sys.platform == "darwin":
-            sd.to("cpu", torch.float32)
-        print("Loading Stable Diffusion to CPU...")
     global llm
+    if MODEL_SERVER_SOCKET:
+        print(f"Using models from model server: {MODEL_SERVER_SOCKET}")
+        sd = RemoteDiffusionPipeline(MODEL_SERVER_SOCKET, "Lykon/dreamshaper-8")
+        llm = RemoteLLM(
+            MODEL_SERVER_SOCKET,
+            "models/zephyr-7b-beta.Q4_K_M.gguf",
+            model_type("models/zephyr-7b-beta.Q4_K_M.gguf"),
+            config,
+        )
+        llm = with_cache(llm, "models/zephyr-7b-beta.Q4_K_M.gguf")
+        return
+    sd, _ = load_pipeline("Lykon/dreamshaper-8")
     gpu_layers = 0
     if torch.cuda.is_available() or torch.backends.mps.is_available():
         gpu_layers = 110
         print("Loading LLM to GPU...")
     else:
         print("Loading LLM to CPU...")
-    llm = CTransformers(
-        model="models/zephyr-7b-beta.Q4_K_M.gguf",
-        model_type="llama",
-        gpu_layers=gpu_layers,
-        config={
-            "max_new_tokens": 1024,
-            "repetition_penalty": 1.1,
-            "top_k": 40,
-            "top_p": 0.95,
-            "temperature": 0.8,
-            "context_length": 8192,
+    # All sessions share one queue. On the GPU every request uses the same
+    # context slot; on the CPU a few generations take turns token by token,
+    # so a name does not wait for a whole example dialogue.
+    llm = ScheduledLLM(PrefixCachedLLM(
+        "models/zephyr-7b-beta.Q4_K_M.gguf",
+        model_type("models/zephyr-7b-beta.Q4_K_M.gguf"),
+        {
+            **apply_tuning(config, "models/zephyr-7b-beta.Q4_K_M.gguf", gpu_layers),  # nopep8
             "gpu_layers": gpu_layers,
-            "stop": [
-                "/s",
-                "</s>",
-                "<s>",
-                "<|system|>",
-                "<|assistant|>",
-                "<|user|>",
-                "<|char|>",
-            ],
         },
-    )
+        slots=1 if gpu_layers else 3,
+    ))
+    llm = with_cache(llm, "models/zephyr-7b-beta.Q4_K_M.gguf")
 
 
 load_models()
@@ -112,16 +104,14 @@ You only answer by giving the name of the character, you do not describe it, you
 <|assistant|> mr. Fluffy </s>
     """  # nopep8
     gender = input_none(gender)
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n<|user|> Generate a random character name. "
         + f"Topic: {topic}. "
         + f"{'Character gender: '+gender+'.' if gender else ''} "
-        + "</s>\n<|assistant|> "
-    )
-    output = re.sub(r"[^a-zA-Z0-9_ -]", "", output).strip()
-    print(output)
-    return output
+        + "</s>\n<|assistant|> ",
+        prefix_key="name",
+    ), clean=clean_name)
 
 
 def generate_character_summary(character_name, topic, gender):
@@ -153,7 +143,7 @@ Mr Fluffy hates: cheap food, loud people
 Mr Fluffy abilities: An ordinary domestic cat with the ability to speak and incredible knowledge of philosophy, Can eat incredible amounts of (good) food and not feel satiated </s>
 """  # nopep8
     gender = input_none(gender)
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n<|user|> Create a longer description for a character named "
         + f"{character_name}. "
@@ -164,10 +154,9 @@ Mr Fluffy abilities: An ordinary domestic cat with the ability to speak and incr
         + "You are to write a brief description of the character. You must "
         + "include character traits, physical and character. You can't add "
         + "anything else. You must not write any summaries, conclusions or "
-        + "endings. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+        + "endings. </s>\n<|assistant|> ",
+        prefix_key="summary",
+    ))
 
 
 def generate_character_personality(
@@ -191,7 +180,7 @@ Your answer should be in the same form as the previous answers.
 <|user|> Describe the personality of Mr Fluffy. Their characteristics  Mr fluffy is {{user}}'s cat who is very fat and fluffy, he has black and white colored fur, this cat is 3 years old, he loves special expensive cat food and lying on {{user}}'s lap while he does his homework. Mr. Fluffy can speak human language, he is a cat who talks a lot about philosophy and expresses himself in a very sarcastic way </s>
 <|assistant|> Mr Fluffy is small, calm, lazy, mischievous cat, speaks in a very philosophical manner and is very sarcastic in his statements, very intelligent for a cat and even for a human, has a vast amount of knowledge about philosophy and the world </s>
 """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + f"\n<|user|> Describe the personality of {character_name}. "
         + f"Their characteristic {character_summary}\nDescribe them "
@@ -200,10 +189,9 @@ Your answer should be in the same form as the previous answers.
         + f"the theme of {topic} but don't specify what topic it is, "
         + "and don't describe the topic itself. You are to write out "
         + "character traits separated by commas, you must not write "
-        + "any summaries, conclusions or endings. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+        + "any summaries, conclusions or endings. </s>\n<|assistant|> ",
+        prefix_key="personality",
+    ))
 
 
 def generate_character_scenario(
@@ -227,7 +215,7 @@ You can not describe the character, but you have to describe the scenario and ac
 <|user|> Write a simple and undemanding introduction to the story, in which the main characters will be {{user}} and {{char}}, do not develop the story, write only the introduction. {{char}} characteristics: Tatsukaga Yamari is an 23 year old anime girl, who loves books and coffee. Make this character unique and tailor them to the theme of anime, but don't specify what topic it is, and don't describe the topic itself. Your response must end when {{user}} and {{char}} interact. </s>
 <|assistant|> When {{user}} found a magic stone in the forest, he moved to the magical world, where he meets {{char}}, who looks at him in disbelief, but after a while comes over to greet him. </s>
 """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + f"\n<|user|> Write a scenario for chat roleplay "
         + "to serve as a simple storyline to start chat "
@@ -238,10 +226,9 @@ You can not describe the character, but you have to describe the scenario and ac
         + "specify what topic it is, and don't describe the topic "
         + "itself. Your answer must not contain any dialogues. "
         + "Your response must end when {{user}} and {{char}} interact. "
-        + "</s>\n<|assistant|> "
-    )
-    print(output)
-    return output
+        + "</s>\n<|assistant|> ",
+        prefix_key="scenario",
+    ))
 
 
 def generate_character_greeting_message(
@@ -264,7 +251,7 @@ decision-making in the business world, and he possesses an insatiable thirst for
 abilities, he prefers peaceful solutions and seeks to maintain harmony in his woodland domain.\ngreets the user we are addressing as {{user}}. Make this character unique and tailor them to the theme of fantasy but don't specify what topic it is, and don't describe the topic itself </s>
 <|assistant|> *Eldric, the elegant elf, approaches you with a serene and contemplative air. His shimmering eyes, filled with ancient wisdom, meet yours as he offers a soft and respectful greeting* Greetings, {{user}}. It is an honor to welcome you to our enchanted woodland realm. I am Eldric, guardian of this forest, and I can sense that you bring a unique energy with you. How may I assist you in your journey through the wonders of the natural world or share the mysteries of our elven heritage with you today? </s>
 """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + "\n<|user|> Create the first message that the character "
         + f"{character_name}, whose personality is "
@@ -276,10 +263,9 @@ abilities, he prefers peaceful solutions and seeks to maintain harmony in his wo
         + "speaking style to the character, if the character is "
         + "childish then speak in a childish way, if the character "
         + "is serious, philosophical then speak in a serious and "
-        + "philosophical way, and so on. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+        + "philosophical way, and so on. </s>\n<|assistant|> ",
+        prefix_key="greeting_message",
+    ))
 
 
 def generate_example_messages(
@@ -306,7 +292,7 @@ Instead of the character's name you must use {{char}}.
 {{user}}: *Nods with determination.* I have no doubt we can do it. With your magic and our unwavering friendship, there's nothing we can't accomplish.
 {{char}}: *{{char}} moves closer, her eyes shining with trust and camaraderie.* That's the spirit, {{user}}! Let's embark on this epic quest and make the Crystal Caves ours! </s>
 """  # nopep8
-    output = llm.invoke(
+    yield from stream_output(llm.stream(
         example_dialogue
         + f"\n<|user|> Create a dialogue between {{user}} and {{char}}, "
         + "they should have an interesting and engaging conversation, "
@@ -319,10 +305,9 @@ Instead of the character's name you must use {{char}}.
         + "topic itself. You must match the speaking style to the character, "
         + "if the character is childish then speak in a childish way, if the "
         + "character is serious, philosophical then speak in a serious and "
-        + "philosophical way and so on. </s>\n<|assistant|> "
-    ).strip()
-    print(output)
-    return output
+        + "philosophical way and so on. </s>\n<|assistant|> ",
+        prefix_key="example_messages",
+    ))
 
 def save_uploaded_image(image, character_name):
     if image is not None:
@@ -354,24 +339,30 @@ Yamari's wardrobe is a colorful and eclectic mix, mirroring her ever-changing mo
 cat-eared headbands, or a pair of mismatched socks, contribute to her quirky and endearing charm. Topic: anime </s>
 <|assistant|> female, anime, Petite and delicate frame, Raven-black hair flowing down to her waist, Striking purple ribbon in her hair, Large and expressive amethyst-colored eyes, Colorful and eclectic outfit, oversized bows, cat-eared headbands, mismatched socks </s>
 """  # nopep8
-    sd_prompt = (
-        input_none(avatar_prompt)
-        or llm.invoke(
-            example_dialogue
-            + "\n<|user|> create a prompt that lists the appearance "
-            + "characteristics of a character whose summary is "
-            + f"{character_summary}. Topic: {topic} </s>\n<|assistant|> "
-        ).strip()
-    )
+    sd_prompt = input_none(avatar_prompt)
+    if not sd_prompt:
+        try:
+            with llm_queue.slot(on_wait=lambda position: gr.Info(
+                f"Waiting for the LLM, position {position} in the queue"
+            )):
+                sd_prompt = llm.invoke(
+                    example_dialogue
+                    + "\n<|user|> create a prompt that lists the appearance "
+                    + "characteristics of a character whose summary is "
+                    + f"{character_summary}. Topic: {topic} </s>\n<|assistant|> ",  # nopep8
+                    prefix_key="avatar_prompt",
+                ).strip()
+        except QueueFull as e:
+            raise gr.Error(str(e))
     print(sd_prompt)
-    sd_filter(nsfw_filter)
     return image_generate(character_name,
                           sd_prompt,
-                          input_none(negative_prompt)
+                          input_none(negative_prompt),
+                          nsfw_filter
                           )
 
 
-def image_generate(character_name, prompt, negative_prompt):
+def image_generate(character_name, prompt, negative_prompt, nsfw_filter):
     prompt = "absurdres, full hd, 8k, high quality, " + prompt
     default_negative_prompt = (
         "worst quality, normal quality, low quality, low res, blurry, "
@@ -390,7 +381,19 @@ def image_generate(character_name, prompt, negative_prompt):
     )
     negative_prompt = default_negative_prompt + (negative_prompt or "")
 
-    generated_image = sd(prompt, negative_prompt=negative_prompt).images[0]
+    try:
+        with sd_queue.slot(on_wait=lambda position: gr.Info(
+            f"Waiting for Stable Diffusion, position {position} in the queue"
+        )):
+            # The pipeline is shared by all sessions, so its safety checker
+            # is only switched while this request holds it.
+            sd_filter(nsfw_filter)
+            generated_image = telemetry.generate_image(
+                sd, prompt, "Lykon/dreamshaper-8",
+                negative_prompt=negative_prompt,
+            )
+    except QueueFull as e:
+        raise gr.Error(str(e))
 
     character_name = character_name.replace(" ", "_")
     os.makedirs(f"characters/{character_name}", exist_ok=True)
@@ -419,6 +422,31 @@ def input_none(text):
         return user_input
 
 
+def clean_name(text):
+    return re.sub(r"[^a-zA-Z0-9_ -]", "", text).strip()
+
+
+def stream_output(chunks, clean=str.strip):
+    # Show the text while it is generated. Gradio closes this generator when
+    # the Stop button is pressed or the page is closed, which stops the
+    # generation as well.
+    try:
+        ticket = llm_queue.join()
+    except QueueFull as e:
+        raise gr.Error(str(e))
+    try:
+        while not ticket.wait(POLL_SECONDS):
+            yield f"Waiting for the LLM, position {ticket.position()} in the queue..."  # nopep8
+        output = ""
+        for chunk in chunks:
+            output += chunk
+            yield clean(output)
+        yield clean(output)
+    finally:
+        ticket.release()
+    print(clean(output))
+
+
 """## Start WebUI"""
 
 
@@ -491,6 +519,14 @@ def export_character_card(
     return card_path
 
 
+
+def telemetry_status():
+    # The model server's queue is not visible from here.
+    queue_status = getattr(llm, "queue_status", None)
+    return ((queue_status() if queue_status else "") + llm_queue.status()
+            + sd_queue.status() + "\n" + telemetry.summary())
+
+
 with gr.Blocks() as webui:
     gr.Markdown("# Character Factory WebUI")
     gr.Markdown("## Model: Zephyr 7b Beta")
@@ -509,10 +545,12 @@ with gr.Blocks() as webui:
             with gr.Row():
                 name = gr.Textbox(placeholder="character name", label="name")
                 name_button = gr.Button("Generate character name with LLM")
-                name_button.click(
+                name_event = name_button.click(
                     generate_character_name,
                     inputs=[topic, gender],
-                    outputs=name
+                    outputs=name,
+                    # Every session reaches the LLM queue, which orders them.
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 summary = gr.Textbox(
@@ -520,10 +558,11 @@ with gr.Blocks() as webui:
                     label="summary"
                 )
                 summary_button = gr.Button("Generate character summary with LLM")  # nopep8
-                summary_button.click(
+                summary_event = summary_button.click(
                     generate_character_summary,
                     inputs=[name, topic, gender],
                     outputs=summary,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 personality = gr.Textbox(
@@ -532,10 +571,11 @@ with gr.Blocks() as webui:
                 personality_button = gr.Button(
                     "Generate character personality with LLM"
                 )
-                personality_button.click(
+                personality_event = personality_button.click(
                     generate_character_personality,
                     inputs=[name, summary, topic],
                     outputs=personality,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 scenario = gr.Textbox(
@@ -543,10 +583,11 @@ with gr.Blocks() as webui:
                     label="scenario"
                 )
                 scenario_button = gr.Button("Generate character scenario with LLM")  # nopep8
-                scenario_button.click(
+                scenario_event = scenario_button.click(
                     generate_character_scenario,
                     inputs=[summary, personality, topic],
                     outputs=scenario,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 greeting_message = gr.Textbox(
@@ -556,10 +597,11 @@ with gr.Blocks() as webui:
                 greeting_message_button = gr.Button(
                     "Generate character greeting message with LLM"
                 )
-                greeting_message_button.click(
+                greeting_message_event = greeting_message_button.click(
                     generate_character_greeting_message,
                     inputs=[name, summary, personality, topic],
                     outputs=greeting_message,
+                    concurrency_limit=None,
                 )
             with gr.Row():
                 example_messages = gr.Textbox(
@@ -569,11 +611,24 @@ with gr.Blocks() as webui:
                 example_messages_button = gr.Button(
                     "Generate character example messages with LLM"
                 )
-                example_messages_button.click(
+                example_messages_event = example_messages_button.click(
                     generate_example_messages,
                     inputs=[name, summary, personality, topic],
                     outputs=example_messages,
+                    concurrency_limit=None,
                 )
+            stop_button = gr.Button("Stop generation")
+            stop_button.click(
+                None,
+                cancels=[
+                    name_event,
+                    summary_event,
+                    personality_event,
+                    scenario_event,
+                    greeting_message_event,
+                    example_messages_event,
+                ],
+            )
             gr.Markdown("## Generate a character avatar using Stable Diffusion or upload an image file (.png file format is recommended)")
             gr.Markdown("### (set character name first)")
             with gr.Row():
@@ -608,6 +663,8 @@ with gr.Blocks() as webui:
                             potential_nsfw_checkbox,
                         ],
                         outputs=image_input,
+                        # Renders wait in the Stable Diffusion queue instead.
+                        concurrency_limit=None,
                     )
     with gr.Tab("Import character"):
         with gr.Column():
@@ -680,6 +737,16 @@ with gr.Blocks() as webui:
                     ],
                     outputs=export_json_textbox,
                 )
+    with gr.Accordion("Telemetry", open=False):
+        gr.Markdown(
+            "Time spent per field and per image since the WebUI started."
+        )
+        telemetry_output = gr.Markdown()
+        telemetry_button = gr.Button("Refresh")
+        telemetry_button.click(
+            telemetry_status, inputs=None, outputs=telemetry_output
+        )
+    webui.load(telemetry_status, inputs=None, outputs=telemetry_output)
     gr.HTML("""<div style='text-align: center; font-size: 20px;'>
     <p>
       <a style="text-decoration: none; color: inherit;" href="https://github.com/Hukasx0/character-factory">Character Factory</a> 
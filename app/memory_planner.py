@@ -0,0 +1,241 @@
+"""
+Check before loading whether a GGUF model fits into memory.
+
+Loading a model that is too large fails only after minutes of downloading
+and loading, deep inside CTransformers, or takes the machine down with it.
+`plan()` reads the model's header instead (see `gguf_header`, nothing is
+downloaded) and estimates what the model needs:
+
+- the weights, i.e. the size of the file, which is memory-mapped as a whole,
+- the key/value cache of the contexts: 2 (keys and values) x layers x
+  context length x key/value width x 2 bytes; the first context may grow to
+  the full `context_length`, the others of a `PrefixCachedLLM` are counted
+  at their initial size (see `prompt_budget`),
+- the evaluation buffers, which grow with the context, plus a fixed amount.
+
+If that is more than the available memory, a smaller context is tried,
+then the smaller quantizations of the same model (the file name with
+`Q8_0` replaced by `Q6_K`, `Q5_K_M`, ...). What happens then depends on the
+mode (CHARACTER_FACTORY_MEMORY_PLAN or the power-user Configuration tab):
+
+- "suggest" (default): a smaller context is used, since it only limits the
+  longest prompts; a smaller quantization is only suggested and the load
+  is refused with `ModelTooLarge`.
+- "auto": a smaller quantization is picked and downloaded as well.
+- "off": no check.
+
+    python app/memory_planner.py https://huggingface.co/.../model.Q8_0.gguf
+"""
+
+import argparse
+import os
+import re
+
+import gguf_header
+import model_store
+import prompt_budget
+from model_store import MODELS_FOLDER, blob_path, load_manifest, remote_metadata  # nopep8
+
+MODE = os.environ.get("CHARACTER_FACTORY_MEMORY_PLAN", "suggest")
+MODES = ("suggest", "auto", "off")
+# Contexts are not reduced below this; the longer prompts need about that.
+MIN_PLAN_CONTEXT = 2048
+OVERHEAD_BYTES = 512 * 1024 ** 2
+
+# Bits per weight of the llama.cpp quantizations, largest first.
+QUANTIZATIONS = {
+    "F16": 16.0, "Q8_0": 8.5, "Q6_K": 6.56, "Q5_K_M": 5.69, "Q5_K_S": 5.54,
+    "Q5_0": 5.54, "Q4_K_M": 4.85, "Q4_K_S": 4.58, "Q4_0": 4.55,
+    "Q3_K_L": 4.27, "Q3_K_M": 3.91, "Q3_K_S": 3.5, "Q2_K": 2.63,
+}
+# `general.file_type` of the header.
+FILE_TYPES = {
+    1: "F16", 2: "Q4_0", 7: "Q8_0", 8: "Q5_0", 10: "Q2_K", 11: "Q3_K_S",
+    12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S",
+    17: "Q5_K_M", 18: "Q6_K",
+}
+QUANTIZATION_IN_NAME = re.compile(r"(?<=[.\-_])(f16|q\d_[a-z0-9_]+?)(?=\.gguf(?:$|\?))", re.I)  # nopep8
+
+
+class ModelTooLarge(MemoryError):
+    pass
+
+
+def gib(size):
+    return f"{size / 1024 ** 3:.1f} GiB"
+
+
+def available_memory_bytes():
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    from model_registry import physical_memory_bytes
+
+    return physical_memory_bytes()
+
+
+def read_header(url):
+    """Return the header of the model at `url` or path, or None."""
+    digest = load_manifest(MODELS_FOLDER)["urls"].get(url)
+    if digest and os.path.exists(blob_path(MODELS_FOLDER, digest)):
+        return gguf_header.read_local(blob_path(MODELS_FOLDER, digest))
+    if os.path.exists(url):
+        return gguf_header.read_local(url)
+    if model_store.OFFLINE:
+        return None
+    return gguf_header.read_remote(url)
+
+
+def kv_cache_bytes(header, context_length):
+    heads = header.get("{arch}.attention.head_count", 32)
+    kv_width = header.get("{arch}.embedding_length", 4096) \
+        * header.get("{arch}.attention.head_count_kv", heads) // heads
+    return 2 * header.get("{arch}.block_count", 32) * context_length \
+        * kv_width * 2
+
+
+def estimate_bytes(header, context_length, slots=1, weights_bytes=None):
+    if prompt_budget.DYNAMIC:
+        contexts = kv_cache_bytes(header, context_length) + (slots - 1) \
+            * kv_cache_bytes(header, min(prompt_budget.INITIAL_CONTEXT, context_length))  # nopep8
+    else:
+        contexts = slots * kv_cache_bytes(header, context_length)
+    buffers = context_length * header.get("{arch}.embedding_length", 4096) * 16  # nopep8
+    weights = header.file_size if weights_bytes is None else weights_bytes
+    return weights + contexts + buffers + OVERHEAD_BYTES
+
+
+def quantization(url, header):
+    match = QUANTIZATION_IN_NAME.search(url)
+    if match:
+        return match.group(1).upper()
+    return FILE_TYPES.get(header.get("general.file_type"))
+
+
+def with_quantization(url, name):
+    match = QUANTIZATION_IN_NAME.search(url)
+    if match is None:
+        return None
+    if match.group(1).islower():
+        name = name.lower()
+    return url[:match.start()] + name + url[match.end():]
+
+
+def candidate_size(url):
+    """Size of another quantization's file, None if it does not exist."""
+    if os.path.exists(url):
+        return os.path.getsize(url)
+    digest = load_manifest(MODELS_FOLDER)["urls"].get(url)
+    if digest and os.path.exists(blob_path(MODELS_FOLDER, digest)):
+        return os.path.getsize(blob_path(MODELS_FOLDER, digest))
+    if model_store.OFFLINE:
+        return None
+    size, _ = remote_metadata(url)
+    return size
+
+
+def plan(url, context_length, slots=1, available=None, mode=MODE,
+         header=None):
+    """Return `{"url", "context_length", "note"}` to load the model with.
+
+    `header` is the model's header if the caller has read it already.
+    Raises `ModelTooLarge` when nothing fits, or when only a smaller
+    quantization would and `mode` is not "auto".
+    """
+    result = {"url": url, "context_length": context_length, "note": ""}
+    if mode == "off":
+        return result
+    try:
+        header = header or read_header(url)
+    except (OSError, ValueError) as e:
+        # Not a GGUF file, or no header from the server; the load itself
+        # reports real problems.
+        result["note"] = f"memory not checked, the header could not be read: {e}"  # nopep8
+        return result
+    if header is None:
+        result["note"] = "memory not checked, offline and not downloaded yet"
+        return result
+    available = available or available_memory_bytes()
+    needed = estimate_bytes(header, context_length, slots)
+    name = os.path.basename(url)
+    if needed <= available:
+        result["note"] = f"needs about {gib(needed)} of {gib(available)} available"  # nopep8
+        return result
+
+    problem = (f"{name} needs about {gib(needed)} with {context_length}-token "
+               f"contexts, but only {gib(available)} are available")
+    contexts = []
+    context = context_length // 2
+    while context >= MIN_PLAN_CONTEXT:
+        contexts.append(context)
+        context //= 2
+    for context in contexts:
+        smaller = estimate_bytes(header, context, slots)
+        if smaller <= available:
+            result["context_length"] = context
+            result["note"] = f"{problem}; using contexts of up to {context} tokens ({gib(smaller)})"  # nopep8
+            return result
+
+    current = quantization(url, header)
+    suggestion = None
+    if current in QUANTIZATIONS:
+        for candidate_name, bits in QUANTIZATIONS.items():
+            candidate = with_quantization(url, candidate_name)
+            if bits >= QUANTIZATIONS[current] or candidate is None:
+                continue
+            size = candidate_size(candidate)
+            if size is None:
+                continue
+            for context in [context_length] + contexts:
+                smaller = estimate_bytes(header, context, slots, size)
+                if smaller <= available:
+                    suggestion = (candidate, candidate_name, context, smaller)
+                    break
+            if suggestion:
+                break
+    if suggestion is None:
+        raise ModelTooLarge(f"{problem}, and no smaller quantization of it fits either. Choose a smaller model or free some memory.")  # nopep8
+    candidate, candidate_name, context, smaller = suggestion
+    if mode != "auto":
+        raise ModelTooLarge(f"{problem}. The {candidate_name} quantization would fit ({gib(smaller)} with {context}-token contexts): {candidate}")  # nopep8
+    result.update(url=candidate, context_length=context)
+    result["note"] = f"{problem}; loading the {candidate_name} quantization with contexts of up to {context} tokens instead ({gib(smaller)})"  # nopep8
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check whether a GGUF model fits into memory"
+    )
+    parser.add_argument("model", help="URL or path of a GGUF file")
+    parser.add_argument("--context-length", type=int, default=8192)
+    parser.add_argument("--slots", type=int, default=1,
+                        help="contexts kept at the same time")
+    parser.add_argument("--available-gib", type=float,
+                        help="memory to plan for instead of what is free now")
+    parser.add_argument("--mode", choices=MODES, default="auto")
+    args = parser.parse_args()
+
+    header = read_header(args.model)
+    if header is None:
+        raise SystemExit("Offline and the model is not downloaded yet")
+    print(f"{header.architecture}, {header.get('{arch}.block_count')} layers, "
+          f"embedding {header.get('{arch}.embedding_length')}, "
+          f"{quantization(args.model, header) or 'unknown quantization'}, "
+          f"{gib(header.file_size)} of weights")
+    available = int(args.available_gib * 1024 ** 3) if args.available_gib \
+        else None
+    try:
+        result = plan(args.model, args.context_length, args.slots, available,
+                      args.mode)
+    except ModelTooLarge as e:
+        raise SystemExit(str(e))
+    print(f"{result['url']} with contexts of up to {result['context_length']} tokens: {result['note']}")  # nopep8
+
+
+if __name__ == "__main__":
+    main()
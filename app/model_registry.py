@@ -0,0 +1,213 @@
+"""
+Registry of resident models with least-recently-used eviction.
+
+The power-user web UI keeps several LLMs and Stable Diffusion pipelines in
+memory at once, up to a RAM budget. Each entry remembers how it was loaded,
+so a model evicted to make room is loaded again transparently the next time
+it is requested.
+
+Requests hold a model with `lease()`. A model evicted while leased keeps
+running those requests and is only released after the last one ends; a
+request for it meanwhile takes it back instead of loading a second copy.
+So loading a new model next to the old one and switching over never
+interrupts a generation. The budget covers resident models only: a
+draining model is on its way out and does not count against it, so memory
+use can briefly exceed the budget by the size of the draining models.
+"""
+
+import gc
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def physical_memory_bytes():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return 16 * 1024 ** 3
+
+
+def default_budget_bytes():
+    return int(physical_memory_bytes() * 0.75)
+
+
+def pipeline_size_bytes(pipeline):
+    import torch
+
+    size = 0
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelRegistry:
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes or default_budget_bytes()
+        self._lock = threading.RLock()
+        self._models = OrderedDict()
+        self._loaders = {}
+        self._load_locks = {}
+        self._leases = {}
+        # Evicted models that requests are still using.
+        self._draining = {}
+
+    def used_bytes(self):
+        """Size of the resident models, which the budget applies to."""
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+    def draining_bytes(self):
+        with self._lock:
+            return sum(size for _, size in self._draining.values())
+
+    def ids(self, prefix=""):
+        with self._lock:
+            return [i for i in self._loaders if i.startswith(prefix)]
+
+    def resident_ids(self, prefix=""):
+        with self._lock:
+            return [i for i in self._models if i.startswith(prefix)]
+
+    def draining_ids(self, prefix=""):
+        with self._lock:
+            return [i for i in self._draining if i.startswith(prefix)]
+
+    def resident_models(self, prefix=""):
+        """Resident models, without loading or reordering anything."""
+        with self._lock:
+            return [
+                model for model_id, (model, _) in self._models.items()
+                if model_id.startswith(prefix)
+            ]
+
+    def is_resident(self, model_id):
+        with self._lock:
+            return model_id in self._models
+
+    def set_budget(self, budget_bytes):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            evicted = self._evict_to_fit(0)
+        if evicted:
+            release_memory()
+        return evicted
+
+    def register(self, model_id, loader):
+        """Remember how to (re)load `model_id`.
+
+        `loader` returns `(model, size_bytes)`.
+        """
+        with self._lock:
+            self._loaders[model_id] = loader
+            self._load_locks.setdefault(model_id, threading.Lock())
+
+    def unregister(self, model_id):
+        with self._lock:
+            self._loaders.pop(model_id, None)
+            self._models.pop(model_id, None)
+
+    def get(self, model_id, lease=False):
+        """Return the model, loading it again if it was evicted.
+
+        With `lease` the caller must `release()` it when done.
+        """
+        with self._lock:
+            if model_id not in self._loaders:
+                raise KeyError(model_id)
+            load_lock = self._load_locks[model_id]
+        # Loads of different models may overlap; two requests for the same
+        # evicted model wait for a single load.
+        with load_lock:
+            with self._lock:
+                if model_id in self._draining:
+                    # Still in memory, so take it back.
+                    model, size = self._draining.pop(model_id)
+                elif model_id in self._models:
+                    self._models.move_to_end(model_id)
+                    if lease:
+                        self._leases[model_id] = self._leases.get(model_id, 0) + 1  # nopep8
+                    return self._models[model_id][0]
+                else:
+                    model = None
+                    loader = self._loaders[model_id]
+            if model is None:
+                model, size = loader()
+            return self.add(model_id, model, size, lease=lease)
+
+    @contextmanager
+    def lease(self, model_id):
+        """Use the model in a with block; eviction waits for it to end."""
+        model = self.get(model_id, lease=True)
+        try:
+            yield model
+        finally:
+            self.release(model_id)
+
+    def release(self, model_id):
+        with self._lock:
+            self._leases[model_id] -= 1
+            if self._leases[model_id]:
+                return
+            del self._leases[model_id]
+            drained = self._draining.pop(model_id, None)
+        if drained is not None:
+            del drained
+            print(f"Released after its last request: {model_id}")
+            release_memory()
+
+    def add(self, model_id, model, size_bytes, lease=False):
+        with self._lock:
+            self._models.pop(model_id, None)
+            self._draining.pop(model_id, None)
+            evicted = self._evict_to_fit(size_bytes)
+            self._models[model_id] = (model, size_bytes)
+            if lease:
+                self._leases[model_id] = self._leases.get(model_id, 0) + 1
+        if evicted:
+            print(f"Evicted to stay within the memory budget: {', '.join(evicted)}")  # nopep8
+            release_memory()
+        return model
+
+    def evict(self, model_id):
+        with self._lock:
+            entry = self._models.pop(model_id, None)
+            if entry is None:
+                return
+            if self._leases.get(model_id):
+                self._draining[model_id] = entry
+                return
+        del entry
+        release_memory()
+
+    def _evict_to_fit(self, size_bytes):
+        # Called with the lock held; the caller releases the memory after
+        # letting go of it, so other requests are not blocked meanwhile.
+        # Draining models are not counted (see used_bytes()): they go away
+        # on their own, and counting them would evict idle models that fit
+        # once they have.
+        evicted = []
+        while self._models and \
+                self.used_bytes() + size_bytes > self.budget_bytes:
+            model_id, entry = self._models.popitem(last=False)
+            if self._leases.get(model_id):
+                self._draining[model_id] = entry
+            else:
+                evicted.append(model_id)
+        if size_bytes > self.budget_bytes:
+            print(f"Warning: model needs {size_bytes / 1024 ** 3:.1f} GiB, more than the {self.budget_bytes / 1024 ** 3:.1f} GiB budget")  # nopep8
+        return evicted
+
+
+def release_memory():
+    # Models are freed once nothing references them any more.
+    gc.collect()
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
@@ -0,0 +1,335 @@
+"""
+Optional long-lived model server shared by the CLI scripts and the web UIs.
+
+The server keeps CTransformers LLMs and Stable Diffusion pipelines loaded
+and answers requests over a Unix socket, so repeated CLI runs skip the model
+load and several front-ends share one copy of the weights. Models are loaded
+on first use and keyed by path and config, so the Zephyr and Mistral scripts
+can use the same server.
+
+    python app/model_server.py --socket /tmp/character-factory.sock
+    python app/main-zephyr.py --model-server /tmp/character-factory.sock ...
+    CHARACTER_FACTORY_MODEL_SERVER=/tmp/character-factory.sock python app/main-zephyr-webui.py
+
+Requests and responses are single JSON lines. Heavy imports happen inside
+the server functions, so clients only pay for `socket` and `json`.
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import types
+
+import telemetry
+from llm_backend import LLMBackend
+
+MODEL_SERVER_SOCKET = os.environ.get("CHARACTER_FACTORY_MODEL_SERVER", "")
+DEFAULT_SOCKET = "/tmp/character-factory.sock"
+
+
+def send_request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("Model server closed the connection")
+    response = json.loads(line)
+    if "error" in response:
+        raise RuntimeError(f"Model server error: {response['error']}")
+    return response
+
+
+def stream_request(socket_path, request):
+    # The server answers with one line per chunk and a final "done" line.
+    # Closing this generator closes the connection, which stops the
+    # generation on the server.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            for line in f:
+                response = json.loads(line)
+                if "error" in response:
+                    raise RuntimeError(f"Model server error: {response['error']}")  # nopep8
+                if response.get("done"):
+                    if response.get("telemetry"):
+                        telemetry.remember(response["telemetry"])
+                    return
+                yield response["text"]
+    raise ConnectionError("Model server closed the connection")
+
+
+class RemoteLLM(LLMBackend):
+    """Forwards `invoke`, `stream` and `invalidate` to the model server."""
+
+    def __init__(self, socket_path, model, model_type, config):
+        self.socket_path = socket_path
+        self.model = os.path.abspath(model)
+        self.model_type = model_type
+        self.config = config
+
+    def invoke(self, prompt, stop=None, prefix_key="default"):
+        response = send_request(self.socket_path, {
+            "method": "invoke",
+            "model": self.model,
+            "model_type": self.model_type,
+            "config": self.config,
+            "prompt": prompt,
+            "stop": stop,
+            "prefix_key": prefix_key,
+        })
+        if response.get("telemetry"):
+            # The server logged it; the summary of this process shows it.
+            telemetry.remember(response["telemetry"])
+        return response["text"]
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        return stream_request(self.socket_path, {
+            "method": "stream",
+            "model": self.model,
+            "model_type": self.model_type,
+            "config": self.config,
+            "prompt": prompt,
+            "stop": stop,
+            "prefix_key": prefix_key,
+        })
+
+    def invalidate(self, key=None):
+        send_request(self.socket_path, {
+            "method": "invalidate",
+            "model": self.model,
+            "model_type": self.model_type,
+            "config": self.config,
+            "prefix_key": key,
+        })
+
+
+class RemoteDiffusionPipeline:
+    """Stands in for the `sd` global of the web UIs.
+
+    `safety_checker` is only used as a flag, so `sd_filter()` keeps working.
+    """
+
+    def __init__(self, socket_path, model):
+        self.socket_path = socket_path
+        self.model = os.path.abspath(model) if os.path.exists(model) else model
+        self.safety_checker = True
+        self.requires_safety_checker = True
+
+    def __call__(self, prompt, negative_prompt=None, width=512, height=512,
+                 seed=None, num_inference_steps=None):
+        from PIL import Image
+
+        response = send_request(self.socket_path, {
+            "method": "generate_image",
+            "model": self.model,
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "width": width,
+            "height": height,
+            "seed": seed,
+            "num_inference_steps": num_inference_steps,
+            "nsfw_filter": bool(self.safety_checker),
+        })
+        image = Image.open(io.BytesIO(base64.b64decode(response["image"])))
+        return types.SimpleNamespace(images=[image])
+
+
+def new_record(before):
+    # The record of the generation that just ran in this thread, if any.
+    entry = telemetry.last_record()
+    return entry if entry is not before else None
+
+
+class LoadedModels:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.llms = {}
+        self.pipelines = {}
+
+    def get(self, cache, key, loader):
+        # One lock per model: loading and generation are not thread-safe,
+        # but different models may run side by side.
+        with self.lock:
+            if key not in cache:
+                cache[key] = {"lock": threading.Lock(), "model": None}
+            entry = cache[key]
+        with entry["lock"]:
+            if entry["model"] is None:
+                print(f"Loading {key[0]}...")
+                entry["model"] = loader()
+        return entry
+
+    def llm(self, request):
+        import torch
+
+        from llm_tuning import apply_tuning
+        from prefix_cache import PrefixCachedLLM
+
+        config = dict(request["config"])
+        if "gpu_layers" not in config:
+            gpu_layers = 0
+            if torch.cuda.is_available() or torch.backends.mps.is_available():
+                gpu_layers = 110
+            config["gpu_layers"] = gpu_layers
+        key = (
+            request["model"],
+            request["model_type"],
+            json.dumps(config, sort_keys=True),
+        )
+        return self.get(self.llms, key, lambda: PrefixCachedLLM(
+            request["model"],
+            request["model_type"],
+            apply_tuning(config, request["model"], config["gpu_layers"]),
+        ))
+
+    def pipeline(self, model):
+        from sd_loading import load_pipeline
+
+        def load():
+            pipeline, _ = load_pipeline(model)
+            pipeline.default_safety_checker = pipeline.safety_checker
+            return pipeline
+
+        return self.get(self.pipelines, (model,), load)
+
+    def invoke(self, request):
+        # PrefixCachedLLM locks each of its slots, so requests for different
+        # prompt templates can run side by side.
+        entry = self.llm(request)
+        before = telemetry.last_record()
+        text = entry["model"].invoke(
+            request["prompt"],
+            stop=request.get("stop"),
+            prefix_key=request.get("prefix_key") or "default",
+        )
+        return {"text": text, "telemetry": new_record(before)}
+
+    def stream(self, request):
+        entry = self.llm(request)
+        return entry["model"].stream(
+            request["prompt"],
+            stop=request.get("stop"),
+            prefix_key=request.get("prefix_key") or "default",
+        )
+
+    def invalidate(self, request):
+        self.llm(request)["model"].invalidate(request.get("prefix_key"))
+        return {}
+
+    def generate_image(self, request):
+        import torch
+
+        entry = self.pipeline(request["model"])
+        generator = None
+        if request.get("seed") is not None:
+            generator = torch.Generator().manual_seed(request["seed"])
+        kwargs = {}
+        if request.get("num_inference_steps"):
+            kwargs["num_inference_steps"] = request["num_inference_steps"]
+        with entry["lock"]:
+            pipeline = entry["model"]
+            if request.get("nsfw_filter", True):
+                pipeline.safety_checker = pipeline.default_safety_checker
+            else:
+                pipeline.safety_checker = None
+            image = pipeline(
+                request["prompt"],
+                negative_prompt=request.get("negative_prompt"),
+                width=request.get("width", 512),
+                height=request.get("height", 512),
+                generator=generator,
+                **kwargs,
+            ).images[0]
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return {"image": base64.b64encode(buffer.getvalue()).decode()}
+
+    def status(self, request):
+        return {
+            "llms": [key[0] for key in self.llms],
+            "pipelines": [key[0] for key in self.pipelines],
+        }
+
+    def handle(self, request):
+        method = request.get("method")
+        if method not in ("invoke", "invalidate", "generate_image", "status"):
+            raise ValueError(f"Unknown method: {method}")
+        return getattr(self, method)(request)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            if request.get("method") == "stream":
+                self.handle_stream(request)
+                continue
+            try:
+                response = self.server.models.handle(request)
+            except Exception as e:
+                print(f"Error while handling request: {e}")
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    def handle_stream(self, request):
+        chunks = None
+        before = telemetry.last_record()
+        try:
+            chunks = self.server.models.stream(request)
+            for text in chunks:
+                self.wfile.write(json.dumps({"text": text}).encode() + b"\n")
+                self.wfile.flush()
+            response = {"done": True, "telemetry": new_record(before)}
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; closing the generator below stops it.
+            return
+        except Exception as e:
+            print(f"Error while handling request: {e}")
+            response = {"error": str(e)}
+        finally:
+            if chunks is not None:
+                chunks.close()
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, RequestHandler)
+        self.models = LoadedModels()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep Character Factory models loaded and serve them over a Unix socket"  # nopep8
+    )
+    parser.add_argument(
+        "--socket",
+        default=MODEL_SERVER_SOCKET or DEFAULT_SOCKET,
+        help=f"Path of the Unix socket (default: {DEFAULT_SOCKET})",
+    )
+    args = parser.parse_args()
+    server = ModelServer(args.socket)
+    print(f"Model server listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
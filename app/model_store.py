@@ -0,0 +1,319 @@
+"""
+Content-addressed store for downloaded model files.
+
+Every model lives once in `models/blobs/<sha256>`; the familiar names such
+as `models/zephyr-7b-beta.Q4_K_M.gguf` are hard links to those blobs, so the
+scripts can keep passing plain paths to CTransformers and sdkit. The
+manifest `models/manifest.json` records size, hash, mtime and the source
+URLs of every blob.
+
+At startup a model is checked against the manifest using only its size and
+mtime. A full streamed hash runs when those disagree, when an unknown file is
+adopted, or on demand:
+
+    python app/model_store.py verify --full
+
+With CHARACTER_FACTORY_OFFLINE=1 (or `--offline` in the command line scripts)
+models are resolved from the `models` folder and the Hugging Face cache only,
+without a single network request; a missing model raises
+`OfflineModelMissing` straight away instead of waiting for timeouts.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import requests
+
+from downloader import download_file, probe
+
+MODELS_FOLDER = "models"
+MANIFEST_NAME = "manifest.json"
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+OFFLINE = os.environ.get("CHARACTER_FACTORY_OFFLINE", "") not in ("", "0")
+
+
+class OfflineModelMissing(FileNotFoundError):
+    pass
+
+
+def enable_offline():
+    """Switch this process to offline mode.
+
+    Call it before diffusers, transformers or sdkit are imported; they read
+    the offline switches when they are first imported.
+    """
+    global OFFLINE
+    OFFLINE = True
+    os.environ["CHARACTER_FACTORY_OFFLINE"] = "1"
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    os.environ["HF_HUB_DISABLE_TELEMETRY"] = "1"
+    os.environ["GRADIO_ANALYTICS_ENABLED"] = "False"
+    if "huggingface_hub" in sys.modules:
+        sys.modules["huggingface_hub"].constants.HF_HUB_OFFLINE = True
+
+
+if OFFLINE:
+    enable_offline()
+
+
+def manifest_path(folder):
+    return os.path.join(folder, MANIFEST_NAME)
+
+
+def blob_path(folder, digest):
+    return os.path.join(folder, "blobs", digest)
+
+
+def load_manifest(folder=MODELS_FOLDER):
+    try:
+        with open(manifest_path(folder), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest.setdefault("blobs", {})
+    manifest.setdefault("urls", {})
+    return manifest
+
+
+def save_manifest(manifest, folder=MODELS_FOLDER):
+    # Merge with whatever another process wrote meanwhile, then replace the
+    # file atomically so readers never see a half written manifest.
+    current = load_manifest(folder)
+    current["blobs"].update(manifest["blobs"])
+    current["urls"].update(manifest["urls"])
+    for digest in manifest.get("removed", []):
+        current["blobs"].pop(digest, None)
+        current["urls"] = {
+            url: d for url, d in current["urls"].items() if d != digest
+        }
+    tmp_path = manifest_path(folder) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path(folder))
+    manifest.update(current)
+    manifest.pop("removed", None)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def model_digest(path, folder=MODELS_FOLDER):
+    # Stored models are links to their blob, whose name is the hash.
+    for digest in load_manifest(folder)["blobs"]:
+        blob = blob_path(folder, digest)
+        if os.path.exists(blob) and os.path.samefile(blob, path):
+            return digest
+    return sha256_file(path)
+
+
+def quick_verify(folder, digest, entry):
+    try:
+        stat = os.stat(blob_path(folder, digest))
+    except OSError:
+        return False
+    return stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]
+
+
+def full_verify(folder, digest, manifest):
+    path = blob_path(folder, digest)
+    if not os.path.exists(path) or sha256_file(path) != digest:
+        return False
+    # Content is intact, only the mtime moved (e.g. the file was copied).
+    manifest["blobs"][digest]["mtime"] = os.stat(path).st_mtime_ns
+    save_manifest(manifest, folder)
+    return True
+
+
+def verify_model(folder, digest, manifest, full=False):
+    entry = manifest["blobs"].get(digest)
+    if entry is None:
+        return False
+    if not full and quick_verify(folder, digest, entry):
+        return True
+    return full_verify(folder, digest, manifest)
+
+
+def link(source, destination):
+    if os.path.lexists(destination):
+        if os.path.exists(destination) and os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(source), destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
+
+def remote_metadata(url):
+    # Hugging Face announces the sha256 of LFS files without redirecting,
+    # which lets us skip downloads of content we already store.
+    try:
+        response = requests.head(url, allow_redirects=False, timeout=30)
+        sha256 = response.headers.get("x-linked-etag", "").strip('"')
+        size = response.headers.get("x-linked-size")
+        if len(sha256) == 64 and size and size.isdigit():
+            return int(size), sha256
+        size, _, _ = probe(url)
+        return size, None
+    except requests.RequestException:
+        return None, None
+
+
+def add_blob(folder, path, url, manifest, digest=None):
+    digest = digest or sha256_file(path)
+    destination = blob_path(folder, digest)
+    if digest in manifest["blobs"] and os.path.exists(destination):
+        if not os.path.samefile(path, destination):
+            os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(path, destination)
+    entry = manifest["blobs"].setdefault(digest, {"urls": []})
+    stat = os.stat(destination)
+    entry.update(size=stat.st_size, sha256=digest, mtime=stat.st_mtime_ns)
+    if url not in entry["urls"]:
+        entry["urls"].append(url)
+    manifest["urls"][url] = digest
+    save_manifest(manifest, folder)
+    return digest
+
+
+def remove_blob(folder, digest, manifest):
+    # Drop the blob together with every name linked to it, otherwise a
+    # damaged link could later be adopted as a legacy file.
+    blob = blob_path(folder, digest)
+    if os.path.exists(blob):
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and os.path.samefile(path, blob):
+                os.remove(path)
+        os.remove(blob)
+    manifest.setdefault("removed", []).append(digest)
+    save_manifest(manifest, folder)
+
+
+def ensure_model(url, filename, folder=MODELS_FOLDER, progress=None):
+    """Return `folder/filename`, downloading or repairing it if needed."""
+    os.makedirs(os.path.join(folder, "blobs"), exist_ok=True)
+    manifest = load_manifest(folder)
+    path = os.path.join(folder, filename)
+
+    digest = manifest["urls"].get(url)
+    if digest and verify_model(folder, digest, manifest):
+        link(blob_path(folder, digest), path)
+        return path
+
+    if OFFLINE:
+        if os.path.exists(path) and not digest:
+            # Copied in by hand; nothing to compare it with offline.
+            print(f"Hashing existing model {path} (one-time)...")
+            actual = sha256_file(path)
+            add_blob(folder, path, url, manifest, actual)
+            link(blob_path(folder, actual), path)
+            return path
+        problem = "failed verification" if digest else "is missing"
+        raise OfflineModelMissing(
+            f"{path} {problem} and offline mode is on. Copy the file there, "
+            f"or run once without offline mode to download it from {url}"
+        )
+
+    expected_size, expected_sha256 = remote_metadata(url)
+    if expected_sha256 and expected_sha256 in manifest["blobs"] and \
+            verify_model(folder, expected_sha256, manifest):
+        print(f"{filename} is already stored as {expected_sha256[:12]}, reusing it")  # nopep8
+        add_blob(folder, blob_path(folder, expected_sha256), url, manifest,
+                 expected_sha256)
+        link(blob_path(folder, expected_sha256), path)
+        return path
+
+    if digest:
+        print(f"{filename} failed verification, downloading it again")
+        remove_blob(folder, digest, manifest)
+
+    if os.path.exists(path) and not os.path.islink(path):
+        # A file from before the store existed. Adopt it unless it is
+        # obviously truncated.
+        size = os.path.getsize(path)
+        if expected_size is None:
+            # The server could not be asked, so nothing shows whether the
+            # file is complete. Use it without storing it as verified; the
+            # next start checks it again.
+            print(f"Could not get the size of {url}; using {path} without verifying it")  # nopep8
+            return path
+        if size == expected_size:
+            print(f"Hashing existing model {path} (one-time)...")
+            actual = sha256_file(path)
+            if expected_sha256 is None or actual == expected_sha256:
+                add_blob(folder, path, url, manifest, actual)
+                link(blob_path(folder, actual), path)
+                return path
+        print(f"{path} is incomplete or corrupted, downloading it again")
+        os.remove(path)
+
+    download_path = os.path.join(folder, "blobs", filename + ".download")
+    print(f"Downloading {filename} from: {url}")
+    download_file(url, download_path, progress=progress)
+    digest = sha256_file(download_path)
+    if expected_sha256 and digest != expected_sha256:
+        os.remove(download_path)
+        raise IOError(f"Hash mismatch for {url}: expected {expected_sha256}, got {digest}")  # nopep8
+    add_blob(folder, download_path, url, manifest, digest)
+    link(blob_path(folder, digest), path)
+    return path
+
+
+def resolve_pretrained(model_id):
+    """Return what to pass to `from_pretrained` for a Hugging Face model id.
+
+    Online this is the id itself. Offline it is the local directory or the
+    cached snapshot, so loading never asks the hub for anything.
+    """
+    if not OFFLINE or os.path.exists(model_id):
+        return model_id
+    from huggingface_hub import snapshot_download
+
+    try:
+        return snapshot_download(model_id, local_files_only=True)
+    except Exception:
+        raise OfflineModelMissing(
+            f"{model_id} is not in the Hugging Face cache and offline mode is "
+            "on. Pass a local model directory, or run once without offline "
+            "mode to download it"
+        ) from None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the model store")
+    parser.add_argument("command", choices=["list", "verify"])
+    parser.add_argument("--folder", default=MODELS_FOLDER)
+    parser.add_argument(
+        "--full", action="store_true", help="hash every blob instead of comparing size and mtime"  # nopep8
+    )
+    args = parser.parse_args()
+    manifest = load_manifest(args.folder)
+    failed = False
+    for digest, entry in sorted(manifest["blobs"].items()):
+        line = f"{digest[:12]}  {entry['size'] / 1024 ** 3:6.2f} GiB  {', '.join(entry['urls'])}"  # nopep8
+        if args.command == "verify":
+            ok = verify_model(args.folder, digest, manifest, full=args.full)
+            failed = failed or not ok
+            line = ("OK      " if ok else "FAILED  ") + line
+        print(line)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,184 @@
+"""
+LLM backend for OpenAI-compatible completion servers.
+
+Points the factory at an inference server on another machine, e.g. the
+llama.cpp server, vLLM or text-generation-webui's OpenAI extension:
+
+    python app/main-zephyr.py --llm-backend openai --llm-url http://gpu-box:8000/v1
+
+Requests go to `<url>/completions` with `stream: true` over a pool of
+keep-alive connections. At most `max_connections` requests run at the same
+time; further requests wait up to `queue_timeout` seconds for a free
+connection. Connecting times out after `connect_timeout` seconds, and a
+generation fails when no chunk arrives for `read_timeout` seconds.
+
+The prompts are sent unchanged, so they keep the few-shot format of the
+model the script was written for (Zephyr or Mistral). `top_k` and
+`repetition_penalty` are sent as well; local servers understand them.
+CHARACTER_FACTORY_LLM_URL and CHARACTER_FACTORY_LLM_API_KEY set the default
+URL and a bearer token.
+"""
+
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import generation_profiles
+import telemetry
+from llm_backend import LLMBackend
+
+DEFAULT_URL = os.environ.get("CHARACTER_FACTORY_LLM_URL", "http://localhost:8000/v1")  # nopep8
+API_KEY = os.environ.get("CHARACTER_FACTORY_LLM_API_KEY", "")
+MAX_CONNECTIONS = 4
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+QUEUE_TIMEOUT = 300
+
+
+class OpenAICompatibleLLM(LLMBackend):
+    def __init__(self, base_url, model, config,
+                 max_connections=MAX_CONNECTIONS, api_key=API_KEY,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 queue_timeout=QUEUE_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.config = config
+        self.max_connections = max_connections
+        self.timeout = (connect_timeout, read_timeout)
+        self.queue_timeout = queue_timeout
+        self.session = requests.Session()
+        # pool_block keeps the pool at max_connections instead of opening
+        # throwaway connections beyond it.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections,
+                              pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self._requests = threading.BoundedSemaphore(max_connections)
+        # Ask the server now, so a wrong URL fails at load time.
+        self.model = model or self.models()[0]
+
+    def models(self):
+        """Return the ids of the models the server offers."""
+        try:
+            response = self.session.get(f"{self.base_url}/models",
+                                        timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise RuntimeError(f"LLM server {self.base_url} is not reachable: {e}")  # nopep8
+        models = [model["id"] for model in response.json().get("data", [])]
+        if not models:
+            raise RuntimeError(f"LLM server {self.base_url} offers no models")
+        return models
+
+    def _body(self, prompt, stop, max_tokens):
+        body = {
+            "model": self.model,
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": self.config.get("temperature", 0.8),
+            "top_p": self.config.get("top_p", 0.95),
+            "top_k": self.config.get("top_k", 40),
+            "repetition_penalty": self.config.get("repetition_penalty", 1.1),
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        if stop:
+            body["stop"] = stop
+        if self.config.get("seed", -1) >= 0:
+            body["seed"] = self.config["seed"]
+        return body
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        """Yield the generated text in chunks as they arrive.
+
+        Applies the field's generation profile like `PrefixCachedLLM`, and
+        checks the stop words here as well, since some servers only accept
+        a few of them.
+        """
+        limits = generation_profiles.profile(prefix_key)
+        stop = self.config.get("stop") if stop is None else stop
+        if limits.get("stop"):
+            stop = generation_profiles.stop_list(prefix_key, stop)
+        stop = stop or []
+        body = self._body(
+            prompt, stop, limits.get("max_new_tokens")
+            or self.config.get("max_new_tokens", 256),
+        )
+        if not self._requests.acquire(timeout=self.queue_timeout):
+            raise RuntimeError(f"All {self.max_connections} connections to {self.base_url} stayed busy for {self.queue_timeout}s")  # nopep8
+        started = time.perf_counter()
+        first_chunk = None
+        chunks = 0
+        usage = {}
+        # Everything received, and how much of it was passed on.
+        text = ""
+        sent = 0
+        try:
+            with self.session.post(f"{self.base_url}/completions", json=body,
+                                   stream=True, timeout=self.timeout) as response:  # nopep8
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        # Read to the end, so the connection can be reused.
+                        continue
+                    message = json.loads(data)
+                    usage = message.get("usage") or usage
+                    if not message.get("choices"):
+                        continue
+                    chunk = message["choices"][0].get("text") or ""
+                    if not chunk:
+                        continue
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                    chunks += 1
+                    text += chunk
+                    end = min((position for position in (
+                        text.find(s) for s in stop
+                    ) if position >= 0), default=None)
+                    cut = generation_profiles.cut_position(
+                        prefix_key, text[:end]
+                    )
+                    if cut is not None or end is not None:
+                        # Leaving the with block drops the connection,
+                        # which stops the generation on the server.
+                        cut = end if cut is None else cut
+                        if cut > sent:
+                            yield text[sent:cut]
+                        return
+                    # A stop word may be split across chunks; its start
+                    # must not reach the caller before that is known.
+                    ready = len(text) - generation_profiles.held_back(text, stop)  # nopep8
+                    if ready > sent:
+                        yield text[sent:ready]
+                        sent = ready
+                if sent < len(text):
+                    yield text[sent:]
+        except requests.Timeout as e:
+            raise RuntimeError(f"LLM server {self.base_url} timed out: {e}")
+        except requests.HTTPError as e:
+            raise RuntimeError(f"LLM server {self.base_url} failed: {e}: {e.response.text[:500]}")  # nopep8
+        except requests.RequestException as e:
+            raise RuntimeError(f"LLM server {self.base_url} failed: {e}")
+        finally:
+            self._requests.release()
+            finished = time.perf_counter()
+            prompt_eval_seconds = (first_chunk or finished) - started
+            generated = usage.get("completion_tokens", chunks)
+            self.last_timing = {
+                "prefix_key": prefix_key,
+                "generated_tokens": generated,
+                "seconds": finished - started,
+            }
+            telemetry.record_llm(
+                self.model, prefix_key, usage.get("prompt_tokens", 0), 0,
+                generated, prompt_eval_seconds,
+                finished - started - prompt_eval_seconds,
+            )
@@ -0,0 +1,205 @@
+"""
+Keep the evaluated few-shot prefix of every generation prompt.
+
+Each field of the power-user UI sends a long, fixed few-shot template followed
+by a short per-character request. A ctransformers model only keeps one
+evaluated context and reuses the part of a new prompt that matches it, so
+alternating between fields re-evaluates the whole template every time.
+
+`PrefixCachedLLM` keeps one context slot per template (the "name" prompt,
+the "summary" prompt, ...). Each slot is a separate ctransformers instance;
+the weights are memory-mapped, so extra slots cost their context buffers but
+not another copy of the model. A request in a slot evaluates only the tokens
+after the part shared with that slot's previous prompt. With more templates
+than slots, the least recently used slot is handed over.
+
+Edits in the Prompt Editor call `invalidate()`, which drops the slot's
+context before its next use. Without it the outcome would be the same, since
+only matching tokens are reused, but the stale state would linger.
+
+Each slot's context is sized to its prompts and grown when needed, up to
+the config's `context_length`; see `prompt_budget`.
+
+CHARACTER_FACTORY_PREFIX_SLOTS sets the number of slots; 0 disables reuse.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import generation_profiles
+import prompt_budget
+import telemetry
+from llm_backend import LLMBackend
+
+SLOTS = os.environ.get("CHARACTER_FACTORY_PREFIX_SLOTS")
+
+
+def default_slots(gpu_layers):
+    if SLOTS is not None:
+        return int(SLOTS)
+    # Every slot uploads its own copy of offloaded layers, so GPUs get one.
+    return 1 if gpu_layers else 7
+
+
+class PrefixCachedLLM(LLMBackend):
+    def __init__(self, model, model_type, config, slots=None):
+        self.model = model
+        self.model_type = model_type
+        self.config = config
+        self.slots = default_slots(config.get("gpu_layers", 0)) \
+            if slots is None else slots
+        # The largest context a slot may grow to.
+        self.max_context = config.get("context_length") or 2048
+        self._lock = threading.Lock()
+        self._instances = OrderedDict()
+        self._stale = set()
+        self.last_timing = None
+        # Load the first instance now, so a broken model fails at load time.
+        self._spare = [self._load()]
+
+    def _model(self, context_length):
+        from ctransformers import AutoModelForCausalLM
+
+        return AutoModelForCausalLM.from_pretrained(
+            self.model,
+            model_type=self.model_type,
+            **{**self.config, "context_length": context_length},
+        )
+
+    def _load(self):
+        context_length = self.max_context
+        if prompt_budget.DYNAMIC:
+            context_length = min(prompt_budget.INITIAL_CONTEXT, context_length)
+        return {
+            "llm": self._model(context_length),
+            "context_length": context_length,
+            "lock": threading.Lock(),
+        }
+
+    def _fit(self, instance, prompt, max_new_tokens, field):
+        """Trim `prompt` to the largest context and grow the slot's context
+        if it is too small for it. Returns the prompt and its tokens.
+        """
+        llm = instance["llm"]
+        tokens = llm.tokenize(prompt)
+        budget = max(self.max_context - max_new_tokens, self.max_context // 2)
+        if len(tokens) > budget:
+            prompt, dropped, truncated = prompt_budget.fit_prompt(
+                prompt, llm.tokenize, llm.detokenize, budget
+            )
+            print(f"Prompt ({field}) has {len(tokens)} tokens, more than the {budget} that fit: dropped {dropped} few-shot example(s){' and cut out its middle' if truncated else ''}")  # nopep8
+            tokens = llm.tokenize(prompt)
+        needed = prompt_budget.context_size(
+            len(tokens) + max_new_tokens, self.max_context
+        )
+        if needed > instance["context_length"]:
+            print(f"Growing the context ({field}) from {instance['context_length']} to {needed} tokens")  # nopep8
+            # Free the old context before creating the larger one.
+            instance["llm"] = llm = None
+            instance["llm"] = self._model(needed)
+            instance["context_length"] = needed
+        return prompt, tokens
+
+    def _slot(self, key):
+        with self._lock:
+            if key in self._instances:
+                self._instances.move_to_end(key)
+                instance = self._instances[key]
+                if key in self._stale:
+                    self._stale.discard(key)
+                    instance["reset"] = True
+                return instance
+            if self._spare:
+                instance = self._spare.pop()
+            elif len(self._instances) < max(self.slots, 1):
+                instance = None
+            else:
+                # Hand over the least recently used idle slot, so a request
+                # does not queue behind one that is still generating.
+                idle = [k for k, i in self._instances.items()
+                        if not i["lock"].locked()]
+                instance = self._instances.pop(
+                    idle[0] if idle else next(iter(self._instances))
+                )
+            if instance is None:
+                instance = self._load()
+            instance["reset"] = True
+            self._stale.discard(key)
+            self._instances[key] = instance
+            return instance
+
+    def tokenize(self, text):
+        with self._lock:
+            # A slot whose context is being grown has no model for a moment.
+            llm = next(i["llm"] for i in [*self._instances.values(), *self._spare]  # nopep8
+                       if i["llm"] is not None)
+        return llm.tokenize(text)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._stale.update([key] if key else list(self._instances))
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        """Yield the generated text in chunks as tokens arrive.
+
+        The generation profile of the field named by `prefix_key` limits
+        the tokens and adds stop rules. Closing the generator early stops
+        the generation.
+        """
+        field = prefix_key
+        limits = generation_profiles.profile(field)
+        if limits.get("stop"):
+            stop = generation_profiles.stop_list(
+                field, self.config.get("stop") if stop is None else stop
+            )
+        if self.slots == 0:
+            prefix_key = "default"
+        max_new_tokens = limits.get("max_new_tokens") \
+            or self.config.get("max_new_tokens", 256)
+        instance = self._slot(prefix_key)
+        with instance["lock"]:
+            prompt, tokens = self._fit(instance, prompt, max_new_tokens, field)
+            llm = instance["llm"]
+            if instance.pop("reset", False) or self.slots == 0:
+                llm._context.clear()
+            # Only tokens after the part shared with this slot's previous
+            # prompt are evaluated; the last one is left for the call below,
+            # which needs it to produce logits.
+            pending = llm.prepare_inputs_for_generation(tokens, reset=True)
+            started = time.perf_counter()
+            if len(pending) > 1:
+                llm.eval(pending[:-1])
+            seconds = time.perf_counter() - started
+            timing = self.last_timing = {
+                "prefix_key": prefix_key,
+                "prompt_tokens": len(tokens),
+                "reused_tokens": len(tokens) - len(pending),
+                "prompt_eval_seconds": seconds,
+            }
+            print(f"Prompt eval ({prefix_key}): {len(pending)} of {len(tokens)} tokens in {seconds:.2f}s")  # nopep8
+            text = ""
+            started = time.perf_counter()
+            try:
+                # Never generate past the end of the context.
+                for chunk in llm(prompt, stop=stop, stream=True, reset=True,
+                                 max_new_tokens=min(
+                                     max_new_tokens,
+                                     instance["context_length"] - len(tokens),
+                                 )):
+                    cut = generation_profiles.cut_position(field, text + chunk)
+                    if cut is not None:
+                        # Returning closes the generation as well.
+                        yield (text + chunk)[len(text):cut]
+                        return
+                    text += chunk
+                    yield chunk
+            finally:
+                timing["generated_tokens"] = len(llm._context) - len(tokens)
+                timing["generation_seconds"] = time.perf_counter() - started
+                telemetry.record_llm(
+                    self.model, field, len(tokens), timing["reused_tokens"],
+                    timing["generated_tokens"], seconds,
+                    timing["generation_seconds"],
+                )
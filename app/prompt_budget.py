@@ -0,0 +1,79 @@
+"""
+Context sizes and token budgets for the generation prompts.
+
+The configs set `context_length: 8192`, but most prompts are well under 2k
+tokens, and every context reserves its key/value memory for the full size.
+`context_length` is therefore treated as an upper bound: a context is
+created for the tokens it actually needs (prompt plus the field's
+`max_new_tokens`), rounded up to a power of two, and grown when a longer
+prompt arrives.
+
+A prompt that does not fit even in the upper bound (e.g. a long imported
+summary and personality spliced into the example messages prompt) is
+trimmed instead of overflowing the context: the oldest few-shot examples
+are dropped first, and only if that is not enough is the middle of the
+remaining prompt cut out, keeping its start (the instructions) and its end
+(the request and the assistant turn).
+
+CHARACTER_FACTORY_DYNAMIC_CONTEXT=0 creates every context with the full
+`context_length` again; the trimming still applies.
+"""
+
+import os
+import re
+
+DYNAMIC = os.environ.get("CHARACTER_FACTORY_DYNAMIC_CONTEXT", "1") != "0"
+MIN_CONTEXT = 1024
+# The first context is created before any prompt is known.
+INITIAL_CONTEXT = 2048
+
+# Start of a user turn in the Zephyr and Mistral prompt formats.
+USER_TURN = re.compile(r"(?:<s>)?\[INST\]|<\|user\|>")
+
+
+def context_size(needed, maximum, minimum=MIN_CONTEXT):
+    """Return the context length to create for `needed` tokens."""
+    size = minimum
+    while size < needed:
+        size *= 2
+    return min(size, maximum)
+
+
+def examples(prompt):
+    """Return the `(start, end)` span of every few-shot example.
+
+    An example runs from one user turn to the next. Text before the first
+    user turn (the system prompt) and the last user turn (the request) are
+    not examples.
+    """
+    starts = [match.start() for match in USER_TURN.finditer(prompt)]
+    return list(zip(starts, starts[1:]))
+
+
+def fit_prompt(prompt, tokenize, detokenize, budget):
+    """Return `(prompt, dropped_examples, truncated)` with `prompt` trimmed
+    to at most `budget` tokens.
+    """
+    if len(tokenize(prompt)) <= budget:
+        return prompt, 0, False
+    dropped = 0
+    spans = examples(prompt)
+    while spans:
+        start, end = spans[0]
+        prompt = prompt[:start] + prompt[end:]
+        dropped += 1
+        if len(tokenize(prompt)) <= budget:
+            return prompt, dropped, False
+        spans = examples(prompt)
+    # Decoding and encoding again may merge or split tokens at the cuts, so
+    # keep fewer tokens until the result fits.
+    tokens = tokenize(prompt)
+    keep = budget
+    while keep > 0:
+        head = keep // 4
+        prompt = detokenize(tokens[:head]) \
+            + detokenize(tokens[len(tokens) - (keep - head):])
+        if len(tokenize(prompt)) <= budget:
+            break
+        keep -= 8
+    return prompt, dropped, True
@@ -0,0 +1,204 @@
+"""
+Central scheduler for LLM requests from concurrent web UI sessions.
+
+Without it every click calls the shared model directly: requests wait for
+each other's context, so a 640-token example messages request blocks every
+other user's 24-token name. `ScheduledLLM` puts every request into one
+queue and a single decode thread advances the running generations one
+chunk at a time in turn, so new requests join between tokens instead of
+after whole generations (continuous batching at the iteration level; the
+in-process models evaluate one sequence per call, so each running
+generation keeps its own context slot of the `PrefixCachedLLM`).
+
+Up to `capacity` generations run at once, one per context slot, and long
+jobs leave one of them free for short ones such as the name. Waiting
+requests start shortest job first, by the field's `max_new_tokens`; the
+longer a request waits, the higher it moves up, so long jobs are not
+starved. `stats()` reports the queue depth and wait times.
+"""
+
+import threading
+import time
+from collections import deque
+
+import generation_profiles
+import telemetry
+from llm_backend import LLMBackend
+
+# A waiting request gains this many tokens of priority per second.
+AGING_TOKENS_PER_SECOND = 20
+# Jobs up to this many new tokens may use the slot kept for short jobs.
+SHORT_JOB_TOKENS = 128
+
+
+class Job:
+    def __init__(self, prompt, stop, prefix_key, cost):
+        self.prompt = prompt
+        self.stop = stop
+        self.prefix_key = prefix_key
+        self.cost = cost
+        self.submitted = time.monotonic()
+        self.chunks = deque()
+        self.done = False
+        self.error = None
+        self.cancelled = False
+
+    def priority(self, now):
+        return self.cost - (now - self.submitted) * AGING_TOKENS_PER_SECOND
+
+
+class ScheduledLLM(LLMBackend):
+    def __init__(self, llm, capacity=None):
+        self.llm = llm
+        # Each running generation holds a slot; more would wait for one
+        # while the decode thread waits for them.
+        self.capacity = capacity or max(getattr(llm, "slots", 1), 1)
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._running = []
+        self._waits = deque(maxlen=200)
+        self.completed = 0
+        self._thread = None
+
+    @property
+    def config(self):
+        return self.llm.config
+
+    @property
+    def last_timing(self):
+        return self.llm.last_timing
+
+    def invalidate(self, key=None):
+        self.llm.invalidate(key)
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text)
+
+    def cost(self, prefix_key):
+        return generation_profiles.profile(prefix_key).get("max_new_tokens") \
+            or (self.llm.config or {}).get("max_new_tokens", 256)
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        """Queue the request and yield its chunks as the scheduler runs it.
+
+        Closing the generator cancels the request.
+        """
+        job = Job(prompt, stop, prefix_key, self.cost(prefix_key))
+        with self._condition:
+            self._waiting.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        try:
+            while True:
+                with self._condition:
+                    while not job.chunks and not job.done:
+                        self._condition.wait()
+                    chunks = list(job.chunks)
+                    job.chunks.clear()
+                    done = job.done
+                yield from chunks
+                if done:
+                    break
+            if job.error is not None:
+                raise job.error
+        finally:
+            with self._condition:
+                job.cancelled = True
+                self._condition.notify_all()
+
+    def _admit(self, now):
+        # Called with the condition held.
+        running_keys = {job.prefix_key for job, _ in self._running}
+        long_jobs = sum(job.cost > SHORT_JOB_TOKENS for job, _ in self._running)
+        while len(self._running) < self.capacity:
+            # Two generations of the same template would need the same slot.
+            candidates = [
+                job for job in self._waiting
+                if job.prefix_key not in running_keys
+                and (job.cost <= SHORT_JOB_TOKENS
+                     or long_jobs < max(self.capacity - 1, 1))
+            ]
+            if not candidates:
+                return
+            job = min(candidates, key=lambda job: job.priority(now))
+            self._waiting.remove(job)
+            if job.cancelled:
+                continue
+            wait = now - job.submitted
+            self._waits.append(wait)
+            telemetry.record("llm_queue", field=job.prefix_key,
+                             wait_ms=round(wait * 1000, 1),
+                             waiting=len(self._waiting),
+                             running=len(self._running))
+            running_keys.add(job.prefix_key)
+            long_jobs += job.cost > SHORT_JOB_TOKENS
+            self._running.append((job, self.llm.stream(
+                job.prompt, stop=job.stop, prefix_key=job.prefix_key
+            )))
+
+    def _finish(self, entry, error=None):
+        job, chunks = entry
+        chunks.close()
+        with self._condition:
+            self._running.remove(entry)
+            job.done = True
+            job.error = error
+            self.completed += 1
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._waiting = [job for job in self._waiting
+                                 if not job.cancelled]
+                if not self._waiting and not self._running:
+                    # The next request starts a new thread; an idle one
+                    # would keep an evicted model in memory.
+                    self._thread = None
+                    return
+                self._admit(time.monotonic())
+                running = list(self._running)
+            # One step of every running generation, in turn.
+            for entry in running:
+                job, chunks = entry
+                if job.cancelled:
+                    self._finish(entry)
+                    continue
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    self._finish(entry)
+                except Exception as e:
+                    self._finish(entry, e)
+                else:
+                    with self._condition:
+                        job.chunks.append(chunk)
+                        self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            waits = sorted(self._waits)
+            stats = {
+                "waiting": len(self._waiting),
+                "running": len(self._running),
+                "capacity": self.capacity,
+                "completed": self.completed,
+            }
+        if waits:
+            stats["wait_p50"] = waits[len(waits) // 2]
+            stats["wait_p95"] = waits[min(len(waits) - 1, len(waits) * 95 // 100)]  # nopep8
+        return stats
+
+    def queue_status(self):
+        """Return the queue state as Markdown."""
+        stats = self.stats()
+        status = (
+            f"**LLM queue:** {stats['waiting']} waiting, {stats['running']} "
+            f"of {stats['capacity']} generating, {stats['completed']} done"
+        )
+        if "wait_p50" in stats:
+            status += (f"; wait p50 {stats['wait_p50']:.1f}s, "
+                       f"p95 {stats['wait_p95']:.1f}s")
+        return status + "\n\n"
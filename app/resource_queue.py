@@ -0,0 +1,148 @@
+"""
+Separate queues for the LLM and Stable Diffusion work of the web UIs.
+
+Gradio runs every event in one shared queue, so a slow avatar render on the
+CPU holds a worker that text requests could have used, and any number of
+users can start a render at the same time. Each resource gets its own
+`ResourceQueue` instead: at most `limit` requests use it at once, further
+requests wait in order of arrival, and a request that would make more than
+`max_queue` wait is turned away with `QueueFull`. Waiting requests can show
+their position.
+
+The limits come from the environment:
+
+- CHARACTER_FACTORY_LLM_CONCURRENCY (default 16): LLM requests passed on
+  at once. The LLM's own scheduler orders them by length, so this is higher
+  than the number of generations that actually run.
+- CHARACTER_FACTORY_LLM_QUEUE (default 64): LLM requests that may wait.
+- CHARACTER_FACTORY_SD_CONCURRENCY (default 1): images rendered at once.
+- CHARACTER_FACTORY_SD_QUEUE (default 8): image requests that may wait.
+"""
+
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# How often a waiting request reports its position, in seconds.
+POLL_SECONDS = 1.0
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class Ticket:
+    def __init__(self, queue):
+        self.queue = queue
+        self.started = False
+        self.released = False
+
+    def position(self):
+        """1 for the next request to start, 0 once started."""
+        return self.queue._position(self)
+
+    def wait(self, timeout=None):
+        """Wait until the request may use the resource; False on timeout."""
+        return self.queue._wait(self, timeout)
+
+    def release(self):
+        self.queue._release(self)
+
+
+class ResourceQueue:
+    def __init__(self, name, limit, max_queue):
+        self.name = name
+        self.limit = max(limit, 1)
+        self.max_queue = max_queue
+        self._condition = threading.Condition()
+        self._waiting = deque()
+        self.active = 0
+        self.rejected = 0
+
+    def join(self):
+        """Queue a request and return its `Ticket`; raise `QueueFull`."""
+        with self._condition:
+            ticket = Ticket(self)
+            if self.active < self.limit and not self._waiting:
+                ticket.started = True
+                self.active += 1
+                return ticket
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(
+                    f"The {self.name} queue is full ({self.max_queue} "
+                    "requests waiting), please try again later."
+                )
+            self._waiting.append(ticket)
+            return ticket
+
+    @contextmanager
+    def slot(self, on_wait=None):
+        """Use the resource in a with block.
+
+        While the request waits, `on_wait` is called with its position
+        whenever that changes.
+        """
+        ticket = self.join()
+        try:
+            reported = None
+            while not ticket.wait(POLL_SECONDS):
+                position = ticket.position()
+                if on_wait is not None and position != reported:
+                    on_wait(position)
+                    reported = position
+            yield ticket
+        finally:
+            ticket.release()
+
+    def _position(self, ticket):
+        with self._condition:
+            if ticket.started:
+                return 0
+            return self._waiting.index(ticket) + 1
+
+    def _start_waiting(self):
+        # Called with the condition held.
+        while self._waiting and self.active < self.limit:
+            self._waiting.popleft().started = True
+            self.active += 1
+        self._condition.notify_all()
+
+    def _wait(self, ticket, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: ticket.started, timeout)
+
+    def _release(self, ticket):
+        with self._condition:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.started:
+                self.active -= 1
+            else:
+                # Given up while waiting, e.g. by the Stop button.
+                self._waiting.remove(ticket)
+            self._start_waiting()
+
+    def status(self):
+        """Return the queue state as Markdown."""
+        with self._condition:
+            return (
+                f"**{self.name} requests:** {self.active} of {self.limit} "
+                "running, "
+                f"{len(self._waiting)} of {self.max_queue} waiting, "
+                f"{self.rejected} turned away  \n"
+            )
+
+
+llm_queue = ResourceQueue(
+    "LLM",
+    int(os.environ.get("CHARACTER_FACTORY_LLM_CONCURRENCY", "16")),
+    int(os.environ.get("CHARACTER_FACTORY_LLM_QUEUE", "64")),
+)
+sd_queue = ResourceQueue(
+    "Stable Diffusion",
+    int(os.environ.get("CHARACTER_FACTORY_SD_CONCURRENCY", "1")),
+    int(os.environ.get("CHARACTER_FACTORY_SD_QUEUE", "8")),
+)
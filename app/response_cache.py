@@ -0,0 +1,203 @@
+"""
+Optional on-disk cache of LLM responses.
+
+Batch jobs and demos ask for the same topic, name and template combinations
+over and over. With the cache enabled, a response is stored in SQLite under
+a hash of the model file's sha256, the fully rendered prompt, the sampling
+parameters and the stop list, and the same request is answered from disk
+instead of the LLM. Note that this makes repeated requests return the same
+text, where the LLM would sample a new one.
+
+Enable it with CHARACTER_FACTORY_LLM_CACHE=1 (stored in
+models/llm_cache.sqlite) or CHARACTER_FACTORY_LLM_CACHE=<path>, or with
+--llm-cache in the CLI scripts. The least recently used responses are
+dropped once the cache exceeds CHARACTER_FACTORY_LLM_CACHE_MB (256 MB).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import generation_profiles
+import telemetry
+from field_memo import SAMPLING_KEYS
+
+CACHE_SETTING = os.environ.get("CHARACTER_FACTORY_LLM_CACHE", "")
+CACHE_FILE = os.path.join("models", "llm_cache.sqlite")
+MAX_BYTES = int(os.environ.get("CHARACTER_FACTORY_LLM_CACHE_MB", "256")) * 1024 ** 2  # nopep8
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def cache_path(setting):
+    """Return the cache file for a setting, or None if it is disabled."""
+    if setting in (None, "", "0"):
+        return None
+    return CACHE_FILE if setting == "1" else setting
+
+
+def response_key(model_digest, prompt, config, stop, limits=None):
+    sampling = {k: v for k, v in (config or {}).items() if k in SAMPLING_KEYS}
+    if stop is not None:
+        sampling["stop"] = stop
+    # The field's generation profile overrides some of the config per call.
+    data = json.dumps([model_digest, prompt, sampling, limits or {}],
+                      sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Several processes (CLI runs, web UIs) may share the file.
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used "
+            "ON responses (last_used)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS counters "
+            "(name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self._db.commit()
+
+    def _count(self, name):
+        self._db.execute(
+            "INSERT INTO counters VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key):
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                self._count("misses")
+                return None
+            self.hits += 1
+            self._count("hits")
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = 0
+            for old_key, old_size in self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_used"
+            ).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self._db.execute(
+                    "DELETE FROM responses WHERE key = ?", (old_key,)
+                )
+                total -= old_size
+                evicted += 1
+            print(f"LLM response cache: evicted {evicted} least recently used response(s)")  # nopep8
+
+    def stats(self):
+        """Return this process's hits and misses, and the totals on disk."""
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            counters = dict(self._db.execute(
+                "SELECT name, value FROM counters"
+            ).fetchall())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": counters.get("hits", 0),
+            "total_misses": counters.get("misses", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+def open_cache(path):
+    # One connection per file, shared by every LLM of the process.
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(path)
+        return _caches[path]
+
+
+class CachedLLM:
+    """Answers `invoke` and `stream` from the cache, otherwise from `llm`.
+
+    Everything else (`config`, `invalidate`, ...) is passed through.
+    """
+
+    def __init__(self, llm, model_path, cache):
+        from model_store import model_digest
+
+        self.llm = llm
+        self.cache = cache
+        self.model_path = model_path
+        # Models behind an HTTP server are identified by URL and name.
+        self.model_digest = model_digest(model_path) \
+            if os.path.isfile(model_path) else model_path
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        key = response_key(
+            self.model_digest, prompt, getattr(self.llm, "config", None), stop,
+            generation_profiles.profile(prefix_key),
+        )
+        response = self.cache.get(key)
+        if response is not None:
+            print(f"LLM response cache hit ({self.cache.hits} hits, {self.cache.misses} misses)")  # nopep8
+            telemetry.record("llm", model=os.path.basename(self.model_path),
+                             field=prefix_key, cache_hit=True)
+            yield response
+            return
+        chunks = []
+        for chunk in self.llm.stream(prompt, stop=stop, prefix_key=prefix_key):
+            chunks.append(chunk)
+            yield chunk
+        # Only complete responses are stored, not stopped ones.
+        self.cache.put(key, "".join(chunks))
+
+    def invoke(self, prompt, stop=None, prefix_key="default"):
+        return "".join(self.stream(prompt, stop=stop, prefix_key=prefix_key))
+
+
+def with_cache(llm, model_path, setting=CACHE_SETTING):
+    """Wrap `llm` in a `CachedLLM` if the cache is enabled by `setting`."""
+    path = cache_path(setting)
+    if path is None:
+        return llm
+    print(f"Caching LLM responses in {path}")
+    return CachedLLM(llm, model_path, open_cache(path))
@@ -0,0 +1,97 @@
+"""
+Process-level cache of loaded sdkit contexts.
+
+Loading a Stable Diffusion checkpoint takes far longer than sampling one
+512x512 avatar, so the command line scripts keep loaded contexts here keyed
+by (model path, device, half_precision) instead of creating a fresh
+`sdkit.Context()` for every image. Call `evict_context()` to free one, or
+`evict_all()` to free everything.
+"""
+
+import os
+import sys
+import threading
+import time
+
+import telemetry
+
+_contexts = {}
+_lock = threading.Lock()
+
+
+def detect_device():
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda", True
+    if torch.backends.mps.is_available():
+        return "mps", True
+    # sdkit cannot run float16 on the macOS CPU backend.
+    return "cpu", sys.platform != "darwin"
+
+
+def get_context(model_path, device=None, half_precision=None):
+    """Return `(context, load_seconds)`; `load_seconds` is 0 on a cache hit."""
+    import sdkit
+    from sdkit.models import load_model
+
+    if device is None:
+        device, detected_half_precision = detect_device()
+        if half_precision is None:
+            half_precision = detected_half_precision
+    if half_precision is None:
+        half_precision = True
+    key = (model_path, device, half_precision)
+    with _lock:
+        context = _contexts.get(key)
+        if context is not None:
+            return context, 0.0
+        started = time.perf_counter()
+        context = sdkit.Context()
+        context.device = device
+        context.half_precision = half_precision
+        context.model_paths["stable-diffusion"] = model_path
+        print(f"Loading Stable Diffusion to {device}...")
+        load_model(context, "stable-diffusion")
+        _contexts[key] = context
+        seconds = time.perf_counter() - started
+        telemetry.record("sd_load", model=os.path.basename(model_path),
+                         device=device, load_ms=round(seconds * 1000, 1))
+        return context, seconds
+
+
+def evict_context(model_path, device=None, half_precision=None):
+    from sdkit.models import unload_model
+
+    with _lock:
+        for key in list(_contexts):
+            if key[0] != model_path:
+                continue
+            if device is not None and key[1] != device:
+                continue
+            if half_precision is not None and key[2] != half_precision:
+                continue
+            unload_model(_contexts.pop(key), "stable-diffusion")
+    _empty_device_cache()
+
+
+def evict_all():
+    from sdkit.models import unload_model
+
+    with _lock:
+        while _contexts:
+            _, context = _contexts.popitem()
+            unload_model(context, "stable-diffusion")
+    _empty_device_cache()
+
+
+def cached_contexts():
+    with _lock:
+        return list(_contexts)
+
+
+def _empty_device_cache():
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
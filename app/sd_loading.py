@@ -0,0 +1,119 @@
+"""
+Stable Diffusion pipeline loading shared by the web UIs and the model server.
+
+By default pipelines are loaded in low-memory mode: safetensors weights are
+memory-mapped and every tensor is created directly in the dtype the device
+will run (float16 on CUDA and Metal, float32 on the CPU), instead of building
+a full float16 copy first and converting it afterwards. Peak RSS before and
+after the load is printed so both modes can be compared:
+
+    CHARACTER_FACTORY_SD_LOW_MEMORY=0 python app/main-zephyr-webui.py
+"""
+
+import os
+import sys
+import time
+
+import model_store
+import telemetry
+
+LOW_MEMORY = os.environ.get("CHARACTER_FACTORY_SD_LOW_MEMORY", "1") != "0"
+
+
+def target_device():
+    """Return `(device, dtype)` the pipeline will actually run with."""
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda", torch.float16
+    if torch.backends.mps.is_available():
+        return "mps", torch.float16
+    return "cpu", torch.float32
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows.
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def format_rss(size):
+    return "unknown" if size is None else f"{size / 1024 ** 2:.0f} MiB"
+
+
+def load_legacy(model, device):
+    import torch
+    from diffusers import DiffusionPipeline, StableDiffusionPipeline
+
+    if os.path.isfile(model):
+        pipeline = StableDiffusionPipeline.from_single_file(
+            model,
+            torch_dtype=torch.float16,
+            local_files_only=model_store.OFFLINE,
+        )
+    else:
+        pipeline = DiffusionPipeline.from_pretrained(
+            model,
+            torch_dtype=torch.float16,
+            variant="fp16",
+            low_cpu_mem_usage=False,
+        )
+    if device != "cpu":
+        pipeline.to(device)
+    elif sys.platform == "darwin":
+        pipeline.to("cpu", torch.float32)
+    return pipeline
+
+
+def load_low_memory(model, device, dtype):
+    from diffusers import DiffusionPipeline, StableDiffusionPipeline
+
+    if os.path.isfile(model):
+        pipeline = StableDiffusionPipeline.from_single_file(
+            model,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            local_files_only=model_store.OFFLINE,
+        )
+    else:
+        # The fp16 files are half the size to map; they are cast tensor by
+        # tensor while loading when the device needs float32.
+        pipeline = DiffusionPipeline.from_pretrained(
+            model,
+            torch_dtype=dtype,
+            variant="fp16",
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+        )
+    if device != "cpu":
+        pipeline.to(device)
+    return pipeline
+
+
+def load_pipeline(model, low_memory=None):
+    """Load a Hugging Face model id or a local checkpoint file.
+
+    Returns `(pipeline, device)`.
+    """
+    if low_memory is None:
+        low_memory = LOW_MEMORY
+    model = model_store.resolve_pretrained(model)
+    device, dtype = target_device()
+    before = peak_rss_bytes()
+    mode = "low-memory" if low_memory else "legacy"
+    print(f"Loading Stable Diffusion model {model} to {device} ({mode} mode)...")  # nopep8
+    started = time.perf_counter()
+    if low_memory:
+        pipeline = load_low_memory(model, device, dtype)
+    else:
+        pipeline = load_legacy(model, device)
+    telemetry.record("sd_load", model=os.path.basename(model),
+                     device=device, mode=mode,
+                     load_ms=round((time.perf_counter() - started) * 1000, 1))
+    print(f"Stable Diffusion loaded; peak RSS {format_rss(before)} before, {format_rss(peak_rss_bytes())} after")  # nopep8
+    return pipeline, device
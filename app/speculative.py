@@ -0,0 +1,201 @@
+"""
+Speculative decoding with a small draft GGUF model.
+
+A small model (e.g. TinyLlama 1.1B) proposes a few tokens at a time and the
+main model checks all of them in one batched evaluation, keeping the ones
+it would have generated itself. Long fields like the greeting and example
+messages then need far fewer evaluations of the 7B model.
+
+Checking several proposed tokens at once needs the logits of every position,
+and ctransformers only returns those of the last token. The speculative mode
+therefore runs on llama-cpp-python, which is only needed when a draft model
+is configured:
+
+    pip install llama-cpp-python
+
+`SpeculativeLLM` can be used wherever a `PrefixCachedLLM` is used.
+"""
+
+import threading
+import time
+
+import generation_profiles
+import prompt_budget
+import telemetry
+from llm_backend import LLMBackend
+
+DRAFT_TOKENS = 8
+
+
+class DraftModel:
+    """Proposes tokens for llama-cpp-python's `draft_model` hook.
+
+    llama-cpp-python calls it with every token of the main model's context,
+    including the tokens it accepted from the previous proposal.
+    """
+
+    def __init__(self, model_path, n_ctx, n_threads, draft_tokens):
+        from llama_cpp import Llama
+
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx,
+                         n_threads=n_threads, n_gpu_layers=0, verbose=False)
+        self.draft_tokens = draft_tokens
+        self.proposed = 0
+        self.accepted = 0
+        self._proposal = None
+
+    def begin(self):
+        # A new request; the last proposal of the previous one is not judged.
+        self._proposal = None
+
+    def __call__(self, input_ids, **kwargs):
+        import numpy as np
+
+        input_ids = input_ids.tolist()
+        if self._proposal is not None:
+            start, proposal = self._proposal
+            accepted = 0
+            for proposed, kept in zip(proposal, input_ids[start:]):
+                if proposed != kept:
+                    break
+                accepted += 1
+            self.proposed += len(proposal)
+            self.accepted += accepted
+
+        # Keep the draft's own context for the part that is unchanged.
+        llm = self.llm
+        common = 0
+        limit = min(llm.n_tokens, len(input_ids) - 1)
+        while common < limit and llm.input_ids[common] == input_ids[common]:
+            common += 1
+        llm.n_tokens = common
+        llm.eval(input_ids[common:])
+
+        proposal = []
+        for _ in range(min(self.draft_tokens, llm.n_ctx() - llm.n_tokens)):
+            token = llm.sample(temp=0.0)
+            if token == llm.token_eos():
+                break
+            proposal.append(token)
+            llm.eval([token])
+        self._proposal = (len(input_ids), proposal)
+        return np.array(proposal, dtype=np.intc)
+
+
+class SpeculativeLLM(LLMBackend):
+    def __init__(self, model, draft_model, config, draft_tokens=DRAFT_TOKENS):
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise RuntimeError("Speculative decoding needs llama-cpp-python: pip install llama-cpp-python")  # nopep8
+
+        self.model = model
+        self.config = config
+        self.draft = None
+        if draft_model:
+            self.draft = DraftModel(
+                draft_model,
+                config.get("context_length", 2048),
+                config.get("threads"),
+                draft_tokens,
+            )
+        options = {}
+        if config.get("seed", -1) >= 0:
+            options["seed"] = config["seed"]
+        # The tuned batch_size is for ctransformers; llama.cpp keeps its own.
+        self.llm = Llama(
+            model_path=model,
+            n_ctx=config.get("context_length", 2048),
+            n_threads=config.get("threads"),
+            n_gpu_layers=config.get("gpu_layers", 0),
+            draft_model=self.draft,
+            verbose=False,
+            **options,
+        )
+        self._lock = threading.Lock()
+        self.last_timing = None
+
+    def invalidate(self, key=None):
+        # One context for all prompts; llama-cpp-python reuses whatever
+        # prefix matches the next prompt.
+        pass
+
+    def tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def detokenize(self, tokens):
+        return self.llm.detokenize(tokens).decode("utf-8", errors="ignore")
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        """Yield the generated text in chunks as tokens arrive.
+
+        Applies the field's generation profile like `PrefixCachedLLM`.
+        Closing the generator early stops the generation.
+        """
+        limits = generation_profiles.profile(prefix_key)
+        stop = self.config.get("stop") if stop is None else stop
+        if limits.get("stop"):
+            stop = generation_profiles.stop_list(prefix_key, stop)
+        max_new_tokens = limits.get("max_new_tokens") \
+            or self.config.get("max_new_tokens", 256)
+        # The context has a fixed size here; one token is left for the BOS.
+        n_ctx = self.llm.n_ctx() - 1
+        budget = max(n_ctx - max_new_tokens, n_ctx // 2)
+        prompt, dropped, truncated = prompt_budget.fit_prompt(
+            prompt, self.tokenize, self.detokenize, budget
+        )
+        if dropped or truncated:
+            print(f"Prompt ({prefix_key}) is longer than the {budget} tokens that fit: dropped {dropped} few-shot example(s){' and cut out its middle' if truncated else ''}")  # nopep8
+        prompt_tokens = len(self.tokenize(prompt))
+        with self._lock:
+            if self.draft:
+                self.draft.begin()
+                proposed, accepted = self.draft.proposed, self.draft.accepted
+            started = time.perf_counter()
+            # llama-cpp-python evaluates the prompt before the first chunk.
+            first_chunk = None
+            text = ""
+            try:
+                for chunk in self.llm.create_completion(
+                    prompt,
+                    max_tokens=min(max_new_tokens, n_ctx - prompt_tokens),
+                    temperature=self.config.get("temperature", 0.8),
+                    top_k=self.config.get("top_k", 40),
+                    top_p=self.config.get("top_p", 0.95),
+                    repeat_penalty=self.config.get("repetition_penalty", 1.1),
+                    stop=stop or [],
+                    stream=True,
+                ):
+                    chunk = chunk["choices"][0]["text"]
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                    cut = generation_profiles.cut_position(
+                        prefix_key, text + chunk
+                    )
+                    if cut is not None:
+                        previous, text = text, (text + chunk)[:cut]
+                        yield text[len(previous):]
+                        return
+                    text += chunk
+                    yield chunk
+            finally:
+                finished = time.perf_counter()
+                seconds = finished - started
+                timing = self.last_timing = {
+                    "prefix_key": prefix_key,
+                    "generated_tokens": len(self.tokenize(text)),
+                    "seconds": seconds,
+                }
+                prompt_eval_seconds = (first_chunk or finished) - started
+                telemetry.record_llm(
+                    self.model, prefix_key, prompt_tokens, 0,
+                    timing["generated_tokens"], prompt_eval_seconds,
+                    seconds - prompt_eval_seconds,
+                )
+                if self.draft:
+                    timing["draft_proposed"] = \
+                        self.draft.proposed - proposed
+                    timing["draft_accepted"] = \
+                        self.draft.accepted - accepted
+                    rate = timing["draft_accepted"] / max(timing["draft_proposed"], 1)  # nopep8
+                    print(f"Speculative decoding ({prefix_key}): {timing['draft_accepted']} of {timing['draft_proposed']} draft tokens accepted ({rate:.0%}), {timing['generated_tokens'] / max(seconds, 1e-9):.1f} tokens/s")  # nopep8
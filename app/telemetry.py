@@ -0,0 +1,199 @@
+"""
+Timing records of every LLM call and Stable Diffusion image.
+
+Each LLM generation records its field, prompt tokens (and how many of them
+were reused from the previous prompt), generated tokens, prompt evaluation
+and generation time and tokens per second. Each image records its steps,
+resolution and the time spent loading the model versus sampling. Loading a
+pipeline is recorded on its own as well.
+
+Records are appended as JSON lines to logs/telemetry.jsonl
+(CHARACTER_FACTORY_TELEMETRY=<path> for another file, 0 to write none) and
+kept in memory for `summary()`, which the web UIs show in a collapsible
+panel. An LLM is recorded by the process that runs it: with the model
+server the records go to the server's log, and the server sends them back
+so that the web UI's summary includes them.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+TELEMETRY_SETTING = os.environ.get("CHARACTER_FACTORY_TELEMETRY", "")
+TELEMETRY_FILE = os.path.join("logs", "telemetry.jsonl")
+# Used when a pipeline call does not set num_inference_steps.
+DIFFUSERS_STEPS = 50
+
+_records = deque(maxlen=10000)
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def log_path(setting=TELEMETRY_SETTING):
+    """Return the log file for a setting, or None if logging is off."""
+    if setting == "0":
+        return None
+    return TELEMETRY_FILE if setting in (None, "", "1") else setting
+
+
+def remember(entry):
+    """Keep a record for the summary without writing it to the log."""
+    with _lock:
+        _records.append(entry)
+    _local.last = entry
+
+
+def record(kind, **fields):
+    entry = {"time": round(time.time(), 3), "kind": kind, **fields}
+    remember(entry)
+    path = log_path()
+    if path is None:
+        return entry
+    try:
+        with _lock:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"Could not write telemetry to {path}: {e}")
+    return entry
+
+
+def last_record():
+    """Return the latest record made by this thread."""
+    return getattr(_local, "last", None)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+def record_llm(model, field, prompt_tokens, reused_tokens, generated_tokens,
+               prompt_eval_seconds, generation_seconds):
+    return record(
+        "llm",
+        model=os.path.basename(model),
+        field=field,
+        prompt_tokens=prompt_tokens,
+        reused_tokens=reused_tokens,
+        generated_tokens=generated_tokens,
+        prompt_eval_ms=_ms(prompt_eval_seconds),
+        generation_ms=_ms(generation_seconds),
+        tokens_per_second=round(
+            generated_tokens / generation_seconds, 2
+        ) if generation_seconds > 0 else None,
+    )
+
+
+def record_image(model, steps, size, load_seconds, sample_seconds):
+    width, height = size
+    return record(
+        "sd",
+        model=os.path.basename(str(model)),
+        steps=steps,
+        width=width,
+        height=height,
+        load_ms=_ms(load_seconds),
+        sample_ms=_ms(sample_seconds),
+    )
+
+
+def generate_image(pipeline, prompt, model, load_seconds=0.0, **kwargs):
+    """Call a diffusers pipeline (or `RemoteDiffusionPipeline`) and record it.
+
+    Returns the first image.
+    """
+    started = time.perf_counter()
+    image = pipeline(prompt, **kwargs).images[0]
+    record_image(
+        model,
+        kwargs.get("num_inference_steps") or DIFFUSERS_STEPS,
+        image.size,
+        load_seconds,
+        time.perf_counter() - started,
+    )
+    return image
+
+
+def records():
+    with _lock:
+        return list(_records)
+
+
+def summary():
+    """Return a Markdown summary of this session's records, costliest first."""
+    llm = {}
+    images = {}
+    loads = []
+    for entry in records():
+        if entry["kind"] == "llm":
+            row = llm.setdefault((entry["model"], entry["field"]), {
+                "calls": 0, "cached": 0, "prompt": 0, "reused": 0,
+                "generated": 0, "prompt_ms": 0.0, "generation_ms": 0.0,
+            })
+            row["calls"] += 1
+            if entry.get("cache_hit"):
+                row["cached"] += 1
+                continue
+            row["prompt"] += entry["prompt_tokens"]
+            row["reused"] += entry["reused_tokens"]
+            row["generated"] += entry["generated_tokens"]
+            row["prompt_ms"] += entry["prompt_eval_ms"]
+            row["generation_ms"] += entry["generation_ms"]
+        elif entry["kind"] == "sd":
+            key = (entry["model"], entry["steps"],
+                   f"{entry['width']}x{entry['height']}")
+            row = images.setdefault(key, {"images": 0, "load_ms": 0.0,
+                                          "sample_ms": 0.0})
+            row["images"] += 1
+            row["load_ms"] += entry["load_ms"]
+            row["sample_ms"] += entry["sample_ms"]
+        elif entry["kind"] == "sd_load":
+            loads.append(entry)
+    if not llm and not images and not loads:
+        return "Nothing generated yet."
+
+    lines = []
+    if llm:
+        lines += [
+            "| Model | Field | Calls | Cached | Prompt tokens | Reused | Generated | Prompt eval | Generation | Tokens/s |",  # nopep8
+            "|---|---|---:|---:|---:|---:|---:|---:|---:|---:|",
+        ]
+        for (model, field), row in sorted(
+            llm.items(),
+            key=lambda item: -(item[1]["prompt_ms"] + item[1]["generation_ms"]),  # nopep8
+        ):
+            evaluated = max(row["calls"] - row["cached"], 1)
+            speed = row["generated"] / (row["generation_ms"] / 1000) \
+                if row["generation_ms"] else 0
+            lines.append(
+                f"| {model} | {field} | {row['calls']} | {row['cached']} "
+                f"| {row['prompt'] / evaluated:.0f} "
+                f"| {row['reused'] / evaluated:.0f} "
+                f"| {row['generated'] / evaluated:.0f} "
+                f"| {row['prompt_ms'] / 1000:.1f}s "
+                f"| {row['generation_ms'] / 1000:.1f}s | {speed:.1f} |"
+            )
+        lines += ["", "Token counts are per call, times are totals.", ""]
+    if images:
+        lines += [
+            "| Model | Steps | Resolution | Images | Load | Sampling per image |",  # nopep8
+            "|---|---:|---|---:|---:|---:|",
+        ]
+        for (model, steps, resolution), row in sorted(
+            images.items(), key=lambda item: -item[1]["sample_ms"]
+        ):
+            lines.append(
+                f"| {model} | {steps} | {resolution} | {row['images']} "
+                f"| {row['load_ms'] / 1000:.1f}s "
+                f"| {row['sample_ms'] / row['images'] / 1000:.1f}s |"
+            )
+        lines.append("")
+    for entry in loads:
+        lines.append(f"Loaded {entry['model']} in {entry['load_ms'] / 1000:.1f}s  ")  # nopep8
+    path = log_path()
+    if path:
+        lines.append(f"\nEvery record is in `{path}`.")
+    return "\n".join(lines)
@@ -0,0 +1,99 @@
+"""
+Compare peak memory with fixed and with dynamically sized contexts.
+
+    python benchmarks/context_memory.py models/zephyr-7b-beta.Q4_K_M.gguf
+
+Generates every field of the power-user UI (one slot per template, as on
+the CPU) once with every context created at the full 8192 tokens and once
+with contexts sized to their prompts. The last request splices a very long
+summary into the example messages prompt, so it has to be trimmed. Each
+setting runs in its own process, because peak RSS only ever grows.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))  # nopep8
+
+FIELDS = [
+    ("name", "NAME_PROMPT"),
+    ("summary", "SUMMARY_PROMPT"),
+    ("personality", "PERSONALITY_PROMPT"),
+    ("scenario", "SCENARIO_PROMPT"),
+    ("greeting_message", "GREETING_MESSAGE_PROMPT"),
+    ("example_messages", "EXAMPLE_MESSAGES_PROMPT"),
+]
+LONG_SUMMARY = (
+    "She is a retired lighthouse keeper who collects shells, talks to the "
+    "gulls and remembers every ship that passed her island. "
+) * 400
+
+
+def measure(model, model_type, dynamic, threads):
+    import prompt_budget
+    from llm_tuning import default_prompt
+    from prefix_cache import PrefixCachedLLM
+    from sd_loading import peak_rss_bytes
+
+    prompt_budget.DYNAMIC = dynamic
+    config = {"max_new_tokens": 1024, "context_length": 8192,
+              "gpu_layers": 0}
+    if threads:
+        config["threads"] = threads
+    llm = PrefixCachedLLM(model, model_type, config, slots=len(FIELDS))
+    for key, name in FIELDS:
+        llm.invoke(
+            default_prompt(name)
+            + f"\n<|user|> Write the {key} of a character. Topic: fantasy. "
+            + "</s>\n<|assistant|> ",
+            prefix_key=key,
+        )
+    llm.invoke(
+        default_prompt("EXAMPLE_MESSAGES_PROMPT")
+        + "\n<|user|> Create a dialogue between {{user}} and {{char}}. "
+        + f"Character summary: {LONG_SUMMARY} </s>\n<|assistant|> ",
+        prefix_key="example_messages",
+    )
+    return {
+        "peak_rss": peak_rss_bytes(),
+        "contexts": {key: instance["context_length"]
+                     for key, instance in llm._instances.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model")
+    parser.add_argument("--model-type", default="llama")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--measure", choices=["fixed", "dynamic"],
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        result = measure(args.model, args.model_type,
+                         args.measure == "dynamic", args.threads)
+        print(json.dumps(result))
+        return
+
+    from sd_loading import format_rss
+
+    for mode in ("fixed", "dynamic"):
+        command = [sys.executable, __file__, args.model,
+                   "--model-type", args.model_type, "--measure", mode]
+        if args.threads:
+            command += ["--threads", str(args.threads)]
+        output = subprocess.run(command, check=True, capture_output=True,
+                                text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        contexts = ", ".join(f"{key} {size}"
+                             for key, size in result["contexts"].items())
+        print(f"{mode:8s} peak RSS {format_rss(result['peak_rss']):>10s}  "
+              f"contexts: {contexts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Compare the old single-connection download loop with app/downloader.py.
+
+A local HTTP server with Range support stands in for Hugging Face / Civitai.
+`--throttle` limits the bandwidth of every connection (in MB/s), which is how
+CDNs usually behave and is what parallel segments help with.
+
+    python benchmarks/download_benchmark.py --size-mb 256 --throttle 40
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+import downloader  # noqa: E402
+
+
+def make_handler(payload, throttle):
+    class RangeHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            start, end = 0, len(payload) - 1
+            range_header = self.headers.get("Range")
+            if range_header:
+                first, last = range_header.split("=", 1)[1].split("-")
+                start = int(first)
+                end = int(last) if last else end
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", f"bytes {start}-{end}/{len(payload)}"
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            view = memoryview(payload)[start:end + 1]
+            block = 256 * 1024
+            for offset in range(0, len(view), block):
+                self.wfile.write(view[offset:offset + block])
+                if throttle:
+                    time.sleep(block / (throttle * 1024 * 1024))
+
+    return RangeHandler
+
+
+def legacy_download(url, destination):
+    # The loop the scripts used before app/downloader.py.
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(destination, "wb") as out_file:
+            for data in response.iter_content(chunk_size=1024):
+                out_file.write(data)
+
+
+def interrupted_download(url, destination):
+    # Let the first segment fail, then resume from the .part file.
+    original = downloader.download_segment
+    state = {"failed": False}
+
+    def failing_segment(url, part_path, segment, lock, counter):
+        if not state["failed"]:
+            state["failed"] = True
+            raise IOError("simulated interruption")
+        return original(url, part_path, segment, lock, counter)
+
+    downloader.download_segment = failing_segment
+    try:
+        downloader.download_file(url, destination)
+    except IOError:
+        pass
+    finally:
+        downloader.download_segment = original
+    # The .part file is allocated at full size; the segment state says how
+    # much of it was downloaded before the interruption.
+    with open(destination + ".part.json", "r", encoding="utf-8") as f:
+        segments = json.load(f)["segments"]
+    resumed_from = sum(done for _, _, done in segments)
+    downloader.download_file(url, destination)
+    return resumed_from
+
+
+def timed(label, fn, size):
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<32} {elapsed:8.2f}s {size / elapsed / 1024 / 1024:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--throttle", type=float, default=20.0,
+                        help="per-connection bandwidth in MB/s, 0 = unlimited")
+    parser.add_argument("--connections", type=int, default=4)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_handler(payload, args.throttle)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/model.gguf"
+    workdir = tempfile.mkdtemp()
+    try:
+        legacy_path = os.path.join(workdir, "legacy.gguf")
+        timed("legacy loop (1 KiB chunks)",
+              lambda: legacy_download(url, legacy_path), len(payload))
+
+        ranged_path = os.path.join(workdir, "ranged.gguf")
+        timed(f"downloader ({args.connections} connections)",
+              lambda: downloader.download_file(
+                  url, ranged_path, connections=args.connections
+              ), len(payload))
+        with open(ranged_path, "rb") as f:
+            assert f.read() == payload, "downloaded file differs"
+
+        resumed_path = os.path.join(workdir, "resumed.gguf")
+        resumed_from = interrupted_download(url, resumed_path)
+        with open(resumed_path, "rb") as f:
+            assert f.read() == payload, "resumed file differs"
+        print(f"resume after interruption      ok, {resumed_from / 1024 / 1024:.1f} MB kept")  # nopep8
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
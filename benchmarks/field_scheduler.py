@@ -0,0 +1,62 @@
+"""
+Measure the wall-clock time per character with one and with several LLM workers.
+
+    python benchmarks/field_scheduler.py
+    python benchmarks/field_scheduler.py --script main-mistral.py --workers 3
+
+Runs the CLI with --no-avatar a few times per worker count, each run in a
+fresh interpreter, and reads the time the field scheduler reports for
+generating the text fields. Model loading is not included, and every run
+writes its character folder like a normal run. With one worker
+the fields are generated one after another, as before the scheduler.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+RESULT = re.compile(r"Generated (\d+) fields in ([\d.]+)s")
+
+
+def run(script, workers, topic, extra):
+    result = subprocess.run(
+        [sys.executable, os.path.join("app", script), "--no-avatar",
+         "--topic", topic, "--llm-workers", str(workers), *extra],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    match = RESULT.search(result.stdout)
+    if result.returncode != 0 or not match:
+        raise SystemExit(result.stderr.strip() or result.stdout.strip())
+    return float(match.group(2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", default="main-zephyr.py")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--topic", default="fantasy")
+    parser.add_argument("--model-server",
+                        help="run against a model server instead of loading the LLM in each run")  # nopep8
+    args = parser.parse_args()
+
+    extra = ["--model-server", args.model_server] if args.model_server else []
+    medians = {}
+    for workers in (1, args.workers):
+        seconds = [run(args.script, workers, args.topic, extra)
+                   for _ in range(args.runs)]
+        medians[workers] = statistics.median(seconds)
+        print(f"{workers} worker(s): median {medians[workers]:6.1f}s per character "  # nopep8
+              f"({', '.join(f'{s:.1f}' for s in seconds)})")
+    reduction = 1 - medians[args.workers] / medians[1]
+    print(f"wall-clock reduction: {reduction:.0%}")
+
+
+if __name__ == "__main__":
+    main()
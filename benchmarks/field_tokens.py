@@ -0,0 +1,109 @@
+"""
+Count the tokens generated per character field that end up thrown away.
+
+    python benchmarks/field_tokens.py
+    python benchmarks/field_tokens.py --script main-mistral.py --characters 5
+
+Generates a few characters with the CLI's own `create_character()`, once
+with the generation profiles turned off (every field may use the model's
+1024 new tokens and shared stop list) and once with them on. A field's
+wasted tokens are the tokens generated minus the tokens of the text that is
+kept after cleaning. Fields run one after another so every generation can be
+attributed to its field.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import generation_profiles  # noqa: E402
+
+FIELDS = ["name", "summary", "personality", "scenario", "greeting_message",
+          "example_messages", "avatar_prompt"]
+TOPICS = ["fantasy", "noir detective", "space pirate", "anime", "business"]
+
+
+class Recorder:
+    """Stands in for the script's `llm` and counts the generated tokens."""
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.generated = {}
+
+    def invoke(self, prompt, stop=None, prefix_key="default"):
+        output = self.llm.invoke(prompt, stop=stop, prefix_key=prefix_key)
+        self.generated[prefix_key] = self.llm.last_timing["generated_tokens"]
+        return output
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(
+        "script", os.path.join(ROOT, "app", name)
+    )
+    script = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(script)
+    return script
+
+
+def run(script, args, characters):
+    generated = dict.fromkeys(FIELDS, 0)
+    kept = dict.fromkeys(FIELDS, 0)
+    for i in range(characters):
+        args.topic = TOPICS[i % len(TOPICS)]
+        recorder = Recorder(script.llm)
+        script.llm = recorder
+        try:
+            character, avatar_prompt = script.create_character(args)
+        finally:
+            script.llm = recorder.llm
+        values = {field: getattr(character, field, None)
+                  for field in FIELDS[:-1]}
+        values["avatar_prompt"] = avatar_prompt
+        for field in FIELDS:
+            generated[field] += recorder.generated[field]
+            kept[field] += len(script.llm.tokenize(values[field] or ""))
+    return generated, kept
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", default="main-zephyr.py")
+    parser.add_argument("--characters", type=int, default=3)
+    options = parser.parse_args()
+
+    os.chdir(ROOT)
+    script = load_script(options.script)
+    sys.argv = [options.script, "--llm-workers", "1"]
+    args = script.parse_args()
+    script.prepare_llm(args)
+
+    results = {}
+    for label, enabled in (("before", False), ("after", True)):
+        generation_profiles.ENABLED = enabled
+        results[label] = run(script, args, options.characters)
+
+    print(f"tokens per character  {'generated':>20s}  {'wasted':>16s}")
+    print(f"{'field':18s}  {'before':>9s} {'after':>9s}  {'before':>7s} {'after':>7s}")  # nopep8
+    totals = {"before": [0, 0], "after": [0, 0]}
+    for field in FIELDS:
+        row = []
+        for label in ("before", "after"):
+            generated, kept = results[label]
+            totals[label][0] += generated[field]
+            totals[label][1] += generated[field] - kept[field]
+            row.append((generated[field] / options.characters,
+                        (generated[field] - kept[field]) / options.characters))
+        print(f"{field:18s}  {row[0][0]:9.0f} {row[1][0]:9.0f}  "
+              f"{row[0][1]:7.0f} {row[1][1]:7.0f}")
+    print(f"{'total':18s}  {totals['before'][0] / options.characters:9.0f} "
+          f"{totals['after'][0] / options.characters:9.0f}  "
+          f"{totals['before'][1] / options.characters:7.0f} "
+          f"{totals['after'][1] / options.characters:7.0f}")
+
+
+if __name__ == "__main__":
+    main()
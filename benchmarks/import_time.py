@@ -0,0 +1,87 @@
+"""
+Report the startup cost of the command line scripts with `python -X importtime`.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --script app/main-mistral.py --top 15
+    python benchmarks/import_time.py --max-ms 300   # fail on regressions
+
+Each script is started with `--help`, which must not pull in torch, sdkit,
+diffusers or langchain. The report lists wall time, the total import time and
+the most expensive top-level imports.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_SCRIPTS = ["app/main-zephyr.py", "app/main-mistral.py"]
+HEAVY_MODULES = ["torch", "sdkit", "diffusers", "langchain_community"]
+
+
+def parse_importtime(stderr):
+    # Lines look like: "import time:       312 |       1204 |   json"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        # Nested imports are indented by two spaces per level.
+        imports.append((name[1:].rstrip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure(script, runs):
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", script, "--help"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        )
+        wall_ms = (time.perf_counter() - started) * 1000
+        if result.returncode != 0:
+            raise SystemExit(f"{script} --help failed:\n{result.stderr}")
+        if best is None or wall_ms < best[0]:
+            best = (wall_ms, parse_importtime(result.stderr))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--script", action="append", dest="scripts")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--max-ms", type=float,
+                        help="exit with an error if wall time exceeds this")
+    args = parser.parse_args()
+
+    failed = False
+    for script in args.scripts or DEFAULT_SCRIPTS:
+        wall_ms, imports = measure(script, args.runs)
+        top_level = [i for i in imports if not i[0].startswith(" ")]
+        total_ms = sum(cumulative for _, _, cumulative in top_level) / 1000
+        print(f"{script} --help: {wall_ms:.0f} ms wall, {total_ms:.0f} ms importing")  # nopep8
+        for name, _, cumulative in sorted(
+            top_level, key=lambda i: i[2], reverse=True
+        )[:args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {name.strip()}")
+        heavy = sorted({
+            name.strip().split(".")[0] for name, _, _ in imports
+            if name.strip().split(".")[0] in HEAVY_MODULES
+        })
+        if heavy:
+            print(f"  heavy modules imported: {', '.join(heavy)}")
+            failed = True
+        if args.max_ms is not None and wall_ms > args.max_ms:
+            print(f"  slower than the {args.max_ms:.0f} ms budget")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,97 @@
+"""
+Measure how long model resolution takes at startup, online and offline.
+
+    python benchmarks/offline_startup.py
+    python benchmarks/offline_startup.py --unreachable   # simulate an air-gapped node
+
+Both models must already be downloaded. Each mode runs in a fresh
+interpreter that resolves the default GGUF model through the model store
+and the Stable Diffusion model the way `from_pretrained` does, without
+loading any weights, and counts the network connections it opened.
+`--unreachable` sends every HTTP(S) request of the child, the GGUF URL as
+well as the hub, to a non-routable proxy, which is what a node without
+network access sees.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+GGUF_URL = "https://huggingface.co/TheBloke/zephyr-7B-beta-GGUF/resolve/main/zephyr-7b-beta.Q4_K_M.gguf"  # nopep8
+SD_MODEL_ID = "Lykon/dreamshaper-8"
+UNREACHABLE_PROXY = "http://10.255.255.1:3128"
+
+CHILD = """
+import json, os, socket, sys, time
+sys.path.insert(0, "app")
+connections = []
+connect = socket.socket.connect
+def counting_connect(self, address):
+    connections.append(str(address))
+    return connect(self, address)
+socket.socket.connect = counting_connect
+
+started = time.perf_counter()
+import model_store
+model_store.ensure_model(sys.argv[1], os.path.basename(sys.argv[1]))
+gguf_seconds = time.perf_counter() - started
+
+started = time.perf_counter()
+if model_store.OFFLINE:
+    model_store.resolve_pretrained(sys.argv[2])
+else:
+    from diffusers import DiffusionPipeline
+    DiffusionPipeline.download(sys.argv[2], variant="fp16")
+sd_seconds = time.perf_counter() - started
+print(json.dumps({"gguf": gguf_seconds, "sd": sd_seconds,
+                  "connections": len(connections)}))
+"""
+
+
+def measure(offline, unreachable):
+    env = dict(os.environ)
+    env.pop("CHARACTER_FACTORY_OFFLINE", None)
+    if offline:
+        env["CHARACTER_FACTORY_OFFLINE"] = "1"
+    if unreachable:
+        # requests and the hub's HTTP client both use the proxy variables;
+        # the model URLs are hard-coded, so pointing HF_ENDPOINT elsewhere
+        # alone would still let the GGUF check reach huggingface.co.
+        env["HF_ENDPOINT"] = "http://10.255.255.1"
+        for name in ("HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"):  # nopep8
+            env[name] = UNREACHABLE_PROXY
+        for name in ("NO_PROXY", "no_proxy"):
+            env.pop(name, None)
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, GGUF_URL, SD_MODEL_ID],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return json.loads(result.stdout.strip().splitlines()[-1]), None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--unreachable", action="store_true",
+                        help="make the network unreachable for the online run")
+    args = parser.parse_args()
+
+    for label, offline in (("online", False), ("offline", True)):
+        r, error = measure(offline, args.unreachable)
+        if r is None:
+            print(f"{label:8s} failed: {error}")
+            continue
+        print(f"{label:8s} GGUF {r['gguf'] * 1000:8.1f} ms  "
+              f"Stable Diffusion {r['sd'] * 1000:8.1f} ms  "
+              f"connections {r['connections']}")
+
+
+if __name__ == "__main__":
+    main()
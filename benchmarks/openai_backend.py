@@ -0,0 +1,173 @@
+"""
+Exercise the OpenAI-compatible LLM backend against a local stand-in server.
+
+    python benchmarks/openai_backend.py
+    python benchmarks/openai_backend.py --serve 8000
+
+The stand-in server answers `/v1/models` and streams `/v1/completions` word
+by word with a fixed delay per token, counting the TCP connections it
+accepts and the requests it runs at the same time. The benchmark sends the
+fields of several characters from more threads than the backend has
+connections, and reports the wall time, how many connections were opened
+(keep-alive reuses them) and the highest number of concurrent requests the
+server saw (never more than --max-connections). Finally a request to a
+stalled server checks that the read timeout fires.
+
+With --serve the stand-in server just keeps running, so the scripts can be
+tried against it:
+
+    python app/main-zephyr.py --llm-backend openai --llm-url http://localhost:8000/v1 --no-avatar
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))  # nopep8
+
+FIELDS = ["name", "summary", "personality", "scenario", "greeting_message",
+          "example_messages"]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/v1/models":
+            self.send_error(404)
+            return
+        self.send_json({"object": "list",
+                        "data": [{"id": "stand-in", "object": "model"}]})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+        if self.path.rstrip("/") != "/v1/completions":
+            self.send_error(404)
+            return
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.stall)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            tokens = min(request.get("max_tokens") or 16, server.tokens)
+            for i in range(tokens):
+                time.sleep(server.token_seconds)
+                message = {"choices": [{"index": 0, "text": f"word{i} "}]}
+                self.send_chunk(f"data: {json.dumps(message)}\n\n".encode())
+            usage = {"choices": [], "usage": {
+                "prompt_tokens": len(request["prompt"].split()),
+                "completion_tokens": tokens,
+            }}
+            self.send_chunk(f"data: {json.dumps(usage)}\n\n".encode())
+            self.send_chunk(b"data: [DONE]\n\n")
+            self.send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped the generation.
+            self.close_connection = True
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+def start_server(port=0, tokens=32, token_seconds=0.005, stall=0.0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.active = 0
+    server.peak = 0
+    server.tokens = tokens
+    server.token_seconds = token_seconds
+    server.stall = stall
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="Only run the stand-in server on this port")
+    parser.add_argument("--characters", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=12)
+    parser.add_argument("--max-connections", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.serve:
+        server, url = start_server(args.serve)
+        print(f"Stand-in OpenAI-compatible server on {url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return
+
+    from openai_backend import OpenAICompatibleLLM
+
+    server, url = start_server()
+    llm = OpenAICompatibleLLM(url, "", {"max_new_tokens": 32},
+                              max_connections=args.max_connections)
+    requests = [(field, topic) for topic in range(args.characters)
+                for field in FIELDS]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        outputs = list(executor.map(
+            lambda request: llm.invoke(
+                f"Write the {request[0]} of character {request[1]}.",
+                prefix_key=request[0],
+            ),
+            requests,
+        ))
+    seconds = time.perf_counter() - started
+    assert all(outputs), "every request returns text"
+    print(f"{len(requests)} requests from {args.threads} threads in "
+          f"{seconds:.2f}s ({len(requests) / seconds:.1f} requests/s)")
+    # The first connection answered /v1/models.
+    print(f"connections opened: {server.connections}, "
+          f"most concurrent requests: {server.peak} "
+          f"(limit {args.max_connections})")
+    server.shutdown()
+
+    server, url = start_server(stall=2.0)
+    llm = OpenAICompatibleLLM(url, "stand-in", {}, read_timeout=0.5)
+    started = time.perf_counter()
+    try:
+        llm.invoke("Write a name.", prefix_key="name")
+        print("read timeout: did not fire")
+    except RuntimeError as e:
+        print(f"read timeout fired after {time.perf_counter() - started:.1f}s: {e}")  # nopep8
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
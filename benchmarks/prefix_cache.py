@@ -0,0 +1,76 @@
+"""
+Compare prompt evaluation time with and without the few-shot prefix cache.
+
+    python benchmarks/prefix_cache.py models/mistral-7b-instruct-v0.1.Q4_K_M.gguf
+
+Generates every field of the power-user UI for a few characters, alternating
+between the templates the way the UI does, once with reuse disabled and once
+with one slot per template. Only a handful of tokens are generated per
+request, so the totals are dominated by prompt evaluation.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))  # nopep8
+
+from llm_tuning import default_prompt  # noqa: E402
+from prefix_cache import PrefixCachedLLM  # noqa: E402
+
+FIELDS = [
+    ("name", "NAME_PROMPT"),
+    ("summary", "SUMMARY_PROMPT"),
+    ("personality", "PERSONALITY_PROMPT"),
+    ("scenario", "SCENARIO_PROMPT"),
+    ("greeting_message", "GREETING_MESSAGE_PROMPT"),
+    ("example_messages", "EXAMPLE_MESSAGES_PROMPT"),
+]
+TOPICS = ["fantasy", "noir detective", "space pirate", "anime"]
+
+
+def run(model, model_type, slots, new_tokens, threads):
+    config = {"max_new_tokens": new_tokens, "context_length": 4096,
+              "gpu_layers": 0}
+    if threads:
+        config["threads"] = threads
+    llm = PrefixCachedLLM(model, model_type, config, slots=slots)
+    templates = {key: default_prompt(name) for key, name in FIELDS}
+    total = 0.0
+    evaluated = 0
+    for topic in TOPICS:
+        for key, _ in FIELDS:
+            llm.invoke(
+                templates[key]
+                + f"\n<|user|> Write the {key} of a character. Topic: {topic}. "  # nopep8
+                + "</s>\n<|assistant|> ",
+                prefix_key=key,
+            )
+            timing = llm.last_timing
+            total += timing["prompt_eval_seconds"]
+            evaluated += timing["prompt_tokens"] - timing["reused_tokens"]
+    return total, evaluated
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model")
+    parser.add_argument("--model-type", default="llama")
+    parser.add_argument("--new-tokens", type=int, default=4)
+    parser.add_argument("--threads", type=int)
+    args = parser.parse_args()
+
+    requests = len(TOPICS) * len(FIELDS)
+    results = {}
+    for label, slots in (("without cache", 0), ("with cache", len(FIELDS))):
+        seconds, evaluated = run(
+            args.model, args.model_type, slots, args.new_tokens, args.threads
+        )
+        results[label] = seconds
+        print(f"{label:14s} {requests} requests: prompt eval {seconds:7.1f}s, "
+              f"{evaluated} tokens evaluated")
+    print(f"speed-up: {results['without cache'] / results['with cache']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
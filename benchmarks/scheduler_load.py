@@ -0,0 +1,148 @@
+"""
+Latency of the web UI fields under concurrent users, with and without the scheduler.
+
+    python benchmarks/scheduler_load.py
+    python benchmarks/scheduler_load.py models/zephyr-7b-beta.Q4_K_M.gguf --users 4
+
+Every simulated user clicks through the fields of one character in the
+order of the web UI (name, summary, personality, ...), starting at a random
+moment within the first seconds. "direct" calls a single-slot
+`PrefixCachedLLM` from every user thread, as the Zephyr and Mistral web
+UIs did before the scheduler; "scheduled" puts a `ScheduledLLM` with three
+slots in front of it. The p50/p95 latency per field and over all requests
+is reported for both, together with the scheduler's queue waits.
+
+Without a model file the backend is simulated: it generates half of each
+field's token limit at --token-ms per token, one token at a time across
+all slots like a CPU, so both modes do the same amount of work.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))  # nopep8
+
+import generation_profiles  # noqa: E402
+from llm_backend import LLMBackend  # noqa: E402
+
+FIELDS = [
+    ("name", "NAME_PROMPT"),
+    ("summary", "SUMMARY_PROMPT"),
+    ("personality", "PERSONALITY_PROMPT"),
+    ("scenario", "SCENARIO_PROMPT"),
+    ("greeting_message", "GREETING_MESSAGE_PROMPT"),
+    ("example_messages", "EXAMPLE_MESSAGES_PROMPT"),
+]
+
+
+class SimulatedLLM(LLMBackend):
+    """One device shared by `slots` contexts, one token at a time."""
+
+    def __init__(self, slots, token_seconds):
+        self.slots = slots
+        self.token_seconds = token_seconds
+        self.config = {"max_new_tokens": 1024}
+        self._device = threading.Lock()
+        self._slots = threading.BoundedSemaphore(slots)
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        tokens = generation_profiles.profile(prefix_key).get("max_new_tokens", 256) // 2  # nopep8
+        with self._slots:
+            for i in range(tokens):
+                with self._device:
+                    time.sleep(self.token_seconds)
+                yield f"word{i} "
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_users(llm, prompts, users, spread, seed):
+    latencies = {field: [] for field, _ in FIELDS}
+    lock = threading.Lock()
+    rng = random.Random(seed)
+    delays = [rng.uniform(0, spread) for _ in range(users)]
+
+    def user(delay):
+        time.sleep(delay)
+        for field, _ in FIELDS:
+            started = time.perf_counter()
+            llm.invoke(prompts[field], prefix_key=field)
+            with lock:
+                latencies[field].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(user, delays))
+    return latencies, time.perf_counter() - started
+
+
+def report(mode, latencies, seconds):
+    print(f"{mode}: {seconds:.1f}s in total")
+    print(f"  {'field':18s} {'p50':>8s} {'p95':>8s}")
+    every = []
+    for field, values in latencies.items():
+        every += values
+        print(f"  {field:18s} {percentile(values, 0.5):7.2f}s "
+              f"{percentile(values, 0.95):7.2f}s")
+    print(f"  {'all requests':18s} {percentile(every, 0.5):7.2f}s "
+          f"{percentile(every, 0.95):7.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", nargs="?",
+                        help="GGUF model; without it the backend is simulated")  # nopep8
+    parser.add_argument("--model-type", default="llama")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--spread", type=float, default=5.0,
+                        help="users start within this many seconds")
+    parser.add_argument("--token-ms", type=float, default=2.0,
+                        help="time per token of the simulated backend")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from request_scheduler import ScheduledLLM
+
+    if args.model:
+        from llm_tuning import default_prompt
+        from prefix_cache import PrefixCachedLLM
+
+        config = {"max_new_tokens": 1024, "context_length": 8192,
+                  "gpu_layers": 0}
+
+        def backend(slots):
+            return PrefixCachedLLM(args.model, args.model_type, config,
+                                   slots=slots)
+
+        prompts = {
+            field: default_prompt(name)
+            + f"\n<|user|> Write the {field} of a character. Topic: fantasy. "
+            + "</s>\n<|assistant|> "
+            for field, name in FIELDS
+        }
+    else:
+        def backend(slots):
+            return SimulatedLLM(slots, args.token_ms / 1000)
+
+        prompts = {field: f"Write the {field}." for field, _ in FIELDS}
+
+    report("direct", *run_users(backend(1), prompts, args.users,
+                                args.spread, args.seed))
+    llm = ScheduledLLM(backend(3))
+    report("scheduled", *run_users(llm, prompts, args.users,
+                                   args.spread, args.seed))
+    stats = llm.stats()
+    print(f"  queue wait p50 {stats['wait_p50']:.2f}s, "
+          f"p95 {stats['wait_p95']:.2f}s over {stats['completed']} requests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Compare peak RSS of the legacy and low-memory Stable Diffusion loading modes.
+
+    python benchmarks/sd_load_memory.py
+    python benchmarks/sd_load_memory.py --model models/dreamshaper_8.safetensors
+
+Peak RSS never goes down within a process, so every mode is measured in a
+fresh interpreter. Run it once first so the download is not measured.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, "app")
+from sd_loading import load_pipeline, peak_rss_bytes
+before = peak_rss_bytes()
+started = time.perf_counter()
+pipeline, device = load_pipeline(sys.argv[1], low_memory=sys.argv[2] == "1")
+seconds = time.perf_counter() - started
+print(json.dumps({"before": before, "after": peak_rss_bytes(),
+                  "seconds": seconds, "device": device,
+                  "dtype": str(pipeline.unet.dtype)}))
+"""
+
+
+def measure(model, low_memory):
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, model, "1" if low_memory else "0"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="Lykon/dreamshaper-8")
+    args = parser.parse_args()
+
+    for label, low_memory in (("legacy", False), ("low-memory", True)):
+        r = measure(args.model, low_memory)
+        print(f"{label:10s}  {r['device']} {r['dtype']:14s}  "
+              f"peak RSS {r['before'] / 1024 ** 2:6.0f} -> "
+              f"{r['after'] / 1024 ** 2:6.0f} MiB  load {r['seconds']:5.1f}s")
+
+
+if __name__ == "__main__":
+    main()
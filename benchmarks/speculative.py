@@ -0,0 +1,85 @@
+"""
+Compare generation speed with and without a draft model.
+
+    pip install llama-cpp-python
+    python benchmarks/speculative.py models/zephyr-7b-beta.Q4_K_M.gguf models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf
+
+Generates the long fields of the power-user UI for a few topics, once with
+the main model alone and once with the draft model proposing tokens. Both
+runs use llama-cpp-python, so the difference comes from speculative
+decoding only. The generation profiles limit the tokens per field.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))  # nopep8
+
+from llm_tuning import default_prompt  # noqa: E402
+from speculative import DRAFT_TOKENS, SpeculativeLLM  # noqa: E402
+
+FIELDS = [
+    ("summary", "SUMMARY_PROMPT"),
+    ("greeting_message", "GREETING_MESSAGE_PROMPT"),
+    ("example_messages", "EXAMPLE_MESSAGES_PROMPT"),
+]
+TOPICS = ["fantasy", "noir detective", "space pirate"]
+
+
+def run(model, draft, draft_tokens, threads):
+    config = {"max_new_tokens": 1024, "context_length": 4096,
+              "gpu_layers": 0, "temperature": 0.8}
+    if threads:
+        config["threads"] = threads
+    llm = SpeculativeLLM(model, draft, config, draft_tokens=draft_tokens)
+    templates = {key: default_prompt(name) for key, name in FIELDS}
+    results = {key: [0, 0.0, 0, 0] for key, _ in FIELDS}
+    for topic in TOPICS:
+        for key, _ in FIELDS:
+            llm.invoke(
+                templates[key]
+                + f"\n<|user|> Write the {key} of a character. Topic: {topic}. "  # nopep8
+                + "</s>\n<|assistant|> ",
+                prefix_key=key,
+            )
+            timing = llm.last_timing
+            result = results[key]
+            result[0] += timing["generated_tokens"]
+            result[1] += timing["seconds"]
+            result[2] += timing.get("draft_proposed", 0)
+            result[3] += timing.get("draft_accepted", 0)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model")
+    parser.add_argument("draft")
+    parser.add_argument("--draft-tokens", type=int, default=DRAFT_TOKENS)
+    parser.add_argument("--threads", type=int)
+    args = parser.parse_args()
+
+    without = run(args.model, None, args.draft_tokens, args.threads)
+    with_draft = run(args.model, args.draft, args.draft_tokens, args.threads)
+
+    print(f"{'field':18s} {'tokens/s':>9s} {'with draft':>11s} {'accepted':>9s}")  # nopep8
+    totals = [0, 0.0, 0, 0.0, 0, 0]
+    for key, _ in FIELDS:
+        tokens, seconds = without[key][:2]
+        draft_tokens, draft_seconds, proposed, accepted = with_draft[key]
+        totals = [a + b for a, b in zip(totals, [
+            tokens, seconds, draft_tokens, draft_seconds, proposed, accepted
+        ])]
+        print(f"{key:18s} {tokens / seconds:9.1f} "
+              f"{draft_tokens / draft_seconds:11.1f} "
+              f"{accepted / max(proposed, 1):9.0%}")
+    speed = totals[0] / totals[1]
+    draft_speed = totals[2] / totals[3]
+    print(f"{'total':18s} {speed:9.1f} {draft_speed:11.1f} "
+          f"{totals[5] / max(totals[4], 1):9.0%}")
+    print(f"speed-up: {draft_speed / speed:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
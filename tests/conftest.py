@@ -0,0 +1,54 @@
+import os
+import struct
+import sys
+
+import pytest
+
+# The modules in app/ import each other by plain name, like the scripts.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))  # nopep8
+
+import telemetry  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def telemetry_log(tmp_path, monkeypatch):
+    # Keep the records of the tests out of logs/telemetry.jsonl.
+    monkeypatch.setattr(telemetry, "TELEMETRY_FILE",
+                        str(tmp_path / "telemetry.jsonl"))
+
+
+def gguf_value(value):
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        return 8, struct.pack("<Q", len(data)) + data
+    if isinstance(value, list):
+        item_type = gguf_value(value[0])[0] if value else 4
+        items = b"".join(gguf_value(item)[1] for item in value)
+        return 9, struct.pack("<IQ", item_type, len(value)) + items
+    if isinstance(value, float):
+        return 6, struct.pack("<f", value)
+    return 4, struct.pack("<I", value)
+
+
+def gguf_bytes(metadata, tensor_count=0):
+    """Return a GGUF version 3 header with `metadata`."""
+    data = b"GGUF" + struct.pack("<IQQ", 3, tensor_count, len(metadata))
+    for key, value in metadata.items():
+        value_type, encoded = gguf_value(value)
+        data += gguf_value(key)[1] + struct.pack("<I", value_type) + encoded
+    return data
+
+
+@pytest.fixture
+def make_gguf(tmp_path):
+    """Write a GGUF file with `metadata` whose size is `size` bytes."""
+    def make(name, metadata, size=None):
+        path = tmp_path / name
+        data = gguf_bytes(metadata)
+        with open(path, "wb") as f:
+            f.write(data)
+            # Sparse, so gigabytes of "weights" cost nothing.
+            f.truncate(size or len(data))
+        return str(path)
+
+    return make
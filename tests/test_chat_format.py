@@ -0,0 +1,135 @@
+import pytest
+
+from chat_format import (ChatFormat, ChatFormattedLLM, UnsupportedModel,
+                         model_type, parse_prompt, with_chat_format)
+from gguf_header import GGUFHeader
+from llm_backend import LLMBackend
+
+PROMPT = (
+    "<|system|>\nYou are a text generation tool. </s>\n"
+    "<|user|> Generate a name. Topic: business. </s>\n"
+    "<|assistant|> Jamie Hale </s>\n"
+    "<|user|> Generate a name. Topic: fantasy. </s>\n"
+    "<|assistant|> "
+)
+MESSAGES = [
+    {"role": "system", "content": "You are a text generation tool."},
+    {"role": "user", "content": "Generate a name. Topic: business."},
+    {"role": "assistant", "content": "Jamie Hale"},
+    {"role": "user", "content": "Generate a name. Topic: fantasy."},
+]
+# The templates of zephyr-7b-beta and Mistral-7B-Instruct-v0.1.
+ZEPHYR_TEMPLATE = "{% for message in messages %}\n{% if message['role'] == 'user' %}\n{{ '<|user|>\n' + message['content'] + eos_token }}\n{% elif message['role'] == 'system' %}\n{{ '<|system|>\n' + message['content'] + eos_token }}\n{% elif message['role'] == 'assistant' %}\n{{ '<|assistant|>\n'  + message['content'] + eos_token }}\n{% endif %}\n{% if loop.last and add_generation_prompt %}\n{{ '<|assistant|>' }}\n{% endif %}\n{% endfor %}"  # nopep8
+MISTRAL_TEMPLATE = "{{ bos_token }}{% for message in messages %}{% if (message['role'] == 'user') != (loop.index0 % 2 == 0) %}{{ raise_exception('Conversation roles must alternate user/assistant/user/assistant/...') }}{% endif %}{% if message['role'] == 'user' %}{{ '[INST] ' + message['content'] + ' [/INST]' }}{% elif message['role'] == 'assistant' %}{{ message['content'] + eos_token + ' ' }}{% else %}{{ raise_exception('Only user and assistant roles are supported!') }}{% endif %}{% endfor %}"  # nopep8
+CHATML_TEMPLATE = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"  # nopep8
+DEFAULT_STOP = ["</s>", "<|user|>", "<|char|>"]
+
+
+def header(architecture="llama", template=None):
+    metadata = {
+        "general.architecture": architecture,
+        "tokenizer.ggml.tokens": ["<unk>", "<s>", "</s>"],
+        "tokenizer.ggml.bos_token_id": 1,
+        "tokenizer.ggml.eos_token_id": 2,
+    }
+    if template:
+        metadata["tokenizer.chat_template"] = template
+    return GGUFHeader(3, 0, metadata, 0)
+
+
+def test_from_header_reads_model_type_tokens_and_template():
+    chat_format = ChatFormat.from_header(header(template=CHATML_TEMPLATE))
+
+    assert chat_format.model_type == "llama"
+    assert (chat_format.bos, chat_format.eos) == ("<s>", "</s>")
+    assert chat_format.template == CHATML_TEMPLATE
+
+
+@pytest.mark.parametrize("architecture", [
+    "gpt2", "gptj", "gptneox", "mpt", "starcoder", "falcon", "qwen2",
+])
+def test_architectures_ctransformers_cannot_load_are_refused(architecture):
+    with pytest.raises(UnsupportedModel, match=architecture):
+        ChatFormat.from_header(header(architecture))
+
+
+def test_model_type_of_file(make_gguf):
+    path = make_gguf("zephyr.gguf", {"general.architecture": "llama"})
+
+    assert model_type(path) == "llama"
+    # Not downloaded yet: the load reports that, not the header read.
+    assert model_type(path + ".missing") == "llama"
+    with pytest.raises(UnsupportedModel):
+        model_type(make_gguf("gpt2.gguf", {"general.architecture": "gpt2"}))
+
+
+def test_parse_prompt_splits_zephyr_turns():
+    assert parse_prompt(PROMPT) == (MESSAGES, "")
+    assert parse_prompt(PROMPT + "Lady")[1] == "Lady"
+
+
+def test_zephyr_prompt_round_trips_through_zephyr_template():
+    pytest.importorskip("jinja2")
+    rendered = ChatFormat("llama", ZEPHYR_TEMPLATE, "<s>", "</s>")._render(
+        MESSAGES
+    )
+
+    assert parse_prompt(rendered) == (MESSAGES, "")
+
+
+def test_zephyr_style_and_missing_templates_keep_prompts():
+    for template in (ZEPHYR_TEMPLATE, None):
+        chat_format = ChatFormat("llama", template, "<s>", "</s>")
+        assert not chat_format.rewrites
+        assert chat_format.format(PROMPT) == PROMPT
+        assert chat_format.stop(DEFAULT_STOP) == DEFAULT_STOP
+
+
+def test_mistral_template_gets_system_folded_into_first_user_turn():
+    pytest.importorskip("jinja2")
+    chat_format = ChatFormat("llama", MISTRAL_TEMPLATE, "<s>", "</s>")
+
+    assert chat_format.format(PROMPT) == (
+        "[INST] You are a text generation tool.\n\n"
+        "Generate a name. Topic: business. [/INST]"
+        "Jamie Hale</s> "
+        "[INST] Generate a name. Topic: fantasy. [/INST]"
+    )
+    assert chat_format.stop(DEFAULT_STOP) == ["[INST]", "</s>"]
+
+
+def test_chatml_template_ends_with_assistant_turn():
+    pytest.importorskip("jinja2")
+    chat_format = ChatFormat("llama", CHATML_TEMPLATE, "<s>", "<|im_end|>")
+
+    text = chat_format.format(PROMPT + "Lady")
+
+    assert text.startswith("<|im_start|>system\nYou are a text generation tool.<|im_end|>\n")  # nopep8
+    assert text.endswith("<|im_start|>user\nGenerate a name. Topic: fantasy.<|im_end|>\n<|im_start|>assistant\nLady")  # nopep8
+    assert chat_format.stop(DEFAULT_STOP) == ["<|im_end|>", "<|im_start|>"]
+
+
+def test_broken_template_passes_prompt_on():
+    pytest.importorskip("jinja2")
+    chat_format = ChatFormat("llama", "{% for %}", "<s>", "</s>")
+
+    assert chat_format.format(PROMPT) == PROMPT
+
+
+class EchoLLM(LLMBackend):
+    config = {"max_new_tokens": 10}
+    slots = 3
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        yield prompt
+
+
+def test_chat_formatted_llm_passes_formatted_prompt():
+    chat_format = ChatFormat("llama", CHATML_TEMPLATE, "<s>", "<|im_end|>")
+    chat_format.format = lambda prompt: prompt.upper()
+    llm = with_chat_format(EchoLLM(), chat_format)
+
+    assert isinstance(llm, ChatFormattedLLM)
+    assert llm.invoke("hi") == "HI"
+    assert (llm.config, llm.slots) == ({"max_new_tokens": 10}, 3)
+    assert isinstance(with_chat_format(EchoLLM(), None), EchoLLM)
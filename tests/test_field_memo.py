@@ -0,0 +1,122 @@
+from field_memo import FieldMemo, field_key
+
+MODEL = "zephyr"
+CONFIG = {"temperature": 0.7, "threads": 4}
+
+# name -> summary -> personality, summary -> scenario; the greeting only
+# depends on the topic.
+PROMPTS = {
+    "name": lambda f: "name of a fantasy character",
+    "summary": lambda f: f"summary of {f['name']}",
+    "personality": lambda f: f"personality of {f['name']}: {f['summary']}",
+    "scenario": lambda f: f"scenario for {f['summary']}",
+    "greeting": lambda f: "greeting in a fantasy setting",
+}
+
+
+def key(prompt):
+    return field_key(prompt, MODEL, CONFIG)
+
+
+class FakeLLM:
+    def __init__(self, memo):
+        self.memo = memo
+        self.calls = []
+
+    def generate(self, field, prompt):
+        # Streams like generate_field() and records the finished output.
+        self.calls.append(field)
+        output = f"{field} #{len(self.calls)}"
+        yield output[:3]
+        yield output
+        self.memo.record(key(prompt), output)
+
+
+def generate_all(memo, llm):
+    fields = dict.fromkeys(PROMPTS, "")
+    list(memo.refresh(fields, PROMPTS, key, llm.generate))
+    return fields
+
+
+def test_field_key_ignores_speed_settings():
+    assert key("prompt") == field_key("prompt", MODEL, {"temperature": 0.7})
+    assert key("prompt") != field_key("prompt", MODEL, {"temperature": 0.2})
+    assert key("prompt") != field_key("prompt", "mistral", CONFIG)
+    assert key("prompt") != key("other prompt")
+
+
+def test_is_stale():
+    memo = FieldMemo()
+    memo.record(key("summary of Alice"), "A brave knight.")
+    assert not memo.is_stale("A brave knight.", key("summary of Alice"))
+    assert memo.is_stale("A brave knight.", key("summary of Bob"))
+    assert memo.is_stale("", key("summary of Alice"))
+    # Text typed in by hand was never generated, so it is never stale.
+    assert not memo.is_stale("A shy wizard.", key("summary of Bob"))
+
+
+def test_empty_fields_are_generated_in_order():
+    memo = FieldMemo()
+    llm = FakeLLM(memo)
+    fields = generate_all(memo, llm)
+    assert llm.calls == [
+        "name", "summary", "personality", "scenario", "greeting"
+    ]
+    assert fields["personality"] == "personality #3"
+
+
+def test_fresh_fields_are_left_alone():
+    memo = FieldMemo()
+    llm = FakeLLM(memo)
+    fields = generate_all(memo, llm)
+    before = dict(fields)
+    assert list(memo.refresh(fields, PROMPTS, key, llm.generate)) == []
+    assert fields == before
+    assert len(llm.calls) == 5
+
+
+def test_edited_upstream_field_makes_dependents_stale():
+    memo = FieldMemo()
+    llm = FakeLLM(memo)
+    fields = generate_all(memo, llm)
+    greeting = fields["greeting"]
+    llm.calls.clear()
+    fields["name"] = "Bob"
+    updates = list(memo.refresh(fields, PROMPTS, key, llm.generate))
+    # The typed-in name stays and what was generated from it is
+    # regenerated: the scenario through the new summary. The greeting
+    # doesn't depend on the name and is untouched.
+    assert llm.calls == ["summary", "personality", "scenario"]
+    assert {field for field, _ in updates} == {
+        "summary", "personality", "scenario"
+    }
+    assert fields["name"] == "Bob"
+    assert fields["greeting"] == greeting
+
+
+def test_edited_dependent_is_kept():
+    memo = FieldMemo()
+    llm = FakeLLM(memo)
+    fields = generate_all(memo, llm)
+    llm.calls.clear()
+    fields["personality"] = "Grumpy before breakfast."
+    list(memo.refresh(fields, PROMPTS, key, llm.generate))
+    assert llm.calls == []
+    assert fields["personality"] == "Grumpy before breakfast."
+
+
+def test_inputs_seen_before_reuse_the_remembered_output():
+    memo = FieldMemo()
+    llm = FakeLLM(memo)
+    fields = generate_all(memo, llm)
+    original = dict(fields)
+    fields["name"] = "Bob"
+    list(memo.refresh(fields, PROMPTS, key, llm.generate))
+    llm.calls.clear()
+    fields["name"] = original["name"]
+    updates = list(memo.refresh(fields, PROMPTS, key, llm.generate))
+    assert llm.calls == []
+    assert updates == [
+        ("summary", "reused"), ("personality", "reused"), ("scenario", "reused")
+    ]
+    assert fields == original
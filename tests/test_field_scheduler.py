@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from field_scheduler import FIELD_DEPENDENCIES, run_fields
+
+
+def recording_generators(calls, fields=FIELD_DEPENDENCIES):
+    """Generators that record the inputs they got and return `<field>!`."""
+    lock = threading.Lock()
+
+    def generator(field):
+        def generate(inputs):
+            with lock:
+                calls[field] = dict(inputs)
+            return f"{field}!"
+        return generate
+
+    return {field: generator(field) for field in fields}
+
+
+def test_every_field_gets_its_dependencies():
+    calls = {}
+    fields = run_fields(recording_generators(calls), workers=3)
+
+    assert fields == {field: f"{field}!" for field in FIELD_DEPENDENCIES}
+    for field, dependencies in FIELD_DEPENDENCIES.items():
+        for dependency in dependencies:
+            assert calls[field][dependency] == f"{dependency}!"
+
+
+def test_given_fields_are_not_generated():
+    calls = {}
+    fields = run_fields(recording_generators(calls),
+                        given={"name": "Lily", "summary": "A witch."})
+
+    assert "name" not in calls and "summary" not in calls
+    assert fields["name"] == "Lily"
+    assert calls["personality"] == {"name": "Lily", "summary": "A witch."}
+
+
+def test_independent_fields_run_at_the_same_time():
+    # Both must be inside their generator at once to pass the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+    calls = {}
+    generators = recording_generators(calls)
+
+    def meet(field):
+        def generate(inputs):
+            barrier.wait()
+            return f"{field}!"
+        return generate
+
+    generators["scenario"] = meet("scenario")
+    generators["greeting_message"] = meet("greeting_message")
+
+    fields = run_fields(generators, workers=2)
+    assert fields["scenario"] == "scenario!"
+
+
+def test_error_in_one_field_is_raised_and_stops_its_dependents():
+    calls = {}
+    generators = recording_generators(calls)
+
+    def fail(inputs):
+        raise RuntimeError("LLM failed")
+
+    generators["summary"] = fail
+
+    with pytest.raises(RuntimeError, match="LLM failed"):
+        run_fields(generators)
+    assert set(calls) == {"name"}
+
+
+def test_missing_dependency_is_reported_before_generating():
+    calls = {}
+    generators = recording_generators(calls, ["personality"])
+
+    with pytest.raises(ValueError, match="personality depends on name, summary"):  # nopep8
+        run_fields(generators)
+    assert calls == {}
@@ -0,0 +1,48 @@
+import pytest
+
+import generation_profiles
+from generation_profiles import cut_position, held_back, stop_list
+
+
+@pytest.fixture(autouse=True)
+def profiles_on(monkeypatch):
+    monkeypatch.setattr(generation_profiles, "ENABLED", True)
+
+
+def test_fields_without_rule_are_never_cut():
+    assert cut_position("summary", "one\ntwo\nthree\n") is None
+    assert cut_position("unknown", "one\n") is None
+
+
+def test_name_ends_with_first_non_empty_line():
+    assert cut_position("name", "Lily Harper") is None
+    assert cut_position("name", "\nLily Harper\nShe is") == len("\nLily Harper")  # nopep8
+
+
+def test_example_messages_end_after_eight_turns():
+    turns = "".join(f"{{{{{'user' if i % 2 else 'char'}}}}}: line {i}\n"
+                    for i in range(8))
+    assert cut_position("example_messages", turns[:-1]) is None
+    assert cut_position("example_messages", turns + "{{user}}: more") == len(turns) - 1  # nopep8
+
+
+def test_stop_list_adds_field_stops_once():
+    assert stop_list("name", ["</s>", ","]) == ["</s>", ",", "("]
+    assert stop_list("summary", None) == []
+
+
+def test_held_back_is_longest_possible_stop_word_start():
+    stop = ["</s>", "<|user|>"]
+    assert held_back("Lily", stop) == 0
+    assert held_back("Lily <", stop) == 1
+    assert held_back("Lily </", stop) == 2
+    assert held_back("Lily <|us", stop) == 4
+    # A complete stop word is found by the caller, not held back.
+    assert held_back("Lily </s", stop) == 3
+    assert held_back("Lily", []) == 0
+
+
+def test_profiles_can_be_turned_off(monkeypatch):
+    monkeypatch.setattr(generation_profiles, "ENABLED", False)
+    assert cut_position("name", "Lily\nHarper\n") is None
+    assert stop_list("name", None) == []
@@ -0,0 +1,42 @@
+import pytest
+
+import gguf_header
+from conftest import gguf_bytes
+
+METADATA = {
+    "general.architecture": "llama",
+    "general.file_type": 15,
+    "llama.block_count": 32,
+    "llama.rope.freq_base": 10000.0,
+    "tokenizer.ggml.tokens": ["<unk>", "<s>", "</s>"],
+    "tokenizer.chat_template": "{{ messages }}",
+}
+
+
+def test_read_local_parses_metadata(make_gguf):
+    path = make_gguf("model.gguf", METADATA, size=1024 ** 2)
+
+    header = gguf_header.read_local(path)
+
+    assert header.version == 3
+    assert header.file_size == 1024 ** 2
+    assert header.architecture == "llama"
+    assert header.get("{arch}.block_count") == 32
+    assert header.get("{arch}.rope.freq_base") == pytest.approx(10000.0)
+    assert header.get("tokenizer.ggml.tokens") == ["<unk>", "<s>", "</s>"]
+    assert header.get("tokenizer.chat_template") == "{{ messages }}"
+    assert header.get("{arch}.missing", 7) == 7
+
+
+def test_short_buffer_raises_truncated_header():
+    data = gguf_bytes(METADATA)
+
+    for length in (len(data) - 1, len(data) // 2, 30):
+        with pytest.raises(gguf_header.TruncatedHeader):
+            gguf_header.parse(data[:length])
+    assert gguf_header.parse(data).get("general.file_type") == 15
+
+
+def test_other_files_are_rejected():
+    with pytest.raises(ValueError, match="Not a GGUF file"):
+        gguf_header.parse(b"PK\x03\x04" + bytes(64))
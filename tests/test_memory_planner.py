@@ -0,0 +1,96 @@
+import pytest
+
+import memory_planner
+import model_store
+import prompt_budget
+
+GIB = 1024 ** 3
+METADATA = {
+    "general.architecture": "llama",
+    "llama.block_count": 32,
+    "llama.embedding_length": 4096,
+    "llama.attention.head_count": 32,
+    "llama.attention.head_count_kv": 8,
+}
+
+
+@pytest.fixture(autouse=True)
+def planner(tmp_path, monkeypatch):
+    # No models folder, no network: quantizations without a file are
+    # treated as missing.
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_store, "OFFLINE", False)
+    monkeypatch.setattr(memory_planner, "remote_metadata",
+                        lambda url: (None, None))
+    monkeypatch.setattr(prompt_budget, "DYNAMIC", True)
+
+
+@pytest.fixture
+def quantizations(make_gguf):
+    """Q8_0, Q6_K and Q4_K_M files of a 7B model."""
+    return {
+        name: make_gguf(f"model.{name}.gguf", METADATA, int(size * GIB))
+        for name, size in (("Q8_0", 7.7), ("Q6_K", 5.9), ("Q4_K_M", 4.4))
+    }
+
+
+def test_kv_cache_uses_grouped_query_width(make_gguf):
+    header = memory_planner.read_header(make_gguf("m.gguf", METADATA))
+
+    # 2 x 32 layers x 8192 tokens x (4096 * 8 / 32) x 2 bytes
+    assert memory_planner.kv_cache_bytes(header, 8192) == GIB
+    assert memory_planner.estimate_bytes(header, 8192) == \
+        header.file_size + GIB + 8192 * 4096 * 16 + memory_planner.OVERHEAD_BYTES  # nopep8
+
+
+def test_model_that_fits_keeps_its_context(quantizations):
+    result = memory_planner.plan(quantizations["Q8_0"], 8192,
+                                 available=12 * GIB)
+
+    assert result["url"] == quantizations["Q8_0"]
+    assert result["context_length"] == 8192
+    assert "needs about 9.7 GiB" in result["note"]
+
+
+def test_context_is_halved_first(quantizations):
+    result = memory_planner.plan(quantizations["Q8_0"], 8192,
+                                 available=9 * GIB)
+
+    assert result["url"] == quantizations["Q8_0"]
+    assert result["context_length"] == 4096
+
+
+def test_smaller_quantization_is_suggested(quantizations):
+    with pytest.raises(memory_planner.ModelTooLarge, match="Q4_K_M"):
+        memory_planner.plan(quantizations["Q8_0"], 8192, available=6.5 * GIB)
+
+
+def test_smaller_quantization_is_picked_in_auto_mode(quantizations):
+    result = memory_planner.plan(quantizations["Q8_0"], 8192,
+                                 available=6.5 * GIB, mode="auto")
+
+    assert result["url"] == quantizations["Q4_K_M"]
+    assert result["context_length"] == 8192
+
+
+def test_nothing_fits(quantizations):
+    with pytest.raises(memory_planner.ModelTooLarge, match="no smaller"):
+        memory_planner.plan(quantizations["Q8_0"], 8192, available=4 * GIB,
+                            mode="auto")
+
+
+def test_offline_switched_on_after_import_skips_remote_header(monkeypatch):
+    def no_network(url):
+        raise AssertionError("offline mode must not read remote headers")
+
+    monkeypatch.setattr(memory_planner.gguf_header, "read_remote", no_network)
+    monkeypatch.setattr(model_store, "OFFLINE", True)
+
+    result = memory_planner.plan("https://example.com/model.Q8_0.gguf", 8192)
+    assert "offline" in result["note"]
+
+
+def test_off_mode_does_not_read_the_header():
+    result = memory_planner.plan("missing.gguf", 8192, mode="off")
+    assert result == {"url": "missing.gguf", "context_length": 8192,
+                      "note": ""}
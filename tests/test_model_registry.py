@@ -0,0 +1,123 @@
+import pytest
+
+import model_registry
+from model_registry import ModelRegistry
+
+GB = 1024 ** 3
+
+
+class Model:
+    def __init__(self, name):
+        self.name = name
+
+
+@pytest.fixture
+def released(monkeypatch):
+    calls = []
+    monkeypatch.setattr(model_registry, "release_memory",
+                        lambda: calls.append(True))
+    return calls
+
+
+@pytest.fixture
+def registry(released):
+    registry = ModelRegistry(budget_bytes=10 * GB)
+    registry.loads = []
+
+    def loader(name, size):
+        def load():
+            registry.loads.append(name)
+            return Model(name), size * GB
+        return load
+
+    registry.register("llm:a", loader("llm:a", 6))
+    registry.register("llm:b", loader("llm:b", 6))
+    registry.register("sd:c", loader("sd:c", 3))
+    return registry
+
+
+def test_get_loads_once(registry):
+    model = registry.get("llm:a")
+    assert registry.get("llm:a") is model
+    assert registry.loads == ["llm:a"]
+    assert registry.used_bytes() == 6 * GB
+    with pytest.raises(KeyError):
+        registry.get("llm:unknown")
+
+
+def test_least_recently_used_model_is_evicted(registry, released):
+    registry.get("llm:a")
+    registry.get("sd:c")
+    registry.get("llm:a")
+    registry.get("llm:b")
+    assert registry.resident_ids() == ["llm:b"]
+    assert registry.draining_ids() == []
+    assert released
+    registry.get("sd:c")
+    assert registry.resident_ids() == ["llm:b", "sd:c"]
+    assert registry.loads == ["llm:a", "sd:c", "llm:b", "sd:c"]
+
+
+def test_leased_model_drains_and_does_not_count(registry, released):
+    with registry.lease("llm:a") as model:
+        registry.get("llm:b")
+        # llm:a keeps serving its request but is no longer resident.
+        assert registry.resident_ids() == ["llm:b"]
+        assert registry.draining_ids() == ["llm:a"]
+        assert registry.used_bytes() == 6 * GB
+        assert registry.draining_bytes() == 6 * GB
+        # Only resident models count, so sd:c fits next to llm:b.
+        registry.get("sd:c")
+        assert registry.resident_ids() == ["llm:b", "sd:c"]
+        assert not released
+    assert model.name == "llm:a"
+    assert registry.draining_ids() == []
+    assert registry.draining_bytes() == 0
+    assert released == [True]
+
+
+def test_release_waits_for_the_last_lease(registry, released):
+    first = registry.get("llm:a", lease=True)
+    second = registry.get("llm:a", lease=True)
+    assert first is second
+    registry.evict("llm:a")
+    assert registry.draining_ids() == ["llm:a"]
+    registry.release("llm:a")
+    assert registry.draining_ids() == ["llm:a"]
+    assert not released
+    registry.release("llm:a")
+    assert registry.draining_ids() == []
+    assert released == [True]
+
+
+def test_draining_model_is_taken_back(registry, released):
+    with registry.lease("llm:a") as model:
+        registry.get("llm:b")
+        assert registry.get("llm:a") is model
+        # Taking it back made room by evicting llm:b.
+        assert registry.resident_ids() == ["llm:a"]
+        assert registry.draining_ids() == []
+    assert registry.loads == ["llm:a", "llm:b"]
+    assert registry.is_resident("llm:a")
+
+
+def test_evicting_an_idle_model_releases_it(registry, released):
+    registry.get("llm:a")
+    registry.evict("llm:a")
+    assert not registry.is_resident("llm:a")
+    assert registry.draining_ids() == []
+    assert released == [True]
+    registry.get("llm:a")
+    assert registry.loads == ["llm:a", "llm:a"]
+
+
+def test_smaller_budget_drains_leased_models(registry, released):
+    registry.get("sd:c")
+    with registry.lease("llm:a"):
+        assert registry.set_budget(6 * GB) == ["sd:c"]
+        assert registry.resident_ids() == ["llm:a"]
+        registry.set_budget(2 * GB)
+        assert registry.resident_ids() == []
+        assert registry.draining_ids() == ["llm:a"]
+        assert registry.used_bytes() == 0
+    assert registry.draining_ids() == []
@@ -0,0 +1,172 @@
+import hashlib
+import os
+
+import pytest
+
+import model_store
+
+URL = "https://example.com/model.gguf"
+PAYLOAD = b"weights" * 1000
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """A models folder whose downloads write PAYLOAD and are counted."""
+    downloads = []
+
+    def download_file(url, destination, progress=None):
+        downloads.append(url)
+        with open(destination, "wb") as f:
+            f.write(PAYLOAD)
+
+    monkeypatch.setattr(model_store, "OFFLINE", False)
+    monkeypatch.setattr(model_store, "download_file", download_file)
+    monkeypatch.setattr(model_store, "remote_metadata",
+                        lambda url: (len(PAYLOAD), SHA256))
+    folder = str(tmp_path / "models")
+    return folder, downloads
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_stores_blob_and_links_name(store):
+    folder, downloads = store
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == [URL]
+    assert read(path) == PAYLOAD
+    assert os.path.samefile(path, model_store.blob_path(folder, SHA256))
+    manifest = model_store.load_manifest(folder)
+    assert manifest["urls"][URL] == SHA256
+    assert manifest["blobs"][SHA256]["size"] == len(PAYLOAD)
+
+
+def test_verified_model_is_only_linked(store, monkeypatch):
+    folder, downloads = store
+    model_store.ensure_model(URL, "model.gguf", folder)
+    os.remove(os.path.join(folder, "model.gguf"))
+
+    def no_network(url):
+        raise AssertionError("a verified model must not touch the network")
+
+    monkeypatch.setattr(model_store, "remote_metadata", no_network)
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == [URL]
+    assert os.path.samefile(path, model_store.blob_path(folder, SHA256))
+
+
+def test_complete_legacy_file_is_adopted(store):
+    folder, downloads = store
+    os.makedirs(folder)
+    with open(os.path.join(folder, "model.gguf"), "wb") as f:
+        f.write(PAYLOAD)
+
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == []
+    assert os.path.samefile(path, model_store.blob_path(folder, SHA256))
+
+
+def test_truncated_legacy_file_is_downloaded_again(store):
+    folder, downloads = store
+    os.makedirs(folder)
+    with open(os.path.join(folder, "model.gguf"), "wb") as f:
+        f.write(PAYLOAD[:100])
+
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == [URL]
+    assert read(path) == PAYLOAD
+
+
+def test_damaged_blob_is_removed_and_downloaded_again(store):
+    folder, downloads = store
+    model_store.ensure_model(URL, "model.gguf", folder)
+    blob = model_store.blob_path(folder, SHA256)
+    with open(blob, "r+b") as f:
+        f.write(b"X")
+
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == [URL, URL]
+    assert read(path) == PAYLOAD
+    assert os.path.samefile(path, blob)
+
+
+def test_second_url_reuses_blob_with_same_digest(store):
+    folder, downloads = store
+    model_store.ensure_model(URL, "model.gguf", folder)
+    mirror = "https://mirror.example.com/model.gguf"
+
+    path = model_store.ensure_model(mirror, "copy.gguf", folder)
+
+    assert downloads == [URL]
+    assert os.path.samefile(path, model_store.blob_path(folder, SHA256))
+    entry = model_store.load_manifest(folder)["blobs"][SHA256]
+    assert entry["urls"] == [URL, mirror]
+
+
+def test_wrong_linked_etag_raises_and_leaves_nothing(store, monkeypatch):
+    folder, downloads = store
+    monkeypatch.setattr(model_store, "remote_metadata",
+                        lambda url: (len(PAYLOAD), "0" * 64))
+
+    with pytest.raises(IOError, match="Hash mismatch"):
+        model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == [URL]
+    assert not os.path.exists(os.path.join(folder, "model.gguf"))
+    assert os.listdir(os.path.join(folder, "blobs")) == []
+    manifest = model_store.load_manifest(folder)
+    assert manifest["urls"] == {} and manifest["blobs"] == {}
+
+
+def test_offline_missing_model_raises(store, monkeypatch):
+    folder, downloads = store
+    monkeypatch.setattr(model_store, "OFFLINE", True)
+
+    with pytest.raises(model_store.OfflineModelMissing):
+        model_store.ensure_model(URL, "model.gguf", folder)
+    assert downloads == []
+
+
+def test_offline_adopts_file_copied_in_by_hand(store, monkeypatch):
+    folder, downloads = store
+    monkeypatch.setattr(model_store, "OFFLINE", True)
+    os.makedirs(folder)
+    with open(os.path.join(folder, "model.gguf"), "wb") as f:
+        f.write(PAYLOAD)
+
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == []
+    assert model_store.load_manifest(folder)["urls"][URL] == SHA256
+    assert os.path.samefile(path, model_store.blob_path(folder, SHA256))
+
+
+def test_legacy_file_is_not_adopted_when_size_is_unknown(store, monkeypatch):
+    folder, downloads = store
+    os.makedirs(folder)
+    with open(os.path.join(folder, "model.gguf"), "wb") as f:
+        f.write(PAYLOAD[:100])
+    monkeypatch.setattr(model_store, "remote_metadata",
+                        lambda url: (None, None))
+
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+
+    assert downloads == []
+    assert read(path) == PAYLOAD[:100]
+    manifest = model_store.load_manifest(folder)
+    assert manifest["urls"] == {} and manifest["blobs"] == {}
+
+    # Once the server answers again, the truncated file is replaced.
+    monkeypatch.setattr(model_store, "remote_metadata",
+                        lambda url: (len(PAYLOAD), SHA256))
+    path = model_store.ensure_model(URL, "model.gguf", folder)
+    assert downloads == [URL]
+    assert read(path) == PAYLOAD
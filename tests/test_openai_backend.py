@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+import generation_profiles
+from openai_backend import OpenAICompatibleLLM
+
+
+class FakeResponse:
+    def __init__(self, chunks):
+        self.lines = [b"data: " + json.dumps({"choices": [{"text": c}]}).encode()  # nopep8
+                      for c in chunks] + [b"data: [DONE]"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    monkeypatch.setattr(generation_profiles, "ENABLED", True)
+    monkeypatch.setattr("telemetry.record_llm", lambda *args: None)
+    llm = OpenAICompatibleLLM("http://localhost:1/v1", "model",
+                              {"stop": ["</s>", "<|user|>"]})
+
+    def serve(*chunks):
+        llm.session.post = lambda *args, **kwargs: FakeResponse(chunks)
+
+    return llm, serve
+
+
+def test_stop_word_split_across_chunks_never_reaches_caller(llm):
+    llm, serve = llm
+    serve("A tall ", "woman.</", "s> and more")
+
+    assert list(llm.stream("prompt")) == ["A tall ", "woman."]
+
+
+def test_held_back_text_is_passed_on_when_no_stop_word_follows(llm):
+    llm, serve = llm
+    serve("1 <", " 2 <|us", "ually")
+
+    chunks = list(llm.stream("prompt"))
+    assert chunks == ["1 ", "< 2 ", "<|usually"]
+
+
+def test_stop_word_within_one_chunk(llm):
+    llm, serve = llm
+    serve("Hello", " there<|user|> Hi")
+
+    assert "".join(llm.stream("prompt")) == "Hello there"
+
+
+def test_field_rule_ends_stream(llm):
+    llm, serve = llm
+    serve("Lily Har", "per\nShe is")
+
+    assert "".join(llm.stream("prompt", prefix_key="name")) == "Lily Harper"
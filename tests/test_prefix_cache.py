@@ -0,0 +1,125 @@
+import pytest
+
+import prefix_cache
+from prefix_cache import PrefixCachedLLM
+
+CONFIG = {"max_new_tokens": 4, "context_length": 4096}
+PROMPTS = {
+    key: f"few-shot template of {key} " * 20 + "request"
+    for key in ("a", "b", "c")
+}
+
+
+class FakeModel:
+    """Keeps an evaluated context and reuses its common prefix, like
+    a CTransformers model; every word is a token.
+    """
+
+    def __init__(self, context_length):
+        self.context_length = context_length
+        self._context = []
+
+    def tokenize(self, text):
+        return text.split()
+
+    def detokenize(self, tokens):
+        return " ".join(tokens)
+
+    def prepare_inputs_for_generation(self, tokens, reset=True):
+        shared = 0
+        for old, new in zip(self._context, tokens):
+            if old != new:
+                break
+            shared += 1
+        # The last token is evaluated again to get its logits.
+        shared = min(shared, len(tokens) - 1)
+        del self._context[shared:]
+        return tokens[shared:]
+
+    def eval(self, tokens):
+        self._context.extend(tokens)
+
+    def __call__(self, prompt, stop=None, stream=True, reset=True,
+                 max_new_tokens=4):
+        tokens = self.tokenize(prompt)
+        self.eval(self.prepare_inputs_for_generation(tokens)[-1:])
+        for i in range(max_new_tokens):
+            self._context.append(f"out{i}")
+            yield f" out{i}"
+
+
+@pytest.fixture
+def models(monkeypatch):
+    """Every model the cache creates, in order."""
+    created = []
+
+    def model(self, context_length):
+        created.append(FakeModel(context_length))
+        return created[-1]
+
+    monkeypatch.setattr(PrefixCachedLLM, "_model", model)
+    monkeypatch.setattr(prefix_cache.prompt_budget, "DYNAMIC", True)
+    return created
+
+
+def run(llm, key):
+    assert llm.invoke(PROMPTS[key], prefix_key=key) == " out0 out1 out2 out3"
+    return llm.last_timing["reused_tokens"]
+
+
+def test_second_prefix_key_gets_its_own_slot(models):
+    llm = PrefixCachedLLM("model.gguf", "llama", CONFIG, slots=2)
+    run(llm, "a")
+    run(llm, "b")
+
+    assert len(models) == 2
+    assert llm._instances["a"]["llm"] is models[0]
+    assert llm._instances["b"]["llm"] is models[1]
+    # Both templates stay evaluated in their own slot.
+    assert run(llm, "a") == len(PROMPTS["a"].split()) - 1
+    assert run(llm, "b") == len(PROMPTS["b"].split()) - 1
+
+
+def test_least_recently_used_slot_is_handed_over(models):
+    llm = PrefixCachedLLM("model.gguf", "llama", CONFIG, slots=2)
+    run(llm, "a")
+    run(llm, "b")
+    run(llm, "a")
+
+    assert run(llm, "c") == 0
+
+    assert len(models) == 2
+    assert list(llm._instances) == ["a", "c"]
+    assert llm._instances["c"]["llm"] is models[1]
+    assert run(llm, "a") > 0
+
+
+def test_invalidate_resets_only_that_slot(models):
+    llm = PrefixCachedLLM("model.gguf", "llama", CONFIG, slots=2)
+    run(llm, "a")
+    run(llm, "b")
+
+    llm.invalidate("a")
+
+    assert run(llm, "a") == 0
+    assert run(llm, "b") == len(PROMPTS["b"].split()) - 1
+    assert run(llm, "a") == len(PROMPTS["a"].split()) - 1
+
+
+def test_invalidate_without_key_resets_every_slot(models):
+    llm = PrefixCachedLLM("model.gguf", "llama", CONFIG, slots=2)
+    run(llm, "a")
+    run(llm, "b")
+
+    llm.invalidate()
+
+    assert run(llm, "a") == 0
+    assert run(llm, "b") == 0
+
+
+def test_no_slots_never_reuses(models):
+    llm = PrefixCachedLLM("model.gguf", "llama", CONFIG, slots=0)
+    run(llm, "a")
+
+    assert run(llm, "a") == 0
+    assert len(models) == 1
@@ -0,0 +1,62 @@
+from prompt_budget import context_size, examples, fit_prompt
+
+SYSTEM = "<|system|> Write names only. </s>\n"
+EXAMPLE_1 = "<|user|> Topic: cats </s>\n<|assistant|> Mr. Fluffy </s>\n"
+EXAMPLE_2 = "<|user|> Topic: ships </s>\n<|assistant|> Captain Reed </s>\n"
+REQUEST = "<|user|> Topic: fantasy </s>\n<|assistant|>"
+PROMPT = SYSTEM + EXAMPLE_1 + EXAMPLE_2 + REQUEST
+
+
+def tokenize(text):
+    return text.split()
+
+
+def detokenize(tokens):
+    return "".join(token + " " for token in tokens)
+
+
+def test_context_size_doubles_from_minimum_up_to_maximum():
+    assert context_size(10, 8192) == 1024
+    assert context_size(1025, 8192) == 2048
+    assert context_size(3000, 8192) == 4096
+    assert context_size(9000, 8192) == 8192
+
+
+def test_examples_are_spans_between_user_turns():
+    assert [PROMPT[start:end] for start, end in examples(PROMPT)] == \
+        [EXAMPLE_1, EXAMPLE_2]
+
+
+def test_prompt_within_budget_is_unchanged():
+    budget = len(tokenize(PROMPT))
+    assert fit_prompt(PROMPT, tokenize, detokenize, budget) == \
+        (PROMPT, 0, False)
+
+
+def test_oldest_example_is_dropped_first():
+    budget = len(tokenize(PROMPT)) - 1
+    assert fit_prompt(PROMPT, tokenize, detokenize, budget) == \
+        (SYSTEM + EXAMPLE_2 + REQUEST, 1, False)
+
+
+def test_all_examples_are_dropped_before_cutting():
+    budget = len(tokenize(SYSTEM + REQUEST))
+    assert fit_prompt(PROMPT, tokenize, detokenize, budget) == \
+        (SYSTEM + REQUEST, 2, False)
+
+
+def test_middle_is_cut_keeping_start_and_request():
+    prompt, dropped, truncated = fit_prompt(PROMPT, tokenize, detokenize, 8)
+
+    assert (dropped, truncated) == (2, True)
+    # A quarter of the budget from the start, the rest from the end.
+    assert tokenize(prompt) == ["<|system|>", "Write"] + \
+        tokenize(SYSTEM + REQUEST)[-6:]
+
+
+def test_tiny_budget_loses_the_system_text():
+    prompt, dropped, truncated = fit_prompt(PROMPT, tokenize, detokenize, 5)
+
+    assert (dropped, truncated) == (2, True)
+    assert tokenize(prompt) == ["<|system|>"] + tokenize(REQUEST)[-4:]
+    assert "Write" not in prompt
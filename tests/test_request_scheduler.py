@@ -0,0 +1,202 @@
+import threading
+import time
+import types
+
+import pytest
+
+import generation_profiles
+import request_scheduler
+from llm_backend import LLMBackend
+from request_scheduler import ScheduledLLM
+
+TIMEOUT = 5
+
+
+class FakeLLM(LLMBackend):
+    """Yields `chunks` chunks per prompt and records what runs when.
+
+    While `gate` is cleared, a generation that starts waits for it, which
+    holds the decode thread.
+    """
+
+    def __init__(self, slots=1, chunks=3):
+        self.slots = slots
+        self.chunks = chunks
+        self.config = {"max_new_tokens": 1024}
+        self.gate = threading.Event()
+        self.gate.set()
+        self.started = []
+        self.active = []
+        self.most_active = 0
+        self.same_key_at_once = False
+        self._lock = threading.Lock()
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        with self._lock:
+            self.same_key_at_once |= any(key == prefix_key
+                                         for _, key in self.active)
+            self.started.append(prompt)
+            self.active.append((prompt, prefix_key))
+            self.most_active = max(self.most_active, len(self.active))
+        try:
+            self.gate.wait(TIMEOUT)
+            for i in range(self.chunks):
+                yield f"{prompt}{i} "
+        finally:
+            with self._lock:
+                self.active.remove((prompt, prefix_key))
+
+
+class EndlessLLM(FakeLLM):
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        if prompt != "endless":
+            yield from super().stream(prompt, stop, prefix_key)
+            return
+        with self._lock:
+            self.started.append(prompt)
+        while True:
+            yield "more "
+
+
+@pytest.fixture(autouse=True)
+def profiles_on(monkeypatch):
+    # name: 24 new tokens, greeting_message: 384, example_messages: 640.
+    monkeypatch.setattr(generation_profiles, "ENABLED", True)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(request_scheduler, "time",
+                        types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+class Users:
+    """Runs every request in its own thread, like web UI sessions."""
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.results = {}
+        self.threads = []
+
+    def submit(self, prompt, prefix_key):
+        def run():
+            self.results[prompt] = self.llm.invoke(prompt,
+                                                   prefix_key=prefix_key)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(TIMEOUT)
+            assert not thread.is_alive()
+
+
+def hold_decode_thread(fake, scheduled, users):
+    # A first request starts and keeps the decode thread busy, so the next
+    # ones queue up and are admitted together.
+    fake.gate.clear()
+    users.submit("first", "summary")
+    wait_until(lambda: fake.started == ["first"])
+
+
+def queue_and_release(fake, scheduled, users, requests, waiting=0):
+    for prompt, prefix_key in requests:
+        users.submit(prompt, prefix_key)
+    waiting += len(requests)
+    wait_until(lambda: scheduled.stats()["waiting"] == waiting)
+    fake.gate.set()
+    users.join()
+
+
+def test_short_job_overtakes_long_job(clock):
+    fake = FakeLLM()
+    scheduled = ScheduledLLM(fake)
+    users = Users(scheduled)
+    hold_decode_thread(fake, scheduled, users)
+
+    queue_and_release(fake, scheduled, users, [
+        ("long", "example_messages"), ("short", "name"),
+    ])
+
+    assert fake.started == ["first", "short", "long"]
+    assert users.results["long"] == "long0 long1 long2 "
+
+
+def test_aging_lets_long_job_go_first_after_waiting(clock):
+    fake = FakeLLM()
+    scheduled = ScheduledLLM(fake)
+    users = Users(scheduled)
+    hold_decode_thread(fake, scheduled, users)
+    users.submit("long", "example_messages")
+    wait_until(lambda: scheduled.stats()["waiting"] == 1)
+    # 640 tokens of cost are made up after 32 seconds.
+    clock[0] = 100.0
+
+    queue_and_release(fake, scheduled, users, [("short", "name")], waiting=1)
+
+    assert fake.started == ["first", "long", "short"]
+
+
+def test_running_jobs_never_exceed_slots():
+    fake = FakeLLM(slots=2)
+    scheduled = ScheduledLLM(fake)
+    users = Users(scheduled)
+    fields = ["name", "summary", "personality", "scenario",
+              "avatar_prompt", "default"]
+    for field in fields:
+        users.submit(field, field)
+    users.join()
+
+    assert sorted(fake.started) == sorted(fields)
+    assert fake.most_active <= 2
+
+
+def test_long_jobs_leave_a_slot_for_short_ones():
+    fake = FakeLLM(slots=2)
+    scheduled = ScheduledLLM(fake)
+    users = Users(scheduled)
+    hold_decode_thread(fake, scheduled, users)
+
+    queue_and_release(fake, scheduled, users, [
+        ("example", "example_messages"), ("greeting", "greeting_message"),
+    ])
+
+    # "first" (summary, 512 tokens) is long too, so the long jobs ran one
+    # after the other.
+    assert fake.most_active == 1
+
+
+def test_same_prefix_key_never_runs_twice_at_once():
+    fake = FakeLLM(slots=3)
+    scheduled = ScheduledLLM(fake)
+    users = Users(scheduled)
+    for i in range(4):
+        users.submit(f"name{i}", "name")
+    users.join()
+
+    assert len(fake.started) == 4
+    assert not fake.same_key_at_once
+
+
+def test_closing_consumer_frees_its_slot():
+    fake = EndlessLLM()
+    scheduled = ScheduledLLM(fake)
+    stream = scheduled.stream("endless", prefix_key="summary")
+    assert next(stream) == "more "
+
+    stream.close()
+
+    assert scheduled.invoke("after", prefix_key="name") == "after0 after1 after2 "  # nopep8
+    wait_until(lambda: scheduled.stats()["running"] == 0)
+    assert scheduled.stats()["completed"] == 2
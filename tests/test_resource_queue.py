@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+import resource_queue
+from resource_queue import QueueFull, ResourceQueue
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_requests_within_limit_start_at_once():
+    queue = ResourceQueue("LLM", limit=2, max_queue=4)
+    first, second = queue.join(), queue.join()
+
+    assert (first.position(), second.position()) == (0, 0)
+    assert queue.active == 2
+
+
+def test_waiting_positions_follow_arrival():
+    queue = ResourceQueue("LLM", limit=1, max_queue=4)
+    running = queue.join()
+    waiting = [queue.join() for _ in range(3)]
+
+    assert [ticket.position() for ticket in waiting] == [1, 2, 3]
+    waiting[0].release()
+    assert [ticket.position() for ticket in waiting[1:]] == [1, 2]
+    assert running.position() == 0
+
+
+def test_full_queue_turns_requests_away():
+    queue = ResourceQueue("Stable Diffusion", limit=1, max_queue=2)
+    queue.join()
+    queue.join()
+    queue.join()
+
+    with pytest.raises(QueueFull, match="Stable Diffusion"):
+        queue.join()
+    assert queue.rejected == 1
+    assert "1 turned away" in queue.status()
+
+
+def test_release_starts_next_ticket():
+    queue = ResourceQueue("LLM", limit=1, max_queue=4)
+    running = queue.join()
+    waiting = queue.join()
+    assert not waiting.wait(0)
+
+    running.release()
+
+    assert waiting.wait(0)
+    assert waiting.position() == 0
+    assert queue.active == 1
+    # Releasing twice does not free a second place.
+    running.release()
+    assert queue.active == 1
+
+
+def test_release_wakes_waiting_thread():
+    queue = ResourceQueue("LLM", limit=1, max_queue=4)
+    running = queue.join()
+    started = threading.Event()
+
+    def waiter():
+        with queue.slot():
+            started.set()
+
+    thread = threading.Thread(target=waiter, daemon=True)
+    thread.start()
+    assert not started.wait(0.05)
+    running.release()
+    assert started.wait(5)
+    thread.join(5)
+    assert queue.active == 0
+
+
+def test_slot_reports_position_while_waiting(monkeypatch):
+    monkeypatch.setattr(resource_queue, "POLL_SECONDS", 0.01)
+    queue = ResourceQueue("LLM", limit=1, max_queue=4)
+    running = queue.join()
+    ahead = queue.join()
+    positions = []
+    entered = threading.Event()
+
+    def waiter():
+        with queue.slot(positions.append):
+            entered.set()
+
+    thread = threading.Thread(target=waiter, daemon=True)
+    thread.start()
+    wait_for(lambda: positions == [2])
+    running.release()
+    wait_for(lambda: positions == [2, 1])
+    assert not entered.is_set()
+    ahead.release()
+
+    assert entered.wait(5)
+    thread.join(5)
+    assert positions == [2, 1]
+
+
+def test_slot_releases_on_exception():
+    queue = ResourceQueue("LLM", limit=1, max_queue=4)
+
+    with pytest.raises(RuntimeError):
+        with queue.slot():
+            assert queue.active == 1
+            raise RuntimeError("generation failed")
+
+    assert queue.active == 0
+    with queue.slot():
+        assert queue.active == 1
@@ -0,0 +1,81 @@
+import itertools
+
+import pytest
+
+import response_cache
+from llm_backend import LLMBackend
+from response_cache import CachedLLM, ResponseCache, response_key
+
+CONFIG = {"temperature": 0.8, "top_k": 40, "threads": 8}
+
+
+class CountingLLM(LLMBackend):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.config = dict(CONFIG)
+        self.calls = 0
+
+    def stream(self, prompt, stop=None, prefix_key="default"):
+        self.calls += 1
+        yield from self.chunks
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    # Every put and get happens one second after the previous one.
+    clock = itertools.count(1000)
+    monkeypatch.setattr(response_cache.time, "time", lambda: next(clock))
+    return ResponseCache(str(tmp_path / "cache.sqlite"))
+
+
+def test_key_depends_on_everything_that_changes_the_text():
+    key = response_key("digest", "prompt", CONFIG, ["</s>"], {"lines": 1})
+    assert key == response_key("digest", "prompt", dict(CONFIG), ["</s>"],
+                               {"lines": 1})
+    assert key != response_key("other", "prompt", CONFIG, ["</s>"], {"lines": 1})  # nopep8
+    assert key != response_key("digest", "prompt!", CONFIG, ["</s>"], {"lines": 1})  # nopep8
+    assert key != response_key("digest", "prompt", {**CONFIG, "temperature": 0.1}, ["</s>"], {"lines": 1})  # nopep8
+    assert key != response_key("digest", "prompt", CONFIG, ["\n"], {"lines": 1})  # nopep8
+    assert key != response_key("digest", "prompt", CONFIG, ["</s>"], {"lines": 2})  # nopep8
+
+
+def test_key_ignores_settings_that_only_change_speed():
+    assert response_key("d", "p", CONFIG, None) == \
+        response_key("d", "p", {**CONFIG, "threads": 2, "batch_size": 512}, None)  # nopep8
+
+
+def test_eviction_keeps_most_recently_used(cache):
+    cache.max_bytes = 30
+    cache.put("a", "x" * 10)
+    cache.put("b", "x" * 10)
+    cache.put("c", "x" * 10)
+    assert cache.get("a") is not None  # a is now newer than b
+    cache.put("d", "x" * 10)
+
+    assert cache.get("b") is None
+    assert [cache.get(k) is not None for k in "acd"] == [True, True, True]
+    assert cache.stats()["bytes"] == 30
+
+
+def test_cached_llm_answers_repeated_request_from_cache(cache):
+    llm = CountingLLM(["Lily ", "Harper"])
+    cached = CachedLLM(llm, "remote-model", cache)
+
+    assert cached.invoke("prompt", prefix_key="name") == "Lily Harper"
+    assert cached.invoke("prompt", prefix_key="name") == "Lily Harper"
+    assert llm.calls == 1
+    assert cached.config == CONFIG
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_stream_closed_early_is_not_stored(cache):
+    llm = CountingLLM(["Lily ", "Harper"])
+    cached = CachedLLM(llm, "remote-model", cache)
+
+    stream = cached.stream("prompt")
+    assert next(stream) == "Lily "
+    stream.close()
+
+    assert cache.stats()["entries"] == 0
+    assert cached.invoke("prompt") == "Lily Harper"
+    assert llm.calls == 2